@@ -57,6 +57,9 @@ def SetIntras(mat, value=0, inplace=True):
     '''Sets intra zonal values'''
     if inplace:
         mat.loc[mat.index.get_level_values(0) == mat.index.get_level_values(1), :] = value
+        if hasattr(mat, 'invalidate'):
+            #memoised trip ends, totals... (Matrix)
+            mat.invalidate()
     else:
         aux = mat.copy()
         aux.loc[mat.index.get_level_values(0) == mat.index.get_level_values(1), :] = value
@@ -89,6 +92,58 @@ def CheckEMMEmatNumber(s):
     except:
         raise NameError(ErrMsg)
 
+def EMME_records(O, D, values, decimals=4, compact=False, values_per_line=10,
+                 skip_value=None):
+    '''Returns the text of EMME full matrix (mf) records for arrays O, D,
+    values. Missing values (and values equal to skip_value, e.g. the matrix
+    default value) are not written.
+    compact=False: one record per OD pair, " O D: value".
+    compact=True: one record per origin and up to values_per_line
+    destinations, " O D1: value1 D2: value2 ...". Records of the same
+    origin must be consecutive.'''
+    O, D, values = np.asarray(O), np.asarray(D), np.asarray(values)
+    sel = pd.notnull(values)
+    if skip_value is not None:
+        sel &= values != skip_value
+    #python scalars (tolist) format much faster than numpy scalars
+    O, D, values = O[sel].tolist(), D[sel].tolist(), values[sel].tolist()
+
+    if not compact:
+        fmt = '\n %s %s: %.{}f'.format(decimals)
+        return ''.join([fmt % rec for rec in zip(O, D, values)])
+
+    fmt = '%s: %.{}f'.format(decimals)
+    cells = [fmt % cell for cell in zip(D, values)]
+    #a new line for each origin, and every values_per_line within an origin
+    lines = []
+    start, n = 0, len(O)
+    while start < n:
+        end = start + 1
+        while end < n and end - start < values_per_line and O[end] == O[start]:
+            end += 1
+        lines.append('\n %s %s' % (O[start], ' '.join(cells[start:end])))
+        start = end
+    return ''.join(lines)
+
+def EMME_mf_records(data):
+    '''Returns a list of (O, D, value) strings from the text of the records
+    of an EMME full matrix, with one or more "D: value" per line (separated
+    by any whitespace). Comment lines (c ...) are skipped. Raises
+    ValueError for other lines without records.'''
+    records = []
+    for line in data.splitlines():
+        fields = line.split(None, 1)
+        if not fields or fields[0] == 'c':
+            continue
+        parts = fields[1].replace(':', ' : ').split() if len(fields) > 1 else []
+        #parts: D : value D : value ...
+        found = [(fields[0], parts[k], parts[k + 2])
+                 for k in range(0, len(parts) - 2, 3) if parts[k + 1] == ':']
+        if not found:
+            raise ValueError('Invalid EMME matrix record: {!r}'.format(line))
+        records.extend(found)
+    return records
+
 def StringIsInt(s):
     '''True if string represents an int, False otherwise'''
     try: 
@@ -116,11 +171,13 @@ def trim_index_df(df: pd.DataFrame, index_names_to_keep: list, inplace=False):
         return df.reset_index(level=indexes_to_drop, drop=True)
 
 def mat(n):
-    mat = pd.DataFrame({'O': [x+1 for x in range(n) for _ in range(n)],
-                        'D': [x+1 for x in range(n)] * n,
-                        'T1':[int((x%3)!=0) for x in range(n*n)],
-                        'T2':[x+1 for x in range(n*n)],
-                        'T3':[-(x%n)**2+n*(x%n) for x in range(n*n)]})
+    zones = np.arange(1, n+1)
+    x = np.arange(n*n)
+    mat = pd.DataFrame({'O': np.repeat(zones, n),
+                        'D': np.tile(zones, n),
+                        'T1': ((x%3)!=0).astype(int),
+                        'T2': x+1,
+                        'T3': -(x%n)**2+n*(x%n)})
     mat = mat.set_index(['O', 'D'])
     #remove intrazonals:
     mat.loc[mat.index.get_level_values(0) == mat.index.get_level_values(1), 'T3'] = 0 
@@ -128,12 +185,61 @@ def mat(n):
 
 def I(n):
     '''returns identity matrix of n x n'''
-    matI = pd.DataFrame({'O': [x+1 for x in range(n) for _ in range(n)],
-                         'D': [x+1 for x in range(n)] * n})
-    matI['T'] = (matI.O == matI.D).apply(int)
+    zones = np.arange(1, n+1)
+    matI = pd.DataFrame({'O': np.repeat(zones, n),
+                         'D': np.tile(zones, n)})
+    matI['T'] = (matI.O == matI.D).astype(int)
     matI = matI.set_index(['O', 'D'])
     return matI
 
+def synthetic_zones(n, size=100., seed=0):
+    '''Returns a dataframe of n zones (1..n) with random coordinates (x, y)
+    in a size x size area, population and employment.'''
+    rng = np.random.default_rng(seed)
+    zones = pd.DataFrame({'x': rng.uniform(0, size, n),
+                          'y': rng.uniform(0, size, n),
+                          'pop': rng.lognormal(7, 1, n),
+                          'emp': rng.lognormal(6.5, 1.2, n)},
+                         index=pd.Index(np.arange(1, n+1), name='zone'))
+    return zones
+
+def synthetic_cost(n, segments=1, size=100., seed=0, dtype=np.float64):
+    '''Returns a synthetic cost (distance) matrix for n zones, as a dataframe
+    with [O, D] index and one column per segment (C1, C2...).
+    Costs are straight-line distances times a detour factor per segment;
+    intrazonals are half the distance to the nearest zone.'''
+    zones = synthetic_zones(n, size, seed)
+    x = zones['x'].values
+    y = zones['y'].values
+    dist = np.hypot(x[:, np.newaxis] - x, y[:, np.newaxis] - y)
+    np.fill_diagonal(dist, np.inf)
+    intra = dist.min(axis=1) / 2 if n > 1 else np.ones(n)
+    np.fill_diagonal(dist, intra)
+    idx = pd.MultiIndex.from_product([zones.index, zones.index], names=['O', 'D'])
+    cols = {'C{}'.format(s+1): (dist.ravel() * (1.2 + 0.1 * s)).astype(dtype)
+            for s in range(segments)}
+    return pd.DataFrame(cols, index=idx)
+
+def synthetic_demand(n, segments=1, trips=None, beta=0.05, size=100., seed=0,
+                     dtype=np.float64):
+    '''Returns a synthetic demand matrix for n zones, as a dataframe with
+    [O, D] index and one column per segment (T1, T2...). Demand follows a
+    gravity model (pop_i * emp_j * exp(-beta * cost_ij)) with random noise,
+    scaled to trips per segment (default: total zone population).'''
+    rng = np.random.default_rng(seed)
+    zones = synthetic_zones(n, size, seed)
+    cost = synthetic_cost(n, 1, size, seed).values[:, 0]
+    base = (np.repeat(zones['pop'].values, n) * np.tile(zones['emp'].values, n)
+            * np.exp(-beta * cost))
+    if trips is None:
+        trips = zones['pop'].sum()
+    cols = {}
+    for s in range(segments):
+        seg = base * rng.gamma(2., .5, n * n)
+        cols['T{}'.format(s+1)] = (seg * trips / seg.sum()).astype(dtype)
+    idx = pd.MultiIndex.from_product([zones.index, zones.index], names=['O', 'D'])
+    return pd.DataFrame(cols, index=idx)
+
 import random
 
 def randomizeSeries(S, fraction):
@@ -143,60 +249,149 @@ def randomizeSeries(S, fraction):
 def randomizeTE(TE):
     return TE.apply(randomizeSeries, args=[10])
 
+def flat_labels(columns, sep='_', strip=True, escape=True):
+    '''Returns the flat labels of MultiIndex columns, joining the level
+    labels with sep. Any sep (or backslash) inside a label is escaped with
+    a backslash, so split_labels can always recover the levels.
+        escape - False for plain joined labels (names, file names), which
+                 may not split back'''
+    levels = [columns.get_level_values(i).astype(str).astype(object)
+              for i in range(columns.nlevels)]
+    if escape:
+        levels = [level.str.replace('\\', '\\\\', regex=False)
+                       .str.replace(sep, '\\' + sep, regex=False)
+                  for level in levels]
+    cols = levels[0]
+    for level in levels[1:]:
+        cols = cols + sep + level
+    if strip:
+        cols = cols.str.strip()
+    return pd.Index(cols, name=None)
+
+def split_labels(labels, sep='_'):
+    '''Returns the MultiIndex of flat labels (see flat_labels): labels are
+    split on sep, except where escaped with a backslash.'''
+    if not any('\\' in c for c in labels):
+        return pd.MultiIndex.from_tuples([c.split(sep) for c in labels])
+    
+    unescaped = re.compile(r'(?<!\\)((?:\\\\)*){}'.format(re.escape(sep)))
+    unescape = re.compile(r'\\(\\|{})'.format(re.escape(sep)))
+    tup = []
+    for c in labels:
+        parts = unescaped.sub(lambda m: m.group(1) + '\0', c).split('\0')
+        tup.append([unescape.sub(r'\1', p) for p in parts])
+    return pd.MultiIndex.from_tuples(tup)
+
 def flatten_cols(df, sep='_', strip=True, inplace=True):
-    '''Turns a MultiIndex-column dataframe into a simple-column dataframe.'''
+    '''Turns a MultiIndex-column dataframe into a simple-column dataframe.
+    Only the column labels change: the data is not copied.'''
 
     if not isinstance(df.columns, pd.MultiIndex):
         raise ValueError("Columns are already flat")
     
-    if strip:
-        cols = [sep.join([str(c) for c in col_vals]).strip() for col_vals in df.columns.values]
-    else:
-        cols = [sep.join([str(c) for c in col_vals]) for col_vals in df.columns.values]
+    cols = flat_labels(df.columns, sep=sep, strip=strip)
     
     if inplace:
         df.columns = cols
     else:
-        newdf = df.copy()
+        newdf = df.copy(deep=False)
         newdf.columns = cols
         return newdf
 
 def split_cols(df, sep='_', inplace=True):
     '''Turns a simple-column dataframe into a MultiIndex-column by
-    splitting the labels'''
+    splitting the labels (escaped separators are kept, see flat_labels).
+    Only the column labels change: the data is not copied.'''
 
     if isinstance(df.columns, pd.MultiIndex):
         raise ValueError("Columns are already MultiIndex")
     
-    tup = [c.split(sep) for c in df.columns.values]
-    newidx = pd.MultiIndex.from_tuples(tup)
+    newidx = split_labels([str(c) for c in df.columns.values], sep=sep)
 
     if inplace:
         df.columns = newidx
     else:
-        newdf = df.copy()
+        newdf = df.copy(deep=False)
         newdf.columns = newidx
         return newdf
 
 
+class ColumnPairs:
+    '''Columns of several dataframes taken by position: pair i is formed of
+    the i-th column of each dataframe. Indexes are aligned once (outer join,
+    as pd.concat) and pairs are built from column views, without copies.
+    If default_col_index is given, dataframes with fewer columns use that
+    column for the missing pairs (useful to broadcast one column to the
+    rest of the dataframes).
+
+        pairs = ColumnPairs([mat, dist])
+        pairs.stacked       #array of dataframes x rows x pairs
+        for df in pairs:    #a dataframe for each pair (as zip_df_cols)
+    '''
+
+    def __init__(self, dflist, default_col_index=None):
+        coln = [len(df.columns) for df in dflist]
+        if default_col_index is None and len(set(coln)) > 1:
+            raise IndexError('Input dataframes have different number of columns.')
+        self.npairs = max(coln)
+        self.positions = [[i if i < n else default_col_index
+                           for i in range(self.npairs)] for n in coln]
+
+        index = dflist[0].index
+        for df in dflist[1:]:
+            if not df.index.equals(index):
+                index = index.union(df.index, sort=False)
+        self.index = index
+        self.frames = [df if df.index.equals(index) else df.reindex(index)
+                       for df in dflist]
+        self._stacked = None
+
+    def __len__(self):
+        return self.npairs
+
+    def __iter__(self):
+        for i in range(self.npairs):
+            yield self.pair(i)
+
+    def labels(self, i):
+        '''Returns the column labels of pair i.'''
+        return [df.columns[pos[i]] for df, pos in zip(self.frames, self.positions)]
+
+    def names(self, sep=' - '):
+        '''Returns a name for each pair, joining its column labels.'''
+        return [sep.join([str(c) for c in self.labels(i)])
+                for i in range(self.npairs)]
+
+    def pair(self, i, sep=None):
+        '''Returns a dataframe with the columns of pair i (views).
+        sep - if given, MultiIndex labels are joined with sep (plain labels,
+              see flat_labels)'''
+        cols = {k: df.iloc[:, pos[i]].to_numpy()
+                for k, (df, pos) in enumerate(zip(self.frames, self.positions))}
+        df = pd.DataFrame(cols, index=self.index, copy=False)
+        columns = pd.Index(self.labels(i), tupleize_cols=True)
+        if sep is not None and isinstance(columns, pd.MultiIndex):
+            columns = flat_labels(columns, sep=sep, escape=False)
+        df.columns = columns
+        return df
+
+    @property
+    def stacked(self):
+        '''Values of all the pairs as a float array of shape
+        (dataframes, rows, pairs), for operations over all pairs at once.'''
+        if self._stacked is None:
+            self._stacked = np.stack([df.to_numpy(dtype=np.float64)[:, pos]
+                                      for df, pos in zip(self.frames, self.positions)])
+        return self._stacked
+
 def zip_df_cols(dflist, default_col_index=None):
     '''generator yields dataframes formed of pair-wise concatenation of columns
     from each df in the input dataframe list.
     If the dataframes are of uneven length, missing values are filled-in with
     the first column of each df. This is usefull when broadcasting one column
-    to the rest of the dataframes'''
-    dflist_coln = [len(df.columns) for df in dflist]
-    max_coln = max(dflist_coln)
-    for i in range(max_coln):
-        if default_col_index is not None:
-            #default to first column for df with not enough
-            use_cols = [i if i <= (coln-1) else 0 for coln in dflist_coln]
-            yield pd.concat([df.iloc[:,col] for col,df in zip(use_cols, dflist)], axis=1)
-        else:
-            try:
-                yield pd.concat([df.iloc[:,i] for df in dflist], axis=1)
-            except IndexError:
-                raise IndexError('Input dataframes have different number of columns.')
+    to the rest of the dataframes (see ColumnPairs)'''
+    for df in ColumnPairs(dflist, default_col_index=default_col_index):
+        yield df
 
 def df_difference(dfi, dff, percent=False):
     '''Returns dff-dfi difference. Asumes compatible indexes.
@@ -316,10 +511,91 @@ def ScatterPlot_ConsecutiveColPairs(df, oFileNamePattern='{}', title='',
         if output_df:
             df.to_csv(oFileName + '.csv')
 
-def RegressionStats_ConsecutiveColPairs(df, prefixes='', suffixes='', **kwargs):
+def RegressionStats_ColPairs(x, y, weights=None, through_origin=False, names=None):
+    '''Returns a dataframe with the regression stats of y on x for every
+    column pair (x[:,i], y[:,i]), computed in one pass from closed-form sums.
+        x, y           - 2D arrays or dataframes (observations x pairs)
+        weights        - observation weights, (observations,) or same shape as x
+        through_origin - fit y = slope*x (intercept fixed to 0)
+        names          - labels for the pairs. Default: 'xcol - ycol'
+    NaN values are dropped pair-wise. Stats: slope, intercept, R2, RMSE,
+    %RMSE (over the mean of x), GEH (mean) and GEH<5 (proportion).
+    '''
+
+    if names is None and isinstance(x, pd.DataFrame) and isinstance(y, pd.DataFrame):
+        names = [' - '.join([str(colx), str(coly)])
+                 for colx, coly in zip(x.columns, y.columns)]
+
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    if x.ndim == 1:
+        x = x[:, np.newaxis]
+    if y.ndim == 1:
+        y = y[:, np.newaxis]
+    if x.shape != y.shape:
+        raise ValueError('x and y must have the same shape.')
+
+    if weights is None:
+        w = np.ones(x.shape)
+    else:
+        w = np.asarray(weights, dtype=np.float64)
+        if w.ndim == 1:
+            w = w[:, np.newaxis]
+        w = np.broadcast_to(w, x.shape)
+
+    valid = ~(np.isnan(x) | np.isnan(y))
+    w = np.where(valid, w, 0.)
+    x = np.where(valid, x, 0.)
+    y = np.where(valid, y, 0.)
+
+    wx = w * x
+    wy = w * y
+    Sw = w.sum(axis=0)
+    Sx = wx.sum(axis=0)
+    Sy = wy.sum(axis=0)
+    Sxx = (wx * x).sum(axis=0)
+    Sxy = (wx * y).sum(axis=0)
+    Syy = (wy * y).sum(axis=0)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if through_origin:
+            slope = Sxy / Sxx
+            intercept = np.zeros_like(slope)
+            SStot = Syy #uncentred R2
+        else:
+            Sxx_c = Sxx - Sx * Sx / Sw
+            Sxy_c = Sxy - Sx * Sy / Sw
+            Syy_c = Syy - Sy * Sy / Sw
+            slope = Sxy_c / Sxx_c
+            intercept = (Sy - slope * Sx) / Sw
+            SStot = Syy_c
+
+        #residuals rather than Syy - slope*Sxy, which loses precision
+        SSres = (w * (y - intercept - slope * x) ** 2).sum(axis=0)
+        R2 = 1 - SSres / SStot
+        RMSE = np.sqrt(SSres / Sw)
+        pRMSE = 100 * RMSE / (Sx / Sw)
+
+        xy = x + y
+        GEH = np.sqrt(np.where(xy > 0, 2 * (y - x) ** 2 / np.where(xy > 0, xy, 1), 0))
+        GEHmean = (w * GEH).sum(axis=0) / Sw
+        GEHlt5 = (w * (GEH < 5)).sum(axis=0) / Sw
+
+    regression_df = pd.DataFrame({'slope': slope, 'intercept': intercept,
+                                  'R2': R2, 'RMSE': RMSE, '%RMSE': pRMSE,
+                                  'GEH': GEHmean, 'GEH<5': GEHlt5},
+                                 index=names,
+                                 columns=['slope', 'intercept', 'R2', 'RMSE',
+                                          '%RMSE', 'GEH', 'GEH<5'])
+    return regression_df
+
+def RegressionStats_ConsecutiveColPairs(df, prefixes='', suffixes='',
+                weights=None, through_origin=False, **kwargs):
     '''Returns a dataframe with the regression stats of consecutive df columns.
         prefixes         - to prepend to each column. Use as a marker.
         suffixes         - to append to each column. Use as a marker.
+        weights          - observation weights (see RegressionStats_ColPairs)
+        through_origin   - fit regressions with intercept fixed to 0
     '''
     
     if prefixes:
@@ -337,19 +613,15 @@ def RegressionStats_ConsecutiveColPairs(df, prefixes='', suffixes='', **kwargs):
     if duplicates_in_list(df.columns):
         raise ValueError("Duplicate names in DataFrame's columns.")
 
+    if weights is not None:
+        weights = pd.Series(np.asarray(weights, dtype=np.float64), index=df.index)
     df = df.dropna()
+    if weights is not None:
+        weights = weights.reindex(df.index).values
     
-    regression_df = pd.DataFrame(columns=['slope', 'intercept', 'R2'])
-    cols = df.columns
-    
-    for colin, colfn in zip(cols, cols[1:]):
-        ColPairName = ' - '.join([colin, colfn])
-        
-        slope, intercept, r_val, p_val, slope_std_err = stats.linregress(df[colin], df[colfn])
-        r_val = r_val ** 2
-        regression_df.loc[ColPairName] = [slope, intercept, r_val]
-    
-    return regression_df
+    return RegressionStats_ColPairs(df.iloc[:, :-1], df.iloc[:, 1:],
+                                    weights=weights,
+                                    through_origin=through_origin)
 
 def Compare_ConsecutiveColPairs(df, oFileNamePattern='{}', 
         output_scatterplots=True, output_regresion_stats=True, **kwargs):
@@ -365,18 +637,30 @@ def Compare_ConsecutiveColPairs(df, oFileNamePattern='{}',
     if isinstance(df, list):
 
         if len(df) == 1:
-            tdfs = df
-        else:
-            tdfs = zip_df_cols(df, default_col_index=0)
-        
-        regression_stats_dfs = []
-        for df in tdfs:
-
             if output_scatterplots:
-                ScatterPlot_ConsecutiveColPairs(df, oFileNamePattern, **kwargs)
-            regression_stats_dfs.append(RegressionStats_ConsecutiveColPairs(df))
-            
-        regression_stats = pd.concat(regression_stats_dfs)
+                ScatterPlot_ConsecutiveColPairs(df[0], oFileNamePattern, **kwargs)
+            regression_stats = RegressionStats_ConsecutiveColPairs(df[0])
+        else:
+            pairs = ColumnPairs(df, default_col_index=0)
+
+            names = []
+            for pair in pairs:
+                if output_scatterplots:
+                    #may add prefixes / suffixes to the column names
+                    ScatterPlot_ConsecutiveColPairs(pair, oFileNamePattern, **kwargs)
+                elif duplicates_in_list(pair.columns):
+                    raise ValueError("Duplicate names in DataFrame's columns.")
+                names += [' - '.join([str(coli), str(colf)])
+                          for coli, colf in zip(pair.columns, pair.columns[1:])]
+
+            #consecutive columns of all the pairs, fitted in one pass
+            #(rows with any NaN in a pair are dropped, for all its columns)
+            values = pairs.stacked
+            values = np.where(np.isnan(values).any(axis=0), np.nan, values)
+            nrows = values.shape[1]
+            x = values[:-1].transpose(1, 2, 0).reshape(nrows, -1)
+            y = values[1:].transpose(1, 2, 0).reshape(nrows, -1)
+            regression_stats = RegressionStats_ColPairs(x, y, names=names)
         
     elif isinstance(df, pd.DataFrame):
         
@@ -404,3 +688,220 @@ def read_clean(fp):
         data = [row for row in data if row[0]==' ']
         buf = io.StringIO(''.join(data))
     return buf
+
+## VISUM matrix files
+
+VISUMheader_re = re.compile(r'\$([A-Za-z]+)(?:;(.*))?')
+
+def numeric_batches(f, batch_bytes=2**22):
+    '''Generator of 1D arrays with the numbers in the lines read from the
+    open file f, in batches of about batch_bytes. Comment lines (starting
+    with *) are skipped; reading stops at the next $ block (e.g. $NAMES).'''
+    while True:
+        lines = f.readlines(batch_bytes)
+        if not lines:
+            return
+        text = ''.join(lines)
+        end = False
+        if '*' in text or '$' in text:
+            data = []
+            for line in lines:
+                first = line[:1]
+                if first == '*':
+                    continue
+                if first == '$':
+                    end = True
+                    break
+                data.append(line)
+            text = ''.join(data)
+        yield np.fromstring(text, sep=' ')
+        if end:
+            return
+
+def _header_numbers(f, n, numbers):
+    '''Reads lines of f (skipping comments) until numbers has n values.'''
+    while len(numbers) < n:
+        line = f.readline()
+        if not line:
+            raise ValueError('Unexpected end of VISUM matrix header.')
+        if line[:1] == '*' or not line.strip():
+            continue
+        numbers.extend(float(x) for x in line.split())
+    return numbers
+
+def read_VISUM_header(f):
+    '''Reads the header of a VISUM matrix from the open file f, up to the
+    first data values. Returns (fmt, factor, zones, extra): the format
+    letter (O, E or V, or None without header), the factor, the zone
+    numbers ($V) and the numbers read past the header.
+    $OM, $EM and $VM headers have a mode number before the time interval,
+    which is skipped.'''
+    start = f.tell()
+    line = f.readline()
+    while line and (not line.strip() or line[:1] == '*'):
+        line = f.readline()
+    header = VISUMheader_re.match(line)
+    if header is None:
+        #no header: records from the first data line
+        f.seek(start)
+        return None, 1., None, np.array([])
+
+    fmt = header.group(1).upper()
+    if fmt[0] not in 'OEV' or fmt[1:] not in ('', 'M'):
+        raise ValueError('VISUM ${} matrices are not supported: '
+                         'export them as $O, $E or $V.'.format(fmt))
+    #(mode number,) time interval (from, to) and factor
+    skip = len(fmt) - 1
+    numbers = _header_numbers(f, skip + 3, [])[skip:]
+    factor = numbers[2]
+    extra = np.array(numbers[3:])
+    zones = None
+    if fmt[0] == 'V':
+        numbers = _header_numbers(f, 1, list(extra))
+        nzones = int(numbers[0])
+        numbers = _header_numbers(f, nzones + 1, numbers)
+        zones = np.array(numbers[1:nzones+1], dtype=np.int64)
+        extra = np.array(numbers[nzones+1:])
+    return fmt[0], factor, zones, extra
+
+def read_VISUM(file, batch_bytes=2**22):
+    '''Reads a VISUM matrix file and returns (O, D, values) arrays.
+    Supported formats:
+      $O - list of records "O D value" (one or more records per line)
+      $E - as $O, usually without the zero values
+      $V - full matrix: number of zones, zone numbers and then the rows
+      (no header) - records "O D value", as in old FormatO exports
+    and their mode variants ($OM, $EM, $VM), with a mode number in the
+    header. Comments (*) are skipped, values are multiplied by the header
+    factor. Records are parsed in batches straight into arrays.
+    Binary VISUM matrices ($B...) must be exported as $O, $E or $V.
+
+    >>> O, D, values = read_VISUM('example_data/VISUM_OM.mtx')
+    >>> list(zip(O.tolist(), D.tolist(), values.tolist()))
+    [(1, 1, 0.0), (1, 2, 2.5), (2, 1, 3.0), (2, 2, 0.0)]
+    '''
+
+    with open(file, 'r') as f:
+        fmt, factor, zones, extra = read_VISUM_header(f)
+        fmt = fmt or 'O'
+        if fmt == 'V':
+            nzones = len(zones)
+
+        data = None
+        if fmt[0] != 'V' and not len(extra):
+            #one record per line (usual): parsed by numpy's C reader
+            start = f.tell()
+            try:
+                records = np.loadtxt(f, comments='*', ndmin=2)
+                if records.shape[1] in (0, 3):
+                    data = records.ravel()
+            except ValueError:
+                pass
+            if data is None:
+                f.seek(start)
+        if data is None:
+            data = np.concatenate([extra] + list(numeric_batches(f, batch_bytes)))
+
+    if fmt[0] == 'V':
+        if len(data) != nzones * nzones:
+            raise ValueError('{}: expected {} values for {} zones, found {}.'.format(
+                                file, nzones * nzones, nzones, len(data)))
+        O = np.repeat(zones, nzones)
+        D = np.tile(zones, nzones)
+        values = data
+    else:
+        if len(data) % 3:
+            raise ValueError('{}: records must have 3 values (O D value).'.format(file))
+        O = data[0::3].astype(np.int64)
+        D = data[1::3].astype(np.int64)
+        values = data[2::3]
+
+    if factor != 1:
+        values = values * factor
+    return O, D, values
+
+## Distribution kernels
+
+def pdf_kernel(distrib, *args, log=False, **kwds):
+    '''Returns a function of x with the pdf (or log pdf if log) of distrib,
+    a scipy.stats distribution with parameters args / kwds or a frozen
+    distribution. It calls the distribution kernel (_pdf / _logpdf) on the
+    standardised values: parameters are parsed and checked once here, not
+    on every call. Returns None if the parameters are not valid.'''
+    if isinstance(distrib, stats._distn_infrastructure.rv_frozen):
+        distrib, args, kwds = distrib.dist, distrib.args, distrib.kwds
+    shapes, loc, scale = distrib._parse_args(*args, **kwds)
+    with np.errstate(invalid='ignore'):
+        if not (np.all(scale > 0) and np.all(distrib._argcheck(*shapes))):
+            return None
+    kernel = distrib._logpdf if log else distrib._pdf
+    outside = -np.inf if log else 0.
+    logscale = np.log(scale)
+
+    def evaluate(x):
+        y = (np.asarray(x, dtype=np.float64) - loc) / scale
+        inside = distrib._support_mask(y, *shapes)
+        with np.errstate(all='ignore'):
+            if inside.all():
+                out = kernel(y, *shapes)
+                out = out - logscale if log else out / scale
+            else:
+                out = np.full(y.shape, outside)
+                values = kernel(y[inside], *shapes)
+                out[inside] = values - logscale if log else values / scale
+                out[np.isnan(y)] = np.nan
+        return out
+    return evaluate
+
+def fast_pdf(distrib, x, grid=None):
+    '''Returns the pdf of the frozen distribution distrib at x (any shape),
+    as distrib.pdf(x) but without its per-call overhead (see pdf_kernel).
+        grid - if given, number of points of a regular grid over the range
+               of x: the pdf is evaluated on the grid and interpolated
+               linearly (approximate, for costly pdfs on big arrays)'''
+    kernel = pdf_kernel(distrib)
+    if kernel is None:
+        return distrib.pdf(x)
+    x = np.asarray(x, dtype=np.float64)
+    if grid is None or x.size <= grid:
+        return kernel(x)
+    grid = max(int(grid), 2)
+
+    #values outside the grid (NaN, infinite or out of the support, where the
+    #pdf may jump) are evaluated exactly. Usually there are none
+    lo, hi = x.min(), x.max()
+    a, b = distrib.support()
+    exact = None
+    if not (np.isfinite(lo) and np.isfinite(hi) and a <= lo and hi <= b):
+        with np.errstate(invalid='ignore'):
+            exact = ~(np.isfinite(x) & (x >= a) & (x <= b))
+        if exact.all():
+            return kernel(x)
+        lo, hi = x[~exact].min(), x[~exact].max()
+    if lo == hi:
+        return kernel(x)
+    table = kernel(np.linspace(lo, hi, grid))
+    steps = np.diff(table)
+
+    #regular grid: the cell of each value is computed, not searched, with
+    #in-place operations (one pass over x each)
+    with np.errstate(invalid='ignore'):
+        pos = np.subtract(x, lo)
+        pos *= (grid - 1) / (hi - lo)
+        if exact is not None:
+            pos[exact] = 0
+        cell = pos.astype(np.intp)
+        np.minimum(cell, grid - 2, out=cell)
+        pos -= cell
+        out = table.take(cell)
+        pos *= steps.take(cell)
+        out += pos
+
+    #cells next to a non-finite pdf (e.g. gamma with a < 1 at 0) are exact
+    infinite = ~np.isfinite(table)
+    if infinite.any():
+        near = (infinite[:-1] | infinite[1:]).take(cell)
+        exact = near if exact is None else exact | near
+    if exact is not None and exact.any():
+        out[exact] = kernel(x[exact])
+    return out
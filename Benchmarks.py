@@ -0,0 +1,195 @@
+
+# coding: utf-8
+
+# Benchmarks of the Matrix, TLD and Gravity hot paths on synthetic matrices.
+# Usage: python Benchmarks.py --zones 100 1000 --segments 4
+# Each run is appended to a JSON-lines history, so regressions are visible
+# with compare_history().
+
+import numpy as np
+import pandas as pd
+import scipy.stats as stats
+import argparse
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+
+try:
+    from TPlanning_matrices.Matrix import Matrix
+    from TPlanning_matrices.TLD import TLD
+    from TPlanning_matrices.AuxFunctions import *
+    import TPlanning_matrices.Gravity as Gravity
+except:
+    # For in-folder examples
+    from Matrix import Matrix
+    from TLD import TLD
+    from AuxFunctions import *
+    import Gravity
+
+HISTORY = 'benchmark_history.jsonl'
+
+def write_TBA3(mat, file):
+    '''Writes mat (one column per user class) as a TBA3 file.'''
+    long = mat.copy()
+    long.columns = range(1, len(mat.columns) + 1)
+    long = long.stack().reset_index()
+    long.to_csv(file, sep=' ', header=False, index=False, float_format='%.4f')
+
+def synthetic_TLD(demand, cost, dist_band=5):
+    '''Returns the normalised TLD of each demand column over the cost column
+    in the same position (for fitting distributions).'''
+    tlds = {}
+    for j, col in enumerate(demand.columns):
+        bands = (cost.iloc[:, j].values // dist_band).astype(int)
+        tlds[col] = np.bincount(bands, weights=demand.iloc[:, j].values)
+    n = max(len(t) for t in tlds.values())
+    tld = pd.DataFrame({col: np.pad(t, (0, n - len(t))) for col, t in tlds.items()},
+                       index=(np.arange(n) + 0.5) * dist_band)
+    return TLD(tld).norm
+
+def setup(n, segments, tmpdir, seed=0):
+    '''Returns the inputs of the benchmarks for n zones.'''
+    demand = Matrix(synthetic_demand(n, segments, seed=seed))
+    cost = Matrix(synthetic_cost(n, segments, seed=seed))
+    cost.columns = demand.columns
+
+    emme_demand = demand.copy()
+    emme_demand.columns = list(range(len(demand.columns)))
+    emme_file = os.path.join(tmpdir, 'demand_{}.txt'.format(n))
+    emme_demand.to_EMME(emme_file)
+    tba3_file = os.path.join(tmpdir, 'demand_{}.tba3'.format(n))
+    write_TBA3(demand, tba3_file)
+
+    zones = demand.Os
+    mapping = pd.DataFrame({'zones': zones,
+                            'sectors': [(z - 1) // 10 + 1 for z in zones]})
+    TO = demand.TO * 1.1
+    TD = demand.TD * 1.1
+
+    tld = synthetic_TLD(demand, cost)
+
+    return dict(demand=demand, cost=cost, emme_demand=emme_demand,
+                emme_file=emme_file, tba3_file=tba3_file,
+                mapping=mapping, TO=TO, TD=TD, tld=tld,
+                out_file=os.path.join(tmpdir, 'out_{}.txt'.format(n)))
+
+# name: function of the setup inputs
+BENCHMARKS = {
+    'read_EMME': lambda d: Matrix.read_EMME(d['emme_file']),
+    'read_TBA3': lambda d: Matrix.read_TBA3(d['tba3_file']),
+    'to_EMME': lambda d: d['emme_demand'].to_EMME(d['out_file']),
+    #trip ends are memoised: time the calculation
+    'TO': lambda d: d['demand'].invalidate() or d['demand'].TO,
+    'TD': lambda d: d['demand'].invalidate() or d['demand'].TD,
+    'TEs': lambda d: d['demand'].invalidate() or d['demand'].TEs(),
+    'rezone': lambda d: d['demand'].rezone(d['mapping'], ['zones', 'sectors']),
+    'furness': lambda d: d['demand'].furness(d['TO'], d['TD']),
+    'sectorized': lambda d: d['demand'].sectorized(d['mapping'], 'zones', 'sectors'),
+    'TLD.from_mat': lambda d: TLD.from_mat(d['demand'], d['cost'], dist_band=5),
+    'ApplyGravityModel': lambda d: d['cost'].ApplyGravityModel(
+                            d['TO'], d['TD'], stats.lognorm(0.8, scale=30.)),
+    'fit_distribs': lambda d: Gravity.fit_distribs(d['tld'], ['lognorm', 'gamma']),
+    }
+
+def time_it(func, args, repeat=3):
+    '''Returns the times (seconds) of repeat calls to func(args).'''
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(args)
+        times.append(time.perf_counter() - start)
+    return times
+
+def environment():
+    '''Returns the versions and commit the benchmarks run on.'''
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        commit = None
+    return {'commit': commit,
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+            'machine': platform.node()}
+
+def run_benchmarks(zones=[100, 500], segments=4, repeat=3, benchmarks=None,
+                   history=HISTORY, verbose=True):
+    '''Times each benchmark for each number of zones and returns the results
+    as a dataframe. Results are appended to history (JSON lines) if given.
+    Benchmarks that fail are recorded with their error.'''
+
+    benchmarks = benchmarks or list(BENCHMARKS)
+    env = environment()
+    stamp = pd.Timestamp.now().isoformat()
+    records = []
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for n in zones:
+            inputs = setup(n, segments, tmpdir)
+            for name in benchmarks:
+                record = dict(timestamp=stamp, benchmark=name, zones=n,
+                              segments=segments, repeat=repeat, **env)
+                try:
+                    times = time_it(BENCHMARKS[name], inputs, repeat)
+                    record.update(best=min(times), mean=float(np.mean(times)),
+                                  error=None)
+                except Exception as e:
+                    record.update(best=None, mean=None,
+                                  error='{}: {}'.format(type(e).__name__, e))
+                records.append(record)
+                if verbose:
+                    print('{:>20} {:>6} zones: {}'.format(name, n,
+                          '{:.4f}s'.format(record['best']) if record['error'] is None
+                          else record['error']))
+
+    if history:
+        with open(history, 'a') as f:
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+
+    return pd.DataFrame(records)
+
+def read_history(history=HISTORY):
+    '''Returns the benchmark history as a dataframe.'''
+    with open(history, 'r') as f:
+        return pd.DataFrame([json.loads(line) for line in f if line.strip()])
+
+def compare_history(history=HISTORY, threshold=1.2):
+    '''Compares the last run of each benchmark with the best previous one.
+    Returns a dataframe with ratio = last / previous best; regression is
+    True when ratio > threshold.'''
+    df = read_history(history).dropna(subset=['best'])
+    rows = []
+    for (name, n, segs), runs in df.groupby(['benchmark', 'zones', 'segments']):
+        runs = runs.sort_values('timestamp')
+        last = runs.iloc[-1]
+        previous = runs.iloc[:-1]
+        best_prev = previous['best'].min() if len(previous) else np.nan
+        rows.append({'benchmark': name, 'zones': n, 'segments': segs,
+                     'last': last['best'], 'previous_best': best_prev,
+                     'ratio': last['best'] / best_prev,
+                     'regression': last['best'] / best_prev > threshold})
+    return pd.DataFrame(rows)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks of Matrix hot paths.')
+    parser.add_argument('--zones', type=int, nargs='+', default=[100, 500])
+    parser.add_argument('--segments', type=int, default=4)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--benchmarks', nargs='+', default=None,
+                        choices=list(BENCHMARKS))
+    parser.add_argument('--history', default=HISTORY)
+    parser.add_argument('--compare', action='store_true',
+                        help='compare with previous runs in history')
+    args = parser.parse_args()
+
+    run_benchmarks(args.zones, args.segments, args.repeat, args.benchmarks,
+                   args.history)
+    if args.compare:
+        print(compare_history(args.history).to_string())
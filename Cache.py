@@ -0,0 +1,254 @@
+
+# coding: utf-8
+
+# On-disk cache of parsed matrix files.
+#
+#   import Cache
+#   Cache.enable('~/.cache/tplanning', max_bytes=2 * 2**30)
+#   mat = Matrix.read_EMME('demand.txt')   # parsed and cached
+#   mat = Matrix.read_EMME('demand.txt')   # loaded from the cache
+#   Cache.stats()
+#
+# Entries are addressed by the content of the file (blake2b hash), the
+# reader arguments and the version of the reader code (a hash of the
+# modules next to the reader, so changes to readers or their helpers
+# invalidate old entries), and stored as pickles. The hash of each file is kept
+# with its path, mtime and size, so unchanged files are not read again to
+# check them. There is no shared index: each entry is a file whose size and
+# mtime (last access) are its metadata, and every file is written to a
+# temporary name and renamed, so processes can share the cache folder. The
+# least recently used entries are evicted when the cache exceeds max_bytes.
+# The cache can also be enabled with the TPLANNING_CACHE environment
+# variable (a folder).
+
+import functools
+import glob
+import hashlib
+import json
+import os
+import pickle
+import sys
+import threading
+
+_dir = None
+_max_bytes = 2 ** 30
+_lock = threading.Lock()
+_stats = dict(hits=0, misses=0, hashed_files=0, hashed_bytes=0,
+              stored=0, evicted=0, errors=0)
+
+FILES = 'files'  #subfolder of the file hashes
+VERSION = 1  #format of the cache entries
+_code_versions = {}  #folder: hash of its modules
+
+def enable(path=None, max_bytes=2 ** 30):
+    '''Caches the results of the file readers in path (a folder, created if
+    needed), up to max_bytes.'''
+    global _dir, _max_bytes
+    path = path or os.path.join('~', '.cache', 'TPlanning_matrices')
+    _dir = os.path.abspath(os.path.expanduser(path))
+    _max_bytes = max_bytes
+    os.makedirs(os.path.join(_dir, FILES), exist_ok=True)
+
+def disable():
+    '''Stops caching. Cached entries are kept on disk.'''
+    global _dir
+    _dir = None
+
+def is_enabled():
+    return _dir is not None
+
+if os.environ.get('TPLANNING_CACHE'):
+    enable(os.environ['TPLANNING_CACHE'])
+
+def _write(path, data, mode='wb'):
+    '''Writes data to path through a temporary file, so other processes
+    never see a partial file.'''
+    tmp = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+    with open(tmp, mode) as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+def _hash_file(path):
+    '''Returns the file (in the cache) with the known hash of path.'''
+    name = hashlib.blake2b(path.encode(), digest_size=20).hexdigest()
+    return os.path.join(_dir, FILES, name + '.json')
+
+def file_hash(file, block=2 ** 20):
+    '''Returns the blake2b hash of the content of file.'''
+    h = hashlib.blake2b(digest_size=20)
+    with open(file, 'rb') as f:
+        for chunk in iter(lambda: f.read(block), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def _content_hash(file):
+    '''Returns the hash of file, reusing the known one if the path, mtime
+    and size are unchanged.'''
+    path = os.path.abspath(file)
+    st = os.stat(path)
+    try:
+        with open(_hash_file(path), 'r') as f:
+            known = json.load(f)
+        if known[:3] == [path, st.st_mtime_ns, st.st_size]:
+            return known[3]
+    except (OSError, ValueError, TypeError):
+        pass
+    digest = file_hash(path)
+    with _lock:
+        _stats['hashed_files'] += 1
+        _stats['hashed_bytes'] += st.st_size
+    _write(_hash_file(path), json.dumps([path, st.st_mtime_ns, st.st_size, digest]), 'w')
+    return digest
+
+def code_version(func):
+    '''Returns a hash of the source of the modules in the folder of func
+    (the reader and the helpers it uses), computed once per folder.'''
+    module = sys.modules.get(func.__module__)
+    path = getattr(module, '__file__', None)
+    if path is None:
+        #no source file (e.g. defined interactively): its bytecode
+        return hashlib.blake2b(func.__code__.co_code, digest_size=20).hexdigest()
+    folder = os.path.dirname(os.path.abspath(path))
+    if folder not in _code_versions:
+        h = hashlib.blake2b(digest_size=20)
+        for name in sorted(os.listdir(folder)):
+            if name.endswith('.py'):
+                h.update(name.encode())
+                with open(os.path.join(folder, name), 'rb') as f:
+                    h.update(f.read())
+        _code_versions[folder] = h.hexdigest()
+    return _code_versions[folder]
+
+def _entry_key(op, version, digest, args, kwargs):
+    desc = repr((VERSION, op, version, digest, args, sorted(kwargs.items())))
+    return hashlib.blake2b(desc.encode(), digest_size=20).hexdigest()
+
+def _entry_file(key):
+    return os.path.join(_dir, key + '.pkl')
+
+def _entries():
+    '''Returns [(mtime, size, path)] of the entries in the cache folder.'''
+    entries = []
+    for path in glob.glob(os.path.join(_dir, '*.pkl')):
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue  #removed by another process
+        entries.append((st.st_mtime, st.st_size, path))
+    return entries
+
+def _evict():
+    '''Removes least recently used entries until the cache fits max_bytes,
+    and the known hashes of files that changed or no longer exist.'''
+    entries = _entries()
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= _max_bytes:
+            break
+        try:
+            os.remove(path)
+            with _lock:
+                _stats['evicted'] += 1
+        except OSError:
+            pass
+        total -= size
+    for path in glob.glob(os.path.join(_dir, FILES, '*.json')):
+        try:
+            with open(path, 'r') as f:
+                file, mtime, size, _ = json.load(f)
+            st = os.stat(file)
+            if st.st_mtime_ns == mtime and st.st_size == size:
+                continue
+        except (OSError, ValueError, TypeError):
+            pass
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def cached(func=None, name=None, context=None):
+    '''Decorator of file readers func(file, *args, **kwargs): when the cache
+    is enabled, results are loaded from it if the file content and arguments
+    are unchanged. Each call returns a new object.
+        context - function returning settings that change the result of
+                  func (e.g. the Matrix dtype policy), added to the key'''
+    if func is None:
+        return functools.partial(cached, name=name, context=context)
+    op = name or func.__qualname__
+
+    @functools.wraps(func)
+    def wrapper(file, *args, **kwargs):
+        if _dir is None or not isinstance(file, (str, os.PathLike)):
+            return func(file, *args, **kwargs)
+
+        digest = _content_hash(file)
+        key = _entry_key(op, code_version(func), digest,
+                         args + ((context(),) if context else ()), kwargs)
+        path = _entry_file(key)
+        try:
+            with open(path, 'rb') as f:
+                result = pickle.load(f)
+        except FileNotFoundError:
+            pass
+        except Exception:
+            #unreadable entry: parse again
+            with _lock:
+                _stats['errors'] += 1
+        else:
+            try:
+                os.utime(path)  #last access, for eviction
+            except OSError:
+                pass  #evicted by another process meanwhile
+            with _lock:
+                _stats['hits'] += 1
+            return result
+
+        result = func(file, *args, **kwargs)
+        with _lock:
+            _stats['misses'] += 1
+        try:
+            data = pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            with _lock:
+                _stats['errors'] += 1
+            return result
+        _write(path, data)
+        with _lock:
+            _stats['stored'] += 1
+        _evict()
+        return result
+    return wrapper
+
+def stats():
+    '''Returns the cache statistics: hits, misses, hit_rate, hashed files and
+    bytes, stored and evicted entries, errors, plus entries, bytes and
+    max_bytes on disk (if enabled).'''
+    with _lock:
+        st = dict(_stats)
+    calls = st['hits'] + st['misses']
+    st['hit_rate'] = st['hits'] / calls if calls else None
+    if _dir is not None:
+        entries = _entries()
+        st.update(path=_dir, entries=len(entries),
+                  bytes=sum(size for _, size, _ in entries),
+                  max_bytes=_max_bytes)
+    return st
+
+def reset_stats():
+    '''Sets the statistics counters to zero.'''
+    with _lock:
+        for k in _stats:
+            _stats[k] = 0
+
+def clear():
+    '''Removes all the cached entries, known file hashes and temporary
+    files left by interrupted writes.'''
+    if _dir is None:
+        return
+    for path in glob.glob(os.path.join(_dir, '*.pkl')) + \
+                glob.glob(os.path.join(_dir, '*.tmp')) + \
+                glob.glob(os.path.join(_dir, FILES, '*.json')):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -0,0 +1,380 @@
+
+# coding: utf-8
+
+# Out-of-core processing of matrices that do not fit in memory.
+#
+#   big = ChunkedMatrix('demand.txt', block_size=1000)
+#   TE = big.TEs()
+#   sectors = big.rezone(mapping, ['zones', 'sectors'])
+#   tld = big.TLD(ChunkedMatrix('distance.txt'), dist_band=5)
+#   big.to_EMME('copy.txt')
+#
+# The matrix file is read one block of origins at a time, so memory is
+# bounded by block_size origins (plus the outputs, e.g. trip ends).
+# Sources can be EMME, TBA3 or FormatO text files (sorted by origin) or a
+# binary store of blocks written with to_store().
+
+import numpy as np
+import pandas as pd
+import glob
+import os
+import shutil
+import tempfile
+
+try:
+    from TPlanning_matrices.Matrix import Matrix
+    from TPlanning_matrices.TLD import TLD
+    from TPlanning_matrices.Streaming import OriginBlockReader, aligned_blocks, \
+                                             origin_keys, BATCH_BYTES
+    from TPlanning_matrices.AuxFunctions import *
+    from TPlanning_matrices.Instrumentation import instrumented, note
+except:
+    # For in-folder examples
+    from Matrix import Matrix
+    from TLD import TLD
+    from Streaming import OriginBlockReader, aligned_blocks, origin_keys, BATCH_BYTES
+    from AuxFunctions import *
+    from Instrumentation import instrumented, note
+
+STORE_BLOCK = 'block_{:06d}.npz'
+
+def plain_array(values):
+    '''Returns values as a numpy array that loads without pickle (str
+    labels as a numpy str array).'''
+    values = np.asarray(values)
+    return values.astype(str) if values.dtype == object else values
+
+def write_store_block(file, block):
+    '''Writes a Matrix block to a .npz file (O, D, values, columns).'''
+    np.savez(file,
+             O=plain_array(block.index.get_level_values(0)),
+             D=plain_array(block.index.get_level_values(1)),
+             values=block.values,
+             columns=plain_array(block.columns),
+             names=np.array([str(n) for n in block.index.names]))
+
+def read_store_block(file):
+    '''Returns the Matrix block in a .npz file written by write_store_block.'''
+    with np.load(file, allow_pickle=False) as data:
+        idx = pd.MultiIndex.from_arrays([data['O'], data['D']],
+                                        names=list(data['names']))
+        return Matrix(data['values'], index=idx, columns=list(data['columns']))
+
+class StoreReader:
+    '''Reads a binary store (folder of .npz blocks, see ChunkedMatrix.to_store)
+    with the same interface as Streaming.OriginBlockReader.'''
+
+    def __init__(self, path):
+        self.path = path
+        self.files = iter(sorted(glob.glob(os.path.join(path, 'block_*.npz'))))
+        self.pending = None
+
+    def _read(self):
+        file = next(self.files, None)
+        if file is None:
+            return False
+        block = read_store_block(file)
+        if self.pending is not None and len(self.pending) and len(block):
+            if origin_keys(block.index.get_level_values(0)[:1])[0] <= self._keys()[-1]:
+                raise ValueError('Store blocks must be sorted by origin.')
+            block = pd.concat([self.pending, block])
+        self.pending = Matrix(block)
+        return True
+
+    def _keys(self):
+        '''Origin sort keys of the pending rows (see origin_keys).'''
+        return origin_keys(self.pending.index.get_level_values(0))
+
+    def origins(self, k):
+        '''Returns up to k+1 next distinct origins (sort keys).'''
+        while True:
+            if self.pending is not None:
+                origins = pd.unique(self._keys())
+                if len(origins) > k:
+                    return origins[:k+1]
+            if not self._read():
+                if self.pending is None:
+                    return np.array([])
+                return pd.unique(self._keys())
+
+    def read_until(self, origin):
+        '''Returns a Matrix with the blocks for origins up to origin (included).'''
+        while (self.pending is None or not len(self.pending)
+               or self._keys()[-1] <= origin):
+            if not self._read():
+                break
+        if self.pending is None:
+            return Matrix()
+        n = np.searchsorted(self._keys(), origin, side='right')
+        block = self.pending.iloc[:n]
+        self.pending = self.pending.iloc[n:]
+        return block
+
+    def blocks(self, block_size=500):
+        '''Generator of Matrix blocks with up to block_size origins each.'''
+        for bound, (block,) in aligned_blocks([self], block_size):
+            yield block
+
+class ChunkedMatrix:
+    '''A matrix processed one block of origins at a time.
+        source      - matrix file (EMME, TBA3, FormatO), a binary store
+                      folder (see to_store) or an in-memory Matrix
+        fmt         - file format. None to guess it.
+        block_size  - number of origins in memory at any time
+        names       - index names'''
+
+    def __init__(self, source, fmt=None, block_size=500, names=['O', 'D'],
+                 batch_bytes=BATCH_BYTES):
+        self.source = source
+        self.fmt = fmt
+        self.block_size = block_size
+        self.names = names
+        self.batch_bytes = batch_bytes
+
+    def __repr__(self):
+        return 'ChunkedMatrix({!r}, block_size={})'.format(
+                    self.source if isinstance(self.source, str) else 'Matrix',
+                    self.block_size)
+
+    def reader(self):
+        '''Returns a new block reader of the source.'''
+        if isinstance(self.source, pd.DataFrame):
+            return MatrixReader(self.source)
+        if os.path.isdir(self.source):
+            return StoreReader(self.source)
+        return OriginBlockReader(self.source, fmt=self.fmt, names=self.names,
+                                 batch_bytes=self.batch_bytes)
+
+    def blocks(self):
+        '''Generator of Matrix blocks with up to block_size origins each.'''
+        return self.reader().blocks(self.block_size)
+
+    ## Trip ends
+
+    @instrumented
+    def trip_ends(self):
+        '''Returns (TO, TD, TOTALS) in a single pass over the matrix.'''
+        TOs, TD, blocks = [], None, 0
+        for block in self.blocks():
+            if not len(block):
+                continue
+            TOs.append(block.TO)
+            td = block.TD
+            TD = td if TD is None else TD.add(td, fill_value=0)
+            blocks += 1
+        note(blocks=blocks)
+        if not TOs:
+            return None, None, None
+        TO = Matrix(pd.concat(TOs))
+        TD = Matrix(TD.sort_index())
+        return TO, TD, TO.TOTALS
+
+    @property
+    def TO(self):
+        '''Returns trip-ends for origins.'''
+        return self.trip_ends()[0]
+
+    @property
+    def TD(self):
+        '''Returns trip-ends for destinations.'''
+        return self.trip_ends()[1]
+
+    @property
+    def TE(self):
+        '''Returns trip-ends for both origins and destinations.'''
+        return self.TEs()
+
+    def TEs(self, index_name='zone', names=['TO', 'TD']):
+        '''Returns Trip Ends (see Matrix.TEs), in a single pass.'''
+        TO, TD, _ = self.trip_ends()
+        TE = pd.concat([TO, TD], axis=1)
+        TE.columns = pd.MultiIndex.from_product([names, TO.columns])
+        return TE
+
+    @property
+    def TOTALS(self):
+        '''Returns the matrix totals.'''
+        return self.trip_ends()[2]
+
+    ## Transformations
+
+    @instrumented
+    def rezone(self, mapping, mapping_cols=['old', 'new'], tol=0.001,
+               strict=False, **kwargs):
+        '''Rezones each block (see Matrix.rezone) and returns the sum of the
+        rezoned blocks as a Matrix. The rezoned matrix must fit in memory
+        (e.g. sectors, or a coarser zoning system).
+        Weights are not supported.'''
+        if kwargs.get('weights') is not None:
+            raise ValueError('ChunkedMatrix.rezone does not support weights.')
+
+        rezoned, totals = None, None
+        for block in self.blocks():
+            if not len(block):
+                continue
+            #totals are checked for the whole matrix, not per block
+            with np.errstate(over='ignore'):
+                r = block.rezone(mapping, mapping_cols,
+                                 tol=np.finfo(np.float64).max, **kwargs)
+            rezoned = r if rezoned is None else rezoned.add(r, fill_value=0)
+            t = block.TOTALS
+            totals = t if totals is None else totals + t
+
+        if rezoned is None:
+            return None
+        rezoned = Matrix(rezoned.sort_index())
+
+        if not np.allclose(totals, rezoned.TOTALS, rtol=tol, atol=tol):
+            if strict:
+                raise Warning("Rezoned matrix does not preserve the matrix totals.")
+            else:
+                print("WARNING: rezoned matrix does not preserve the matrix totals.")
+
+        return rezoned
+
+    def map_blocks(self, func, store):
+        '''Applies func to each block (Matrix -> Matrix, keeping the origins)
+        and writes the results to a binary store. Returns a ChunkedMatrix of
+        the store.'''
+        os.makedirs(store, exist_ok=True)
+        for i, block in enumerate(self.blocks()):
+            write_store_block(os.path.join(store, STORE_BLOCK.format(i)), func(block))
+        return ChunkedMatrix(store, block_size=self.block_size)
+
+    @instrumented
+    def TLD(self, dist, dist_band=1, normalized=False):
+        '''Returns the Trip-Length Distribution (see TLD.from_mat), adding
+        up the trips of each distance band block by block.
+        dist is a ChunkedMatrix (read in step with self) or a Matrix.
+        TLD for each column is based on the dist column in the same position,
+        or the last dist column if they have different numbers of columns.'''
+
+        if isinstance(dist, pd.DataFrame):
+            dist = ChunkedMatrix(dist, block_size=self.block_size)
+
+        counts, trips, columns = None, None, None
+        for bound, (block, dblock) in aligned_blocks([self.reader(), dist.reader()],
+                                                     self.block_size):
+            if not len(block):
+                continue
+            if columns is None:
+                columns = list(block.columns)
+                counts = [np.zeros(0, np.int64) for _ in columns]
+                trips = [np.zeros(0) for _ in columns]
+            d = dblock.reindex(block.index)
+            for j in range(len(columns)):
+                dj = j if d.shape[1] == len(columns) else -1
+                bands = np.trunc(d.iloc[:, dj].values / dist_band)
+                vals = block.iloc[:, j].values.astype(np.float64)
+                valid = ~np.isnan(bands)
+                bands = bands[valid].astype(np.int64)
+                vals = np.nan_to_num(vals[valid])
+                if len(bands) and bands.min() < 0:
+                    raise ValueError('Negative distances are not supported.')
+                n = max(len(trips[j]), bands.max() + 1 if len(bands) else 0)
+                trips[j] = np.pad(trips[j], (0, n - len(trips[j]))) + \
+                           np.bincount(bands, weights=vals, minlength=n)
+                counts[j] = np.pad(counts[j], (0, n - len(counts[j]))) + \
+                            np.bincount(bands, minlength=n)
+
+        if columns is None:
+            return None
+
+        tlds = []
+        for col, c, t in zip(columns, counts, trips):
+            #bands with trips or OD pairs, top end of each band, plus zero
+            used = np.flatnonzero(c)
+            s = pd.Series(t[used], index=(used + 1) * dist_band, name=col)
+            s.loc[0] = 0
+            tlds.append(s.sort_index())
+        tld = TLD(pd.concat(tlds, axis=1).fillna(0))
+
+        if normalized:
+            tld = tld.norm
+
+        return tld
+
+    ## Output
+
+    @instrumented
+    def to_EMME(self, OutputName, file_header='', mat_number_start=100,
+                mat_comment='', default_val=0, decimals=4, compact=False,
+                values_per_line=10, skip_default=False):
+        '''Writes each column as stacked EMME matrices (see Matrix.to_EMME),
+        one block at a time. Each column is written to a temporary file,
+        which are then joined. Matrix numbers are sequential with column
+        order, starting with mat_number_start.'''
+        tmpdir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(OutputName)))
+        try:
+            files, columns = [], None
+            for block in self.blocks():
+                if not len(block):
+                    continue
+                if columns is None:
+                    columns = list(block.columns)
+                    files = [open(os.path.join(tmpdir, '{}.txt'.format(j)), 'w')
+                             for j in range(len(columns))]
+                O = block.index.get_level_values(0).values
+                D = block.index.get_level_values(1).values
+                for j, f in enumerate(files):
+                    #Missing values won't be written
+                    f.write(EMME_records(O, D, block.iloc[:, j].values,
+                                         decimals=decimals, compact=compact,
+                                         values_per_line=values_per_line,
+                                         skip_value=default_val if skip_default else None))
+            for f in files:
+                f.close()
+
+            with open(OutputName, 'w') as OutputFile:
+                if file_header:
+                    OutputFile.write(file_header)
+                for j, col in enumerate(columns or []):
+                    mat_name = '{}'.format(col)
+                    CheckEMMEmatName(mat_name)
+                    mat_number = 'mf{0:02d}'.format(mat_number_start + j)
+                    CheckEMMEmatNumber(mat_number)
+                    mat_cmnt = '{}: {}'.format(col, mat_comment)
+                    OutputFile.write("\nd matrix={}".format(mat_number))
+                    OutputFile.write("\na matrix={} {} {} '{}'".format(
+                                        mat_number, mat_name, default_val, mat_cmnt))
+                    with open(files[j].name, 'r') as f:
+                        shutil.copyfileobj(f, OutputFile)
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    @instrumented
+    def to_store(self, path):
+        '''Writes the matrix to a binary store: a folder with one .npz file
+        per block of origins. Stores are faster to read than text files.
+        Returns a ChunkedMatrix of the store.'''
+        return self.map_blocks(lambda block: block, path)
+
+class MatrixReader:
+    '''Block reader of an in-memory Matrix (e.g. a distance matrix that fits
+    in memory), with the same interface as Streaming.OriginBlockReader.'''
+
+    def __init__(self, mat):
+        #by origin sort key (numeric order of str EMME zones)
+        O = origin_keys(mat.index.get_level_values(0))
+        order = np.argsort(O, kind='stable')
+        self.mat, O = mat.iloc[order], O[order]
+        starts = np.r_[0, np.flatnonzero(O[1:] != O[:-1]) + 1] if len(O) else np.array([], int)
+        self.all_origins = O[starts]
+        self.starts = np.r_[starts, len(O)]
+        self.next = 0  #position of the next origin in all_origins
+
+    def origins(self, k):
+        '''Returns up to k+1 next distinct origins (sort keys).'''
+        return self.all_origins[self.next:self.next + k + 1]
+
+    def read_until(self, origin):
+        '''Returns the rows for origins up to origin (included).'''
+        end = max(self.next, np.searchsorted(self.all_origins, origin, side='right'))
+        block = self.mat.iloc[self.starts[self.next]:self.starts[end]]
+        self.next = end
+        return block
+
+    def blocks(self, block_size=500):
+        '''Generator of Matrix blocks with up to block_size origins each.'''
+        for bound, (block,) in aligned_blocks([self], block_size):
+            yield block
@@ -8,6 +8,8 @@ import pandas as pd
 from scipy import stats
 from scipy import optimize
 import matplotlib.pyplot as plt
+import hashlib
+import json
 #import warnings
 
 
@@ -16,6 +18,8 @@ import matplotlib.pyplot as plt
 from Matrix import Matrix
 from TLD import *
 from AuxFunctions import *
+from Instrumentation import instrumented, note
+from Parallel import get_executor
 
 
 # In[3]:
@@ -85,7 +89,7 @@ class Tanner(stats.rv_continuous):
     #TODO: Review. It would be ideal if Tanner could use built in fit method,
     #      but this implementation works similarly. Wath ydata.index.values 
     def fit(self, ydata, p0=[0.15,-0.9], *args, **kwargs):
-        return optimize.curve_fit(self._pdf, ydata.index.values, ydata, *args, **kwargs)[0]
+        return optimize.curve_fit(self._pdf, ydata.index.values, ydata, p0, *args, **kwargs)[0]
 
 
 # In[11]:
@@ -112,40 +116,128 @@ np.array([-3.39581168,  6.73004206])
 # In[12]:
 
 #src: http://stackoverflow.com/questions/6620471/fitting-empirical-distribution-to-theoretical-ones-with-scipy-python
-def fit_distribs(TLD, distrib_names, *args, **kwargs):
+@instrumented
+def fit_distribs(TLD, distrib_names, *args, cache=None, **kwargs):
     '''Returns a dictionary of distributions fitted for each column in TLD.
-    Drops NaN values.'''
+    Drops NaN values.
+    cache - FitCache: unchanged columns are not fitted again, changed ones
+            start from their previous parameters.'''
     
     if isinstance(distrib_names, str):
-        distrib_names = list(distrib_names)
+        distrib_names = [distrib_names]
     elif not isinstance(distrib_names, list):
         raise ValueError("distrib_names must be a distirbution name or a list.")
     
     distribs = {}
     for col in TLD:
-        distribs[col] = [getattr(stats, fn)(
-                            *getattr(stats, fn).fit(TLD[col].dropna(), *args, **kwargs))
-                         for fn in distrib_names]
+        data = TLD[col].dropna()
+        distribs[col] = []
+        for fn in distrib_names:
+            distrib = getattr(stats, fn)
+            if cache is None:
+                params = distrib.fit(data, *args, **kwargs)
+            else:
+                params = cache.fitted(fn, col, data,
+                            lambda x0: warm_fit(distrib, data, x0, *args, **kwargs),
+                            options=(args, kwargs))
+            distribs[col].append(distrib(*params))
+    if cache is not None:
+        cache.save()
     return distribs
 
+def warm_fit(distrib, data, x0=None, *args, **kwargs):
+    '''distrib.fit(data), starting from parameters x0 if given (e.g. a
+    previous fit) instead of the default starting values.'''
+    if x0 is None:
+        return distrib.fit(data, *args, **kwargs)
+    if isinstance(distrib, Tanner):
+        #curve_fit: x0 as initial guess
+        return distrib.fit(data, p0=list(x0), **kwargs)
+    start = dict(loc=x0[-2], scale=x0[-1])
+    start.update(kwargs)
+    return distrib.fit(data, *x0[:-2], **start)
+
+class FitCache:
+    '''Parameters of previous fits by (distribution, column), with a hash of
+    the data they were fitted to. Fits of unchanged data are returned
+    without fitting; changed data is fitted starting from the previous
+    parameters. If path is given, fits are kept in that file (JSON) between
+    runs.
+        cache = FitCache('fits.json')
+        fit_distribs(TLD, ['lognorm', 'gamma'], cache=cache)'''
+
+    def __init__(self, path=None):
+        self.path = path
+        self.fits = {}
+        self.stats = dict(unchanged=0, warm=0, cold=0)
+        if path and os.path.exists(path):
+            with open(path, 'r') as f:
+                self.fits = json.load(f)
+
+    def __repr__(self):
+        return 'FitCache({} fits, {})'.format(len(self.fits), self.stats)
+
+    @staticmethod
+    def data_hash(data, options=None):
+        '''Hash of data (values and index) and fit options.'''
+        h = hashlib.blake2b(digest_size=16)
+        h.update(pd.util.hash_pandas_object(pd.Series(data), index=True).values.tobytes())
+        h.update(repr(options).encode())
+        return h.hexdigest()
+
+    def fitted(self, distrib_name, col, data, fit, method='fit', options=None):
+        '''Returns the parameters of distrib_name for column col: the stored
+        ones if data and options are unchanged, otherwise fit(x0), where x0
+        are the previous parameters (None if there are none).'''
+        key = repr((distrib_name, col, method))
+        digest = FitCache.data_hash(data, options)
+        known = self.fits.get(key)
+        if known is not None and known['hash'] == digest:
+            self.stats['unchanged'] += 1
+            return tuple(known['params'])
+
+        x0 = tuple(known['params']) if known is not None else None
+        self.stats['cold' if x0 is None else 'warm'] += 1
+        params = tuple(float(p) for p in fit(x0))
+        self.fits[key] = {'hash': digest, 'params': params}
+        return params
+
+    def save(self):
+        '''Writes the fits to path (if any).'''
+        if not self.path:
+            return
+        tmp = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(self.fits, f)
+        os.replace(tmp, self.path)
+
+    def clear(self):
+        self.fits = {}
+
 
 # In[13]:
 
+@instrumented
 def fit_distribs_to_df(distrib_dict: dict, xdata: pd.Series) -> pd.DataFrame:
     '''Returns a dataframe with all the distributions in distrib_dict applied to xdata.'''
-    df = pd.DataFrame.from_dict(
-    {(k, d.dist.name): d.pdf(xdata) for k,dlst in distrib_dict.items() for d in dlst})
-    df.index = xdata
-    return df
+    keys = [(k, d.dist.name) for k, dlst in distrib_dict.items() for d in dlst]
+    x = np.asarray(xdata, dtype=np.float64)
+    values = np.empty((len(x), len(keys)))
+    for j, d in enumerate(d for dlst in distrib_dict.values() for d in dlst):
+        values[:, j] = fast_pdf(d, x)
+    return pd.DataFrame(values, index=xdata,
+                        columns=pd.MultiIndex.from_tuples(keys) if keys else None)
 
 
 # In[14]:
 
+@instrumented
 def append_distribs_to_df(TLD, distrib_names, level=0, include_ydata=True,
-                          *args, **kwargs):
+                          *args, cache=None, **kwargs):
     '''Returns TLD expanded with distrib_names fitted for each column.
-    xdata is taken from TLD index level as specified by level.'''
-    TLDdistribs = fit_distribs(TLD, distrib_names)
+    xdata is taken from TLD index level as specified by level.
+    cache - FitCache for the fits (see fit_distribs)'''
+    TLDdistribs = fit_distribs(TLD, distrib_names, cache=cache)
     df = fit_distribs_to_df(TLDdistribs, TLD.index.get_level_values(level))
     if include_ydata:
         for col in TLD:
@@ -171,3 +263,205 @@ def lognorm_mu_sigma(params):
     shape, loc, scale = params
     mu, sigma = np.log(scale), shape
     return mu, sigma
+
+
+# In[14]:
+
+def _unpack(theta, floc):
+    '''Distribution parameters (shapes, loc, scale) from the optimised ones
+    (shapes, scale if loc is fixed to floc).'''
+    theta = tuple(theta)
+    return theta if floc is None else theta[:-1] + (floc,) + theta[-1:]
+
+def weighted_nnlf(distrib, params, x, w):
+    '''Negative log-likelihood of values x with weights w (e.g. the distance
+    bands of a TLD and their trips) for distrib with params.'''
+    logpdf = pdf_kernel(distrib, *params, log=True)
+    if logpdf is None:
+        return np.inf
+    with np.errstate(all='ignore'):
+        ll = np.dot(w, logpdf(x))
+    return -ll if np.isfinite(ll) else np.inf
+
+def binned_nnlf(distrib, params, upper, band, w):
+    '''Negative log-likelihood of trips w in the distance bands
+    (upper - band, upper] (e.g. a TLD) for distrib with params: each band
+    has the probability F(upper) - F(upper - band). Upper tail bands use
+    the survival function, so they keep their precision.'''
+    if pdf_kernel(distrib, *params) is None:
+        return np.inf
+    lower = upper - band
+    with np.errstate(all='ignore'):
+        median = distrib.median(*params)
+        p = np.where(lower < median,
+                     distrib.cdf(upper, *params) - distrib.cdf(lower, *params),
+                     distrib.sf(lower, *params) - distrib.sf(upper, *params))
+        ll = np.dot(w, np.log(p))
+    return -ll if np.isfinite(ll) else np.inf
+
+def band_width(x):
+    '''Length of the distance bands of a TLD index x (top end of each
+    band): the smallest increment, as TLD.mid_band estimates it.'''
+    steps = np.diff(np.unique(np.asarray(x, dtype=np.float64)))
+    steps = steps[steps > 0]
+    if not len(steps):
+        raise ValueError('Cannot estimate the band length of a single band.')
+    return steps.min()
+
+def fit_weighted(distrib, x, w, x0=None, floc=0, band=None):
+    '''Returns the parameters (shapes, loc, scale) of distrib (a scipy.stats
+    distribution or its name) fitted to values x with weights w by maximum
+    likelihood (e.g. TLD bands weighted by trips).
+        x0   - starting parameters (e.g. a previous fit). Default: fit to a
+               sample drawn from the weights (at the band midpoints)
+        floc - fixed loc (None to fit it too)
+        band - None if x are the values themselves. Otherwise, x are the
+               top ends of distance bands of length band (as in a TLD), and
+               the trips of each band are fitted to its probability (binned
+               likelihood), so the fit does not depend on the band length
+    Tanner has no likelihood (its pdf is not normalized): its parameters
+    (alpha, beta) are fitted to the trip density, as Tanner.fit, and floc
+    does not apply.'''
+    distrib = getattr(stats, distrib) if isinstance(distrib, str) else distrib
+    x = np.asarray(x, dtype=np.float64)
+    w = np.asarray(w, dtype=np.float64)
+    keep = (w > 0) & np.isfinite(x)
+    x, w = x[keep], w[keep]
+
+    if isinstance(distrib, Tanner):
+        mid = x if band is None else x - band / 2
+        density = pd.Series(w / w.sum() / (band or 1), index=mid)
+        return tuple(distrib.fit(density) if x0 is None else
+                     distrib.fit(density, p0=list(x0)))
+
+    if x0 is None:
+        mid = x if band is None else x - band / 2
+        sample = np.repeat(mid, np.round(w / w.sum() * 1000).astype(np.int64))
+        x0 = distrib.fit(sample) if floc is None else distrib.fit(sample, floc=floc)
+    x0 = tuple(x0) if floc is None else tuple(x0[:-2]) + tuple(x0[-1:])
+
+    if band is None:
+        nnlf = lambda theta: weighted_nnlf(distrib, _unpack(theta, floc), x, w)
+    else:
+        nnlf = lambda theta: binned_nnlf(distrib, _unpack(theta, floc), x, band, w)
+    res = optimize.minimize(nnlf, x0, method='Nelder-Mead')
+    return _unpack(res.x, floc)
+
+@instrumented
+def fit_distribs_to_TLD(TLD, distrib_names, floc=0, cache=None, band=0):
+    '''Returns a dictionary of distributions fitted to the trips by distance
+    band of each column in TLD (see fit_weighted), as fit_distribs.
+    cache - FitCache for the fits (see fit_distribs)
+    band  - length of the TLD bands. 0 to estimate it (see band_width)'''
+    if isinstance(distrib_names, str):
+        distrib_names = [distrib_names]
+    x = TLD.index.get_level_values(0).values
+    band = band or band_width(x)
+    distribs = {}
+    for col in TLD:
+        w = TLD[col].fillna(0)
+        distribs[col] = []
+        for fn in distrib_names:
+            fit = lambda x0: fit_weighted(fn, x, w, x0=x0, floc=floc, band=band)
+            if cache is None:
+                params = fit(None)
+            else:
+                params = cache.fitted(fn, col, w, fit, method='binned',
+                                      options=(floc, band))
+            distribs[col].append(getattr(stats, fn)(*params))
+    if cache is not None:
+        cache.save()
+    return distribs
+
+
+# In[15]:
+
+def _fit_replicates(distrib_name, x, weights, x0, floc, band):
+    '''Fits each row of weights, starting from the previous fit (picklable,
+    for process pools).'''
+    params = np.empty((len(weights), len(x0)))
+    for r, w in enumerate(weights):
+        x0 = fit_weighted(distrib_name, x, w, x0=x0, floc=floc, band=band)
+        params[r] = x0
+    return params
+
+@instrumented
+def bootstrap_fit(TLD, distrib_name, replicates=1000, n=None, floc=0, seed=None,
+                  executor='process', workers=None, band=0):
+    '''Returns the bootstrap distribution of the parameters of distrib_name
+    fitted to each TLD column (see fit_weighted), and of the implied average
+    trip length (mean of the fitted distribution).
+    The trips of the TLD bands are resampled (multinomial), with the weights
+    of all the replicates drawn at once. Replicates are fitted in chunks,
+    each fit starting from the previous one.
+        n        - size of each resample. Default: the trips of each column,
+                   which is right only if each trip is an observation. For
+                   TLDs of expanded survey trips it understates the
+                   intervals: use the number of survey records
+        band     - length of the TLD bands. 0 to estimate it (see band_width)
+        executor - None (serial), 'thread', 'process' or an Executor, to fit
+                   the chunks of replicates in parallel
+    Returns a dataframe indexed by (column, replicate), with a column per
+    parameter (alpha, beta for tanner), plus 'mean' (and 'mu', 'sigma' for
+    lognorm). Replicate -1 is the fit to the TLD itself. Use bootstrap_ci
+    for confidence intervals.'''
+
+    distrib = getattr(stats, distrib_name)
+    names = distrib.shapes.split(', ') if distrib.shapes else []
+    if not isinstance(distrib, Tanner):
+        names += ['loc', 'scale']
+    rng = np.random.default_rng(seed)
+    x = TLD.index.get_level_values(0).values.astype(np.float64)
+    band = band or band_width(x)
+
+    pool, owned = (None, False) if executor is None else get_executor(executor, workers)
+    nchunks = 1 if pool is None else (workers or os.cpu_count())
+    try:
+        jobs = {}
+        for col in TLD:
+            w = TLD[col].fillna(0).values.astype(np.float64)
+            keep = (w > 0) & np.isfinite(x)
+            xk, wk = x[keep], w[keep]
+            fit = fit_weighted(distrib, xk, wk, floc=floc, band=band)
+            size = int(round(wk.sum())) if n is None else n
+            weights = rng.multinomial(size, wk / wk.sum(), size=replicates)
+            chunks = [c for c in np.array_split(weights, nchunks) if len(c)]
+            if pool is None:
+                parts = [_fit_replicates(distrib_name, xk, c, fit, floc, band)
+                         for c in chunks]
+            else:
+                parts = [pool.submit(_fit_replicates, distrib_name, xk, c, fit, floc, band)
+                         for c in chunks]
+            jobs[col] = (xk, fit, parts)
+
+        frames = []
+        for col, (xk, fit, parts) in jobs.items():
+            parts = [p if pool is None else p.result() for p in parts]
+            params = np.vstack([np.array([fit])] + parts)
+            df = pd.DataFrame(params, columns=names,
+                              index=pd.Index(np.arange(-1, len(params) - 1), name='replicate'))
+            if isinstance(distrib, Tanner):
+                #pdf not normalized: mean over the TLD bands
+                mid = xk - band / 2
+                f = distrib._pdf(mid, params[:, :1], params[:, 1:])
+                df['mean'] = (f * mid).sum(axis=1) / f.sum(axis=1)
+            else:
+                df['mean'] = distrib.mean(*params.T)
+            if distrib_name == 'lognorm':
+                df['mu'], df['sigma'] = lognorm_mu_sigma(params.T)
+            frames.append(df)
+    finally:
+        if owned:
+            pool.shutdown()
+
+    return pd.concat(frames, keys=list(TLD.columns))
+
+def bootstrap_ci(replicates, ci=0.95):
+    '''Returns the fit, the bootstrap standard error and the confidence
+    interval of each parameter in replicates (see bootstrap_fit).'''
+    level = list(range(replicates.index.nlevels - 1))
+    fit = replicates.xs(-1, level=-1)
+    boot = replicates[replicates.index.get_level_values(-1) >= 0].groupby(level=level)
+    return pd.concat({'fit': fit, 'std': boot.std(),
+                      'lower': boot.quantile((1 - ci) / 2),
+                      'upper': boot.quantile((1 + ci) / 2)}, axis=1)
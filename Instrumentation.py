@@ -0,0 +1,164 @@
+
+# coding: utf-8
+
+# Opt-in instrumentation of Matrix, TLD and Gravity operations.
+#
+#   import Instrumentation
+#   Instrumentation.enable(trace='trace.jsonl', memory=True)
+#   ... run the model ...
+#   Instrumentation.summary()
+#
+# When disabled (default), instrumented functions just check a flag.
+
+import pandas as pd
+import functools
+import json
+import threading
+import time
+import tracemalloc
+
+class _State(threading.local):
+    '''Stack of the active records (per thread).'''
+    def __init__(self):
+        self.stack = []
+
+_enabled = False
+_memory = False
+_trace = None
+_records = []
+_lock = threading.Lock()
+_local = _State()
+
+def enable(trace=None, memory=False):
+    '''Starts recording instrumented operations.
+        trace  - JSON-lines file records are appended to (optional)
+        memory - record peak memory (with tracemalloc, which is slow)'''
+    global _enabled, _memory, _trace
+    disable()
+    _enabled = True
+    _memory = memory
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    if trace:
+        _trace = open(trace, 'a')
+
+def disable():
+    '''Stops recording. Records are kept until reset().'''
+    global _enabled, _memory, _trace
+    _enabled = False
+    if _memory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    _memory = False
+    if _trace is not None:
+        _trace.close()
+        _trace = None
+
+def is_enabled():
+    return _enabled
+
+def reset():
+    '''Removes all the records.'''
+    with _lock:
+        del _records[:]
+
+def _shape(obj):
+    shape = getattr(obj, 'shape', None)
+    return list(shape) if isinstance(shape, tuple) else None
+
+class record:
+    '''Context manager that records an operation: wall time, peak memory
+    (if enabled with memory=True), input shape and any counters added with
+    note(). Records nest: each one keeps its parent operation.'''
+
+    def __init__(self, op, shape=None, **counters):
+        self.op = op
+        self.data = dict(op=op, shape=shape, **counters)
+
+    def __enter__(self):
+        if not _enabled:
+            return self
+        stack = _local.stack
+        self.data['parent'] = stack[-1].op if stack else None
+        self.data['depth'] = len(stack)
+        if _memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if stack:
+                stack[-1]._peak = max(stack[-1]._peak, peak)
+            tracemalloc.reset_peak()
+            self._start_memory = current
+            self._peak = 0
+        stack.append(self)
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if not _enabled or not _local.stack or _local.stack[-1] is not self:
+            return False
+        self.data['seconds'] = time.perf_counter() - self._start
+        _local.stack.pop()
+        if _memory and tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            self.data['peak_memory'] = max(self._peak, peak) - self._start_memory
+            if _local.stack:
+                _local.stack[-1]._peak = max(_local.stack[-1]._peak, peak)
+        if exc[0] is not None:
+            self.data['error'] = exc[0].__name__
+        self.data['time'] = time.time()
+        with _lock:
+            _records.append(self.data)
+            if _trace is not None:
+                _trace.write(json.dumps(self.data, default=str) + '\n')
+                _trace.flush()
+        return False
+
+def note(**counters):
+    '''Adds counters (e.g. iterations=10, residual=0.1) to the operation
+    being recorded. Does nothing if instrumentation is disabled.'''
+    if _enabled and _local.stack:
+        _local.stack[-1].data.update(counters)
+
+def instrumented(func=None, name=None):
+    '''Decorator that records each call to func (see record).
+    The input shape is taken from the first argument with a shape (e.g. self),
+    the output shape from the result.'''
+    if func is None:
+        return functools.partial(instrumented, name=name)
+    op = name or func.__qualname__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _enabled:
+            return func(*args, **kwargs)
+        shape = next((_shape(a) for a in args if _shape(a) is not None), None)
+        with record(op, shape=shape):
+            result = func(*args, **kwargs)
+            note(output_shape=_shape(result))
+        return result
+    return wrapper
+
+def report():
+    '''Returns a dataframe with all the records.'''
+    with _lock:
+        return pd.DataFrame(list(_records))
+
+def summary():
+    '''Returns a dataframe with calls, total / mean / max seconds (and max
+    peak memory) by operation, slowest first.'''
+    df = report()
+    if df.empty:
+        return df
+    agg = {'seconds': ['count', 'sum', 'mean', 'max']}
+    if 'peak_memory' in df:
+        agg['peak_memory'] = ['max']
+    if 'iterations' in df:
+        agg['iterations'] = ['sum', 'max']
+    summ = df.groupby('op').agg(agg)
+    summ.columns = ['calls', 'seconds', 'mean_seconds', 'max_seconds'] + \
+                   [('max_' if f == 'max' else 'total_') + c
+                    for c, fs in list(agg.items())[1:] for f in fs]
+    return summ.sort_values('seconds', ascending=False)
+
+def read_trace(trace):
+    '''Returns the records in a JSON-lines trace as a dataframe.'''
+    with open(trace, 'r') as f:
+        return pd.DataFrame([json.loads(line) for line in f if line.strip()])
@@ -0,0 +1,254 @@
+
+# coding: utf-8
+
+# Lazy evaluation of chained Matrix operations:
+#
+#   mat.lazy().complete(z).rezone(mapping, ['zones', 'sectors']).TEs()
+#
+# Operations are recorded in a plan, which is optimised when computed:
+#  - submatrix filters are pushed before complete and simple rezones,
+#  - consecutive simple rezones are composed into a single mapping,
+#  - a simple rezone followed by sectorized runs as one aggregation,
+#  - simple rezones work on the index codes, without copying the matrix.
+# A rezone is simple if it has no split columns, no weights and each old
+# zone maps to one new zone. Other rezones run as Matrix.rezone.
+
+import numpy as np
+import pandas as pd
+
+try:
+    from TPlanning_matrices.Matrix import Matrix, ZoneSystem
+except:
+    # For in-folder examples
+    from Matrix import Matrix, ZoneSystem
+
+class LazyMatrix:
+    '''A Matrix and a plan of operations on it, executed by compute().
+    Trip-end and total properties compute the plan first.'''
+
+    def __init__(self, source, plan=()):
+        self.source = source
+        self.plan = tuple(plan)
+
+    def _then(self, op, **args):
+        return LazyMatrix(self.source, self.plan + ((op, args),))
+
+    def __repr__(self):
+        return 'LazyMatrix({} rows x {} columns)\n{}'.format(
+                    self.source.shape[0], self.source.shape[1], self.explain())
+
+    ## Operations (same arguments as the Matrix methods)
+
+    def complete(self, zones, names=['O', 'D'], fill_value=0):
+        if isinstance(zones, list):
+            zones = ZoneSystem(zones, names=names)
+        return self._then('complete', zoning=ZoneSystem.of(zones),
+                          fill_value=fill_value)
+
+    def submatrix(self, zoning):
+        return self._then('submatrix', zoning=ZoneSystem.of(zoning))
+
+    def rezone(self, mapping, mapping_cols=['old', 'new'], **kwargs):
+        return self._then('rezone', mapping=mapping, mapping_cols=mapping_cols,
+                          kwargs=kwargs)
+
+    def sectorized(self, sectoring, zcol, scol):
+        return self._then('sectorized', sectoring=sectoring, zcol=zcol, scol=scol)
+
+    ## Terminal operations
+
+    @property
+    def TO(self):
+        return self.compute().TO
+
+    @property
+    def TD(self):
+        return self.compute().TD
+
+    @property
+    def TE(self):
+        return self.compute().TE
+
+    def TEs(self, *args, **kwargs):
+        return self.compute().TEs(*args, **kwargs)
+
+    @property
+    def TOTALS(self):
+        return self.compute().TOTALS
+
+    ## Plan
+
+    def optimized_plan(self):
+        '''Returns the plan after the optimisations.'''
+        plan = [(op, dict(args)) for op, args in self.plan]
+        changed = True
+        while changed:
+            changed = False
+            for i in range(len(plan) - 1):
+                (op1, a1), (op2, a2) = plan[i], plan[i + 1]
+
+                if op1 == 'complete' and op2 == 'submatrix':
+                    #(M | Z1) & Z2 == (M & Z2) | (Z1 & Z2)
+                    plan[i:i+2] = [('submatrix', a2),
+                                   ('complete', dict(a1, zoning=a1['zoning'].intersection(a2['zoning'])))]
+                    changed = True
+                    break
+
+                if op1 == 'rezone' and op2 == 'submatrix' and simple_rezone(a1) \
+                   and not a1.get('prefiltered'):
+                    #only keep the old OD pairs that end up in the submatrix
+                    #(if the mapping covers all the zones, see prefilter)
+                    plan[i:i+2] = [('prefilter', dict(mapping=a1['mapping'],
+                                                      mapping_cols=a1['mapping_cols'],
+                                                      zoning=a2['zoning'])),
+                                   ('rezone', dict(a1, prefiltered=True)),
+                                   ('submatrix', a2)]
+                    changed = True
+                    break
+
+                if op1 == 'rezone' and op2 == 'rezone' \
+                   and simple_rezone(a1) and simple_rezone(a2):
+                    plan[i:i+2] = [('rezone', compose_rezones(a1, a2))]
+                    changed = True
+                    break
+
+                if op1 == 'rezone' and op2 == 'sectorized' and simple_rezone(a1):
+                    plan[i:i+2] = [('rezone_sectorized', dict(rezone=a1, sectorized=a2))]
+                    changed = True
+                    break
+        return plan
+
+    def explain(self):
+        '''Returns the optimised plan as text.'''
+        lines = ['source']
+        for op, args in self.optimized_plan():
+            lines.append('  -> {}'.format(op))
+        return '\n'.join(lines)
+
+    def compute(self):
+        '''Executes the optimised plan and returns a Matrix.'''
+        mat = self.source
+        copied = False
+        for op, args in self.optimized_plan():
+            if op == 'complete':
+                mat = mat.complete(args['zoning'], fill_value=args['fill_value'])
+            elif op == 'submatrix':
+                mat = mat.submatrix(args['zoning'])
+            elif op == 'prefilter':
+                mat = prefilter(mat, args['mapping'], args['mapping_cols'],
+                                args['zoning'])
+            elif op == 'rezone':
+                if simple_rezone(args):
+                    mat = rezone_codes(mat, args['mapping'], args['mapping_cols'],
+                                       index_names=args.get('index_names'),
+                                       **args['kwargs'])
+                else:
+                    mat = mat.rezone(args['mapping'], args['mapping_cols'],
+                                     **args['kwargs'])
+            elif op == 'sectorized':
+                mat = mat.sectorized(args['sectoring'], args['zcol'], args['scol'])
+            elif op == 'rezone_sectorized':
+                r, s = args['rezone'], args['sectorized']
+                mat = rezone_codes(mat, r['mapping'], r['mapping_cols'],
+                                   index_names=r.get('index_names'),
+                                   sectoring=(s['sectoring'], s['zcol'], s['scol']),
+                                   **r['kwargs'])
+            copied = True
+        return mat if copied else mat.copy()
+
+def simple_rezone(args):
+    '''True if a rezone can run on the index codes (see module notes).'''
+    kwargs = args['kwargs']
+    old = args['mapping_cols'][0]
+    return (not kwargs.get('mapping_split_cols')
+            and kwargs.get('weights') is None
+            and not args['mapping'][old].duplicated().any())
+
+def compose_rezones(a1, a2):
+    '''Returns a single simple rezone equivalent to a1 followed by a2.'''
+    old1, new1 = a1['mapping_cols']
+    old2, new2 = a2['mapping_cols']
+    m1 = a1['mapping'][[old1, new1]]
+    m2 = a2['mapping'][[old2, new2]]
+    pos = pd.Index(m2[old2]).get_indexer(m1[new1])
+    mapping = pd.DataFrame({'old': m1[old1].values[pos >= 0],
+                            'new': m2[new2].values[pos[pos >= 0]]})
+    kwargs = dict(a1['kwargs'])
+    kwargs.update(a2['kwargs'])
+    names1 = a1.get('index_names')
+    return dict(mapping=mapping, mapping_cols=['old', 'new'], kwargs=kwargs,
+                index_names=('names', names1, new1, new2))
+
+def rezoned_names(names, index_names, new):
+    '''Index names after a rezone (as Matrix.rezone names them).'''
+    if index_names is None:
+        return ['{}_{}'.format(new, n) for n in names]
+    _, inner, new1, new2 = index_names
+    return rezoned_names(rezoned_names(names, inner, new1), None, new2)
+
+def mapped_codes(index, level, mapping, mapping_cols):
+    '''Returns the new zone of each row of index (level) and a mask of the
+    rows with a mapped zone. Zones are looked up once per level value.'''
+    old, new = mapping_cols
+    pos = pd.Index(mapping[old]).get_indexer(index.levels[level])
+    codes = np.asarray(index.codes[level])
+    rowpos = np.where(codes < 0, -1, pos[codes])
+    found = rowpos >= 0
+    return mapping[new].values[np.where(found, rowpos, 0)], found
+
+def prefilter(mat, mapping, mapping_cols, zoning):
+    '''Returns the rows of mat whose rezoned OD pair is in zoning. If the
+    mapping misses zones of mat, returns mat: the rezone that follows then
+    checks its totals (and strict) against the whole matrix, as eagerly.'''
+    Onew, Ofound = mapped_codes(mat.index, 0, mapping, mapping_cols)
+    Dnew, Dfound = mapped_codes(mat.index, 1, mapping, mapping_cols)
+    if not (Ofound.all() and Dfound.all()):
+        return mat
+    opos = zoning.origins.get_indexer(Onew)
+    dpos = zoning.destinations.get_indexer(Dnew)
+    keep = Ofound & Dfound & (opos >= 0) & (dpos >= 0)
+    codes = opos * len(zoning.destinations) + dpos
+    keep[keep] &= zoning.full_mask()[codes[keep]]
+    return mat.iloc[np.flatnonzero(keep)]
+
+def rezone_codes(mat, mapping, mapping_cols=['old', 'new'], index_names=None,
+                 sectoring=None, tol=0.001, strict=False, min_val=None,
+                 calculate_proportions=None, mapping_split_cols=None, weights=None):
+    '''Simple rezone (see module notes) on the index codes: only the mapped
+    rows are gathered, then summed by new OD pair. If sectoring is given as
+    (sectoring, zcol, scol), returns the rezoned matrix sectorized.'''
+    Onew, Ofound = mapped_codes(mat.index, 0, mapping, mapping_cols)
+    Dnew, Dfound = mapped_codes(mat.index, 1, mapping, mapping_cols)
+    keep = np.flatnonzero(Ofound & Dfound)
+    rows = mat.iloc[keep].reset_index(drop=True)
+    rezoned = rows.groupby([Onew[keep], Dnew[keep]]).sum()
+    rezoned.index.names = rezoned_names(mat.index.names, index_names, mapping_cols[1])
+    rezoned = mat._cast_like(Matrix(rezoned))
+
+    if not np.allclose(mat.TOTALS, rezoned.TOTALS, rtol=tol, atol=tol):
+        if strict:
+            raise Warning("Rezoned matrix does not preserve the matrix totals.")
+        else:
+            print("WARNING: rezoned matrix does not preserve the matrix totals.")
+
+    if sectoring is None:
+        return rezoned
+
+    sectoring, zcol, scol = sectoring
+    smap = sectoring.drop_duplicates(zcol)
+    So, Sofound = mapped_codes(rezoned.index, 0, smap, [zcol, scol])
+    Sd, Sdfound = mapped_codes(rezoned.index, 1, smap, [zcol, scol])
+    Scodes = pd.MultiIndex.from_arrays([So, Sd]).factorize()[0]
+    Scodes[~(Sofound & Sdfound)] = -1
+    sectorized = rezoned.copy()
+    valid = Scodes >= 0
+    for j in range(len(rezoned.columns)):
+        vals = rezoned.iloc[:, j].values.astype(np.float64)
+        totals = np.bincount(Scodes[valid], weights=vals[valid])
+        col = np.full(len(vals), np.nan)
+        col[valid] = totals[Scodes[valid]]
+        dtype = rezoned.iloc[:, j].dtype
+        if valid.all() and np.issubdtype(dtype, np.integer):
+            col = col.astype(dtype)
+        sectorized.isetitem(j, col)
+    return rezoned._cast_like(sectorized)
@@ -7,13 +7,268 @@ import matplotlib.pyplot as plt
 from scipy import stats
 import re
 import os
-from itertools import chain
+from collections import OrderedDict
+import hashlib
+import weakref
+import functools
 
 try:
     from TPlanning_matrices.AuxFunctions import *
+    from TPlanning_matrices.Instrumentation import instrumented, note
+    from TPlanning_matrices.Parallel import map_columns, concat_columns
+    from TPlanning_matrices.Cache import cached
 except:
     # For in-folder examples
     from AuxFunctions import *
+    from Instrumentation import instrumented, note
+    from Parallel import map_columns, concat_columns
+    from Cache import cached
+
+class ZoneSystem:
+    '''Origin and destination zones of a zoning system.
+    OD pairs are identified by positional codes (i * len(destinations) + j),
+    so set operations are boolean masks over integer codes. The MultiIndex
+    is only built when needed, and then kept.
+        origins, destinations - zones (no duplicates)
+        mask  - boolean array over all OD codes. None for all OD combinations.
+        names - index names
+    Use ZoneSystem.of(index) to get the (shared) zone system of a MultiIndex.'''
+
+    # Shared zone systems: {content key: ZoneSystem} and {id(index): (ref, key)}
+    _cache = OrderedDict()
+    _cache_size = 32
+    _by_index = {}
+
+    def __init__(self, origins, destinations=None, mask=None, names=['O', 'D']):
+        if destinations is None:
+            destinations = origins
+        self.origins = pd.Index(origins)
+        self.destinations = pd.Index(destinations)
+        if self.origins.has_duplicates or self.destinations.has_duplicates:
+            raise ValueError('There are duplicated zones')
+        if mask is not None:
+            mask = np.asarray(mask, dtype=bool).ravel()
+            if len(mask) != len(self.origins) * len(self.destinations):
+                raise ValueError('mask must have one value for each OD pair.')
+            if mask.all():
+                mask = None
+        self.mask = mask
+        self.names = list(names)
+        self._codes = None
+        self._index = None
+        self._positions = None
+
+    def __repr__(self):
+        return 'ZoneSystem({} origins x {} destinations, {} OD pairs)'.format(
+                    len(self.origins), len(self.destinations), len(self))
+
+    def __len__(self):
+        if self.mask is None:
+            return len(self.origins) * len(self.destinations)
+        return int(self.mask.sum())
+
+    @property
+    def shape(self):
+        return len(self.origins), len(self.destinations)
+
+    @property
+    def is_product(self):
+        '''True if all the OD combinations are included.'''
+        return self.mask is None
+
+    @property
+    def codes(self):
+        '''Positional codes of the OD pairs.'''
+        if self._codes is None:
+            if self.mask is None:
+                self._codes = np.arange(len(self), dtype=np.int64)
+            else:
+                self._codes = np.flatnonzero(self.mask)
+        return self._codes
+
+    @property
+    def index(self):
+        '''MultiIndex of the OD pairs, built from the codes (no tuples).'''
+        if self._index is None:
+            nD = len(self.destinations)
+            self._index = pd.MultiIndex(levels=[self.origins, self.destinations],
+                                        codes=[self.codes // nD, self.codes % nD],
+                                        names=self.names,
+                                        verify_integrity=False)
+            ZoneSystem._register(self._index, self)
+        return self._index
+
+    def full_mask(self):
+        '''Returns the mask over all OD codes (even for product zonings).'''
+        if self.mask is None:
+            return np.ones(len(self.origins) * len(self.destinations), dtype=bool)
+        return self.mask
+
+    def positions(self, index):
+        '''Returns the positional codes of the OD pairs in index (MultiIndex),
+        -1 for those not in this zone system. Levels are looked up once,
+        rows only through the index codes. Kept for the last index.'''
+        if self._positions is not None and self._positions[0]() is index:
+            return self._positions[1]
+        pos = self._positions_of(index)
+        self._positions = (weakref.ref(index), pos)
+        return pos
+
+    def _positions_of(self, index):
+        opos = self.origins.get_indexer(index.levels[0])
+        dpos = self.destinations.get_indexer(index.levels[1])
+        ocodes = np.asarray(index.codes[0])
+        dcodes = np.asarray(index.codes[1])
+        opos = np.where(ocodes < 0, -1, opos[ocodes]).astype(np.int64)
+        dpos = np.where(dcodes < 0, -1, dpos[dcodes]).astype(np.int64)
+        pos = opos * len(self.destinations) + dpos
+        pos[(opos < 0) | (dpos < 0)] = -1
+        if self.mask is not None:
+            inside = pos >= 0
+            pos[inside & ~self.mask[np.where(inside, pos, 0)]] = -1
+        return pos
+
+    def _zone_mask(self, origins, destinations, how):
+        '''OD mask for origins and/or destinations in the specified zones.'''
+        oin = self.origins.isin(origins)
+        din = self.destinations.isin(destinations)
+        return how.outer(oin, din).ravel()
+
+    def restrict(self, zones=None, origins=None, destinations=None):
+        '''Returns the zone system restricted to the OD pairs with the origin
+        OR the destination in the specified zones.'''
+        origins = zones if origins is None else origins
+        destinations = zones if destinations is None else destinations
+        mask = self._zone_mask(origins, destinations, np.logical_or)
+        return ZoneSystem(self.origins, self.destinations,
+                          mask & self.full_mask(), self.names)
+
+    def remove(self, zones):
+        '''Returns the zone system without the OD pairs between the specified
+        zones (both origin AND destination in zones).'''
+        mask = ~self._zone_mask(zones, zones, np.logical_and)
+        return ZoneSystem(self.origins, self.destinations,
+                          mask & self.full_mask(), self.names)
+
+    def _mask_of(self, other):
+        '''Returns a mask with the OD pairs of other in this zone system.'''
+        mask = np.zeros(len(self.origins) * len(self.destinations), dtype=bool)
+        opos = self.origins.get_indexer(other.origins)
+        dpos = self.destinations.get_indexer(other.destinations)
+        if other.mask is None:
+            #all combinations: no need to go through the codes
+            mask2d = mask.reshape(self.shape)
+            mask2d[np.ix_(opos[opos >= 0], dpos[dpos >= 0])] = True
+            return mask
+        codes = other.codes
+        nD = len(other.destinations)
+        o = opos[codes // nD]
+        d = dpos[codes % nD]
+        inside = (o >= 0) & (d >= 0)
+        mask[o[inside] * len(self.destinations) + d[inside]] = True
+        return mask
+
+    def covers(self, other):
+        '''True if all the OD pairs of other are in this zone system.'''
+        if self.equals(other):
+            return True
+        return (self._mask_of(other) & self.full_mask()).sum() == len(other)
+
+    def union(self, other):
+        '''Returns a zone system with the OD pairs in self or other.'''
+        if self.equals(other):
+            return self
+        zs = ZoneSystem(self.origins.union(other.origins),
+                        self.destinations.union(other.destinations),
+                        names=self.names)
+        return ZoneSystem(zs.origins, zs.destinations,
+                          zs._mask_of(self) | zs._mask_of(other), self.names)
+
+    def intersection(self, other):
+        '''Returns a zone system with the OD pairs in both self and other.'''
+        if self.equals(other):
+            return self
+        return ZoneSystem(self.origins, self.destinations,
+                          self.full_mask() & self._mask_of(other), self.names)
+
+    def difference(self, other):
+        '''Returns a zone system with the OD pairs in self but not in other.'''
+        return ZoneSystem(self.origins, self.destinations,
+                          self.full_mask() & ~self._mask_of(other), self.names)
+
+    def same_zones(self, other):
+        '''True if both zone systems have the same zone lists, so they share
+        the positional codes.'''
+        return (self.origins.equals(other.origins)
+                and self.destinations.equals(other.destinations))
+
+    def rows(self, positions):
+        '''Returns the row number (in self.index) of each positional code.'''
+        if self.mask is None:
+            return positions
+        return (np.cumsum(self.mask) - 1)[positions]
+
+    def equals(self, other):
+        '''True if both zone systems have the same zones and OD pairs.'''
+        if self is other:
+            return True
+        return (self.same_zones(other)
+                and ((self.mask is None and other.mask is None)
+                     or np.array_equal(self.full_mask(), other.full_mask())))
+
+    @staticmethod
+    def _key(index):
+        '''Content key of a MultiIndex: hash of its levels and codes.'''
+        h = hashlib.blake2b(digest_size=16)
+        for lvl, codes in zip(index.levels, index.codes):
+            h.update(pd.util.hash_array(np.asarray(lvl)).tobytes())
+            h.update(np.asarray(codes).tobytes())
+        h.update(repr(list(index.names)).encode())
+        return h.hexdigest()
+
+    @staticmethod
+    def _register(index, zs, key=None):
+        '''Remembers zs as the zone system of index.'''
+        idx_id = id(index)
+        ZoneSystem._by_index[idx_id] = (weakref.ref(index,
+                lambda ref: ZoneSystem._by_index.pop(idx_id, None)), zs)
+        if key is not None:
+            ZoneSystem._cache[key] = zs
+            ZoneSystem._cache.move_to_end(key)
+            while len(ZoneSystem._cache) > ZoneSystem._cache_size:
+                ZoneSystem._cache.popitem(last=False)
+
+    @staticmethod
+    def of(index):
+        '''Returns the zone system of a MultiIndex (e.g. a Matrix index).
+        Zone systems are cached, so matrices on the same zoning share it.'''
+        if isinstance(index, ZoneSystem):
+            return index
+        if not isinstance(index, pd.MultiIndex) or index.nlevels != 2:
+            raise ValueError('Zone systems need a MultiIndex with 2 levels: [O, D]')
+
+        cached = ZoneSystem._by_index.get(id(index))
+        if cached is not None and cached[0]() is index:
+            return cached[1]
+
+        key = ZoneSystem._key(index)
+        zs = ZoneSystem._cache.get(key)
+        if zs is None:
+            ocodes = np.asarray(index.codes[0])
+            dcodes = np.asarray(index.codes[1])
+            used_o = np.bincount(ocodes[ocodes >= 0], minlength=len(index.levels[0]))
+            used_d = np.bincount(dcodes[dcodes >= 0], minlength=len(index.levels[1]))
+            origins = index.levels[0][used_o > 0]
+            destinations = index.levels[1][used_d > 0]
+            zs = ZoneSystem(origins, destinations, names=index.names)
+            pos = zs.positions(index)
+            mask = np.zeros(len(zs.origins) * len(zs.destinations), dtype=bool)
+            mask[pos[pos >= 0]] = True
+            if mask.sum() != len(index):
+                raise ValueError('There are duplicated OD pairs')
+            zs = ZoneSystem(zs.origins, zs.destinations, mask, index.names)
+        ZoneSystem._register(index, zs, key)
+        return zs
 
 def Zoning(zones: list, names=['O', 'D']) -> pd.MultiIndex:
     '''Returns a MultiIndex object with zones for origins and destinations.
@@ -22,108 +277,259 @@ def Zoning(zones: list, names=['O', 'D']) -> pd.MultiIndex:
     are returned. origs and dests are list of zones.'''
     
     if all(isinstance(elem, list) for elem in zones):
-        ODs = zones
-        if not any(duplicates_in_list for lst in zones):
-            raise ValueError('There are duplicated zones')
+        origs, dests = zones
     
     elif isinstance(zones,list):
-        ODs = [zones for name in names]
-        if duplicates_in_list(zones):
-            raise ValueError('There are duplicated zones')
+        origs = dests = zones
     
     else:
         raise ValueError('"zones" must be a list or a list of lists')
     
-    idx = pd.MultiIndex.from_product(ODs, names=names)
-    
-    if idx.names != names:
-        raise ValueError('Zoning could not be created from {}.'.format(zones) + 
-                         '\n"zones" must be a list or a list of lists')
-    
-    return idx
+    return ZoneSystem(origs, dests, names=names).index
 
 def RemoveFromZoning(zoning, rem):
     '''Returns zoning without the zones specified. 'rem' can be a list of zones
     or a zoning system.'''
 
+    zs = ZoneSystem.of(zoning)
     if isinstance(rem, list):
-        rem = Zoning(rem)
-    return zoning.difference(rem)
+        return zs.remove(rem).index
+    return zs.difference(ZoneSystem.of(rem)).index
 
 def RestricZoning(zoning, restrict):
     '''Returns a zoning system restricted to the zones specified (Origin OR
     destination in the specified zones). This is usefull to keep all the
     int-int, int-ext, ext-int trips from a matrix.'''
 
-    allzones = set(chain(*zoning.values))
+    zs = ZoneSystem.of(zoning)
     if isinstance(restrict, list):
-        Os = restrict
-        Ds = restrict
-    else:
-        Os = set(list(zip(*restrict.values))[0])
-        Ds = set(list(zip(*restrict.values))[1])
+        return zs.restrict(restrict).index
+    restrict = ZoneSystem.of(restrict)
+    return zs.restrict(origins=restrict.origins,
+                       destinations=restrict.destinations).index
 
-    return zoning[(zoning.isin(Os, level=0)) | (zoning.isin(Ds, level=1))]
-
-    ##Alternative approach
-    #II = Zoning([Os, Os]) #Int-Int
-    #IE = Zoning([Os, Ds]) #Int-Ext
-    #EI = Zoning([Ds, Os]) #Ext-Int
+def _dtype_policy():
+    '''Matrix dtype policy (readers apply it, so it is part of cache keys).'''
+    return str(Matrix.value_dtype)
 
 class Matrix(pd.DataFrame):
     '''A Matrix in Transport Planning is a pandas DataFrame,
     with Origins and Destinations as MultiIndex levels: [O, D]'''
 
+    # dtype policy:
+    #  value_dtype  - dtype for matrix values (e.g. np.float32 for demand).
+    #                 None keeps the pandas defaults.
+    #  totals_dtype - dtype to accumulate totals and trip ends in
+    #                 (e.g. np.float64). None for the matrix dtype.
+    # Readers cast values to value_dtype. Operations (arithmetic, rezone, furness,
+    # gravity) keep the float dtype of the input matrix.
+    value_dtype = None
+    totals_dtype = None
+
     @property
     def _constructor(self):
         '''Matrix operations return Matrix objects.'''
         return Matrix
 
+    @staticmethod
+    def set_dtype(dtype=None, totals_dtype=None):
+        '''Sets the dtype policy for all matrices (see Matrix.value_dtype).'''
+        Matrix.value_dtype = None if dtype is None else np.dtype(dtype)
+        Matrix.totals_dtype = None if totals_dtype is None else np.dtype(totals_dtype)
+
+    @property
+    def float_dtype(self):
+        '''Returns the dtype of the matrix values if all columns are floats
+        of the same dtype, the dtype policy otherwise.'''
+        dtypes = set(self.dtypes) if len(self.columns) else set()
+        if len(dtypes) == 1:
+            dtype = dtypes.pop()
+            if np.issubdtype(dtype, np.floating):
+                return dtype
+        return Matrix.value_dtype
+
+    def with_dtype(self, dtype=None):
+        '''Returns the matrix with numeric columns as dtype
+        (default: the dtype policy). Same matrix if there is nothing to change.'''
+        dtype = dtype or Matrix.value_dtype
+        if dtype is None:
+            return self
+        dtype = np.dtype(dtype)
+        numeric = [np.issubdtype(dt, np.number) for dt in self.dtypes]
+        if all(dt == dtype for dt, num in zip(self.dtypes, numeric) if num):
+            return self
+        if all(numeric):
+            return self.astype(dtype)
+        mat = self.copy()
+        for j, num in enumerate(numeric):
+            if num:
+                mat.isetitem(j, mat.iloc[:, j].astype(dtype))
+        return mat
+
+    def _cast_like(self, mat):
+        '''Returns mat with the float dtype of self (see float_dtype).'''
+        dtype = self.float_dtype
+        if dtype is None:
+            return mat
+        return Matrix(mat).with_dtype(dtype)
+
+    def _policy_operand(self, other):
+        '''Arithmetic keeps the float dtype of the matrix: float operands of
+        a different dtype are cast to it before operating.'''
+        dtype = self.float_dtype
+        if dtype is None or dtype == np.float64:
+            return other
+        if isinstance(other, (pd.DataFrame, pd.Series)):
+            if any(np.issubdtype(dt, np.floating) and dt != dtype
+                   for dt in np.atleast_1d(other.dtypes)):
+                other = other.astype(dtype)
+        elif isinstance(other, np.ndarray) and np.issubdtype(other.dtype, np.floating):
+            other = other.astype(dtype, copy=False)
+        return other
+
+    def _arith_method(self, other, op):
+        return super()._arith_method(self._policy_operand(other), op)
+
+    def _flex_arith_method(self, other, op, *args, **kwargs):
+        return super()._flex_arith_method(self._policy_operand(other), op,
+                                          *args, **kwargs)
+
+    def _sum_by_level(self, level):
+        '''Sums the matrix rows by index level.
+        Float columns are accumulated in Matrix.totals_dtype, if set.'''
+        dtype = Matrix.totals_dtype
+        if (dtype is None or not len(self.columns)
+            or not all(np.issubdtype(dt, np.floating) for dt in self.dtypes)):
+            return self.groupby(level=level).sum()
+
+        codes, zones = pd.factorize(self.index.get_level_values(level), sort=True)
+        sums = np.empty((len(zones), len(self.columns)), dtype=dtype)
+        for j in range(len(self.columns)):
+            vals = self.iloc[:, j].values
+            vals = np.where(np.isnan(vals), 0, vals)
+            sums[:, j] = np.bincount(codes, weights=vals, minlength=len(zones))
+        zones = pd.Index(zones, name=self.index.names[level])
+        return Matrix(sums, index=zones, columns=self.columns)
+
+    # Segments: the columns of a matrix are its segments (e.g. purpose,
+    # period, user class), and the column level names are the segment
+    # dimensions. broadcast operates with NumPy over rows and segments,
+    # matching the segments of the operand by label or by named levels.
+
+    @property
+    def segment_dims(self):
+        '''Names of the column levels (segment dimensions).'''
+        return list(self.columns.names)
+
+    def broadcast(self, other, op=np.multiply, level=None, by=None):
+        '''Returns op(self, other) broadcast over the rows and segments
+        (columns) of the matrix, without aligning whole frames:
+            other - scalar
+                  - segment factors: dict or Series by column label, or by
+                    the values of the column levels in by
+                  - trip-end vectors (zones x segments DataFrame, or a
+                    Series for all segments) applied to the origin (level=0)
+                    or destination (level=1) zone of each row
+                  - a matrix (level=None), matched by OD pair
+            op    - NumPy binary function (np.multiply, np.divide, ...)
+        Segments of a DataFrame operand are matched by column label, by the
+        named column levels it has (e.g. factors by 'period' for purpose x
+        period columns), or broadcast if it has a single column. Missing
+        zones / OD pairs give NaN.
+            mat.broadcast({'AM': 1.1, 'PM': 0.9}, by='period')
+            mat.broadcast(TO / mat.TO, level='O')'''
+
+        values = self.to_numpy()
+        if np.isscalar(other):
+            operand = other
+        elif isinstance(other, dict) or (isinstance(other, pd.Series) and level is None):
+            operand = segment_factors(self.columns, other, by)[np.newaxis, :]
+        else:
+            other = pd.DataFrame(other)
+            if level is None:
+                rows = other.index.get_indexer(self.index)
+            else:
+                if level in self.index.names:
+                    level = self.index.names.index(level)
+                zones = other.index.get_indexer(self.index.levels[level])
+                codes = np.asarray(self.index.codes[level])
+                rows = np.where(codes >= 0, zones[codes], -1)
+            operand = other.to_numpy()[:, segment_positions(self.columns, other.columns)]
+            if (rows < 0).any():
+                operand = np.where((rows >= 0)[:, np.newaxis],
+                                   operand[rows], np.nan)
+            else:
+                operand = operand[rows]
+
+        mat = Matrix(op(values, operand), index=self.index, columns=self.columns)
+        return self._cast_like(mat)
+
+    # Derived quantities (TO, TD, TE, TOTALS, Os, Ds, intrazonals) are
+    # computed once and kept while the matrix is unchanged. The memo keeps a
+    # shallow copy of the data, so any write in place (loc, iloc, setitem,
+    # inplace methods) copies the written blocks (copy-on-write), which
+    # changes the state and discards the memo. Writes to .values arrays
+    # bypass this: call invalidate() after them.
+
+    def _data_state(self):
+        return (id(self._mgr), tuple(id(b.values) for b in self._mgr.blocks),
+                id(self.index), id(self.columns), str(Matrix.totals_dtype))
+
+    def _memo(self, name, compute):
+        '''Returns the derived quantity name, computed with compute() only
+        if the matrix changed since it was last computed.'''
+        memo = self.__dict__.get('_derived')
+        state = self._data_state()
+        if memo is None or memo['state'] != state:
+            memo = {'state': state, 'data': self.copy(deep=False), 'values': {}}
+            object.__setattr__(self, '_derived', memo)
+        if name not in memo['values']:
+            memo['values'][name] = compute()
+        value = memo['values'][name]
+        #callers get their own (shallow) copy
+        return list(value) if isinstance(value, list) else value.copy(deep=False)
+
+    def invalidate(self):
+        '''Discards the memoised derived quantities (TO, TD, TOTALS...).'''
+        self.__dict__.pop('_derived', None)
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.invalidate()
+
+    def _update_inplace(self, result, **kwargs):
+        super()._update_inplace(result, **kwargs)
+        self.invalidate()
+
     @property
     def Os(self):
         '''Returns origin names without duplicates.'''
-        return list(self.index.get_level_values(0).unique())
+        return self._memo('Os', lambda: list(self.index.get_level_values(0).unique()))
 
     @property
     def Ds(self):
         '''Returns destination names without duplicates.'''
-        return list(self.index.get_level_values(1).unique())
+        return self._memo('Ds', lambda: list(self.index.get_level_values(1).unique()))
 
     @property
     def TO(self):
         '''Returns trip-ends for origins.'''
-        
-        if isinstance(self.columns, pd.MultiIndex):
-            col_lvl_names = self.columns.names
-            mat = self.copy().flat_cols
-        else:
-            mat = self.copy()
-        
-        te = mat.groupby(level=0).sum()
-        
-        if isinstance(self.columns, pd.MultiIndex):
-                split_cols(te)
-                te.columns.names = col_lvl_names
-                
-        return te
+        return self._memo('TO', self._TO)
+
+    @instrumented(name='Matrix.TO')
+    def _TO(self):
+        #column labels (e.g. MultiIndex) are kept as they are
+        return self._sum_by_level(0)
 
     @property
     def TD(self):
         '''Returns trip-ends for destinations.'''
-        
-        if isinstance(self.columns, pd.MultiIndex):
-            col_lvl_names = self.columns.names
-            mat = self.copy().flat_cols
-        else:
-            mat = self.copy()
-        
-        te = mat.groupby(level=1).sum()
-        
-        if isinstance(self.columns, pd.MultiIndex):
-                split_cols(te)
-                te.columns.names = col_lvl_names
-                
-        return te
+        return self._memo('TD', self._TD)
+
+    @instrumented(name='Matrix.TD')
+    def _TD(self):
+        #column labels (e.g. MultiIndex) are kept as they are
+        return self._sum_by_level(1)
 
     @property
     def TE(self):
@@ -131,8 +537,9 @@ class Matrix(pd.DataFrame):
         # this is just a wrapper of TEs function.
         # This allows accesing it as a property,
         # which is consistent with TO and TD usage.
-        return self.TEs()
+        return self._memo('TE', self.TEs)
 
+    @instrumented
     def TEs(self, index_name='zone', names=['TO', 'TD']):
         '''Returns Trip Ends: both trip origins and trip destinations
         in a single DataFrame. Allows customization of index and column names.'''
@@ -148,8 +555,18 @@ class Matrix(pd.DataFrame):
 
     @property
     def TOTALS(self):
-        '''Returns the matrix totals.'''
-        return self.sum()
+        '''Returns the matrix totals.
+        Accumulated in Matrix.totals_dtype, if set.'''
+        return self._memo('TOTALS', self._TOTALS)
+
+    @instrumented(name='Matrix.TOTALS')
+    def _TOTALS(self):
+        dtype = Matrix.totals_dtype
+        if (dtype is None or not len(self.columns)
+            or not all(np.issubdtype(dt, np.floating) for dt in self.dtypes)):
+            return self.sum()
+        return pd.Series(np.nansum(self.values, axis=0, dtype=dtype),
+                         index=self.columns)
 
     def TransposeOD(self, sort=True):
         '''Transposes a matrix in ODT format: swaps Origins and Destinations.'''
@@ -173,6 +590,92 @@ class Matrix(pd.DataFrame):
     def proportions(self):
         return self.apply(lambda x: x/sum(x), axis=1).fillna(0)
 
+    @instrumented
+    def split(self, proportions, by=None):
+        '''Splits each column (segment) of the matrix into new segments by
+        proportions, in one broadcast. Returns a matrix with columns
+        (column, new segment), e.g. (purpose, period).
+            proportions - shares of the new segments (its columns):
+                            by=None      - dict or Series by new segment
+                            by='O' / 'D' - DataFrame by origin / destination
+                                           zone (also index level name or
+                                           number)
+                            by='OD'      - Matrix by OD pair (cell level)
+                          Columns can be MultiIndex (column of self, new
+                          segment) for different shares by column.
+        Shares are normalised to add up to 1, so they can be absolute values
+        (e.g. a segmented matrix). Rows without shares (missing or zero) use
+        the shares of the whole table, so the totals are always preserved.
+        merge_segments is the inverse.'''
+
+        if by is None:
+            proportions = pd.DataFrame([pd.Series(proportions)])
+            rows = np.zeros(len(self), dtype=np.intp)
+        else:
+            proportions = pd.DataFrame(proportions)
+            if by == 'OD':
+                rows = proportions.index.get_indexer(self.index)
+            else:
+                if by in self.index.names:
+                    level = self.index.names.index(by)
+                else:
+                    level = {'O': 0, 'D': 1}.get(by, by)
+                zones = proportions.index.get_indexer(self.index.levels[level])
+                codes = np.asarray(self.index.codes[level])
+                rows = np.where(codes >= 0, zones[codes], -1)
+
+        # shares table: proportion rows x columns of self x new segments
+        cols = proportions.columns
+        values = np.nan_to_num(proportions.to_numpy(dtype=np.float64))
+        per_column = cols.nlevels > 1 and self.columns.is_unique and \
+                     (self.columns.get_indexer(cols.droplevel(-1)) >= 0).all()
+        if per_column:
+            new = cols.get_level_values(-1).unique()
+            table = np.zeros((len(proportions), len(self.columns), len(new)))
+            table[:, self.columns.get_indexer(cols.droplevel(-1)),
+                  new.get_indexer(cols.get_level_values(-1))] = values
+        else:
+            new = cols
+            table = np.repeat(values[:, np.newaxis, :], len(self.columns), axis=1)
+
+        total = table.sum(axis=2, keepdims=True)
+        overall = table.sum(axis=0)
+        overall_total = overall.sum(axis=1, keepdims=True)
+        overall = np.where(overall_total > 0,
+                           overall / np.where(overall_total > 0, overall_total, 1),
+                           1 / len(new))
+        shares = np.where(total > 0, table / np.where(total > 0, total, 1), overall)
+        shares = np.where((rows >= 0)[:, np.newaxis, np.newaxis],
+                          shares[rows], overall)
+
+        mat = self.to_numpy(dtype=self.float_dtype or np.float64)
+        mat = (mat[:, :, np.newaxis] * shares).reshape(len(self), -1)
+
+        as_tuple = lambda c: c if isinstance(c, tuple) else (c,)
+        columns = pd.MultiIndex.from_tuples(
+                        [as_tuple(c) + as_tuple(n) for c in self.columns for n in new],
+                        names=list(self.columns.names) + list(new.names))
+        return self._cast_like(Matrix(mat, index=self.index, columns=columns))
+
+    def merge_segments(self, dims=-1):
+        '''Adds up the columns (segments) over the column levels in dims
+        (names or numbers, default: the last level). Inverse of split.'''
+        cols = self.columns
+        dims = dims if isinstance(dims, list) else [dims]
+        dims = [cols.names.index(d) if d in cols.names else d % cols.nlevels
+                for d in dims]
+        if len(set(dims)) >= cols.nlevels:
+            raise ValueError('Cannot merge all the column levels.')
+
+        codes, segments = pd.factorize(cols.droplevel(dims))
+        indicator = np.zeros((len(cols), len(segments)), dtype=np.int8)
+        indicator[np.arange(len(cols)), codes] = 1
+        values = self.to_numpy()
+        if np.issubdtype(values.dtype, np.floating):
+            values = np.where(np.isnan(values), 0, values)
+        mat = Matrix(values @ indicator, index=self.index, columns=segments)
+        return self._cast_like(mat)
+
     @property
     def matrix(self):
         '''Returns matrix as a tradicional 2D matrix.'''
@@ -183,6 +686,20 @@ class Matrix(pd.DataFrame):
     def from_panel(panel):
         ...
 
+    def lazy(self):
+        '''Returns a LazyMatrix: operations are recorded in a plan, which is
+        optimised and executed by compute() (see Lazy module).'''
+        try:
+            from TPlanning_matrices.Lazy import LazyMatrix
+        except:
+            from Lazy import LazyMatrix
+        return LazyMatrix(self)
+
+    @property
+    def zones(self):
+        '''Returns the (shared) zone system of the matrix.'''
+        return ZoneSystem.of(self.index)
+
     @property
     def flat_cols(self):
         return flatten_cols(self, inplace=False)
@@ -191,27 +708,68 @@ class Matrix(pd.DataFrame):
     def unflat(self):
         return split_cols(self, inplace=False)
 
+    @instrumented
     def complete(self, zones, names=['O', 'D'], fill_value=0):
-        '''Completes the matrix index with specified zones. Ignores existing zones.'''
-        if isinstance(zones, pd.MultiIndex):
+        '''Completes the matrix index with specified zones. Ignores existing zones.
+        Values are scattered by position into the united zone system.'''
+        if isinstance(zones, (pd.MultiIndex, ZoneSystem)):
             #zones is a zoning system already (MultiIndex)
-            zoning = zones
+            zoning = ZoneSystem.of(zones)
         elif isinstance(zones, list):
             #zones is just a list that needs to be expanded
-            zoning = Zoning(zones, names=names)
+            zoning = ZoneSystem(zones, names=names)
         else:
             raise ValueError('"zones" must be list of zones or zoning system (MultiIndex)')
-        zoning_union = self.index.union(zoning)
-        return self.reindex(index=zoning_union, fill_value=fill_value)
 
-    def submatrix(self, zoning: pd.MultiIndex):
-        '''Returns a submatrix with the origins and destinations specified in zoning'''
-        zoning_intersect = self.index.intersection(zoning)
-        return self.reindex(zoning_intersect)
+        zs = self.zones
+        if zs.covers(zoning):
+            #zoning is already in the matrix
+            return self.copy()
+        zoning_union = zs.union(zoning)
 
+        if zoning_union.same_zones(zs):
+            #same zone lists: the matrix codes are valid in zoning_union
+            pos = zs.positions(self.index)
+        else:
+            pos = zoning_union.positions(self.index)
+        rows = zoning_union.rows(pos)
+        return self._scatter(zoning_union.index, rows, fill_value)
+
+    def _scatter(self, index, rows, fill_value=0):
+        '''Returns a matrix with index, with self values in rows positions
+        and fill_value elsewhere.'''
+        arrays = []
+        for j in range(len(self.columns)):
+            col = self.iloc[:, j].values
+            dtype = np.result_type(col.dtype, fill_value)
+            arr = np.full(len(index), fill_value, dtype=dtype)
+            arr[rows] = col
+            arrays.append(arr)
+        if arrays and all(arr.dtype == arrays[0].dtype for arr in arrays):
+            return Matrix(np.column_stack(arrays), index=index, columns=self.columns)
+        mat = Matrix(dict(enumerate(arrays)), index=index)
+        mat.columns = self.columns
+        return mat
+
+    @instrumented
+    def submatrix(self, zoning: pd.MultiIndex):
+        '''Returns a submatrix with the origins and destinations specified in zoning.
+        Rows are gathered by position, in the matrix order.'''
+        zs = self.zones
+        zoning = ZoneSystem.of(zoning)
+        if zoning.covers(zs):
+            #all the matrix is in zoning
+            return self.copy()
+        zoning_intersect = zs.intersection(zoning)
+
+        keep = zoning_intersect.full_mask()[zs.positions(self.index)]
+        return self.iloc[np.flatnonzero(keep)]
+
+    @instrumented
     def rezone(self, mapping, mapping_cols=['old', 'new'],
                mapping_split_cols=None, calculate_proportions=True,
-               weights=None, min_val=0.00000001, tol=0.001, strict=False):
+               weights=None, min_val=0.00000001, tol=0.001, strict=False,
+               executor=None, workers=None):
         '''Changes the zoning system based on mapping.
         A mapping is a correspondence between old zones and new zones.
 
@@ -231,15 +789,21 @@ class Matrix(pd.DataFrame):
                 value zero.
             tol - tolerance to check differences between input and
                 outputs matrices.
+            executor - None, 'thread', 'process' or an Executor to rezone
+                each column in parallel (see Parallel.map_columns).
+            workers - number of parallel workers.
             '''
-        
-        if isinstance(self.columns, pd.MultiIndex):
-            col_lvl_names = self.columns.names
-            mat = self.copy().flat_cols
-        else:
-            mat = self.copy()
 
+        if executor is not None and weights is None and len(self.columns) > 1:
+            rezone = functools.partial(Matrix.rezone, mapping=mapping,
+                            mapping_cols=mapping_cols,
+                            mapping_split_cols=mapping_split_cols,
+                            calculate_proportions=calculate_proportions,
+                            min_val=min_val, tol=tol, strict=strict)
+            return concat_columns(map_columns(rezone, [self], executor, workers))
+        
         if weights is None:
+            old, new = mapping_cols
             if mapping_split_cols:
                 
                 try:
@@ -248,44 +812,33 @@ class Matrix(pd.DataFrame):
                     raise ValueError("mapping_split_cols must be as in ['Owght', 'Dwght']")
                 
                 #cap to min_val
-                Omap = mapping[mapping_cols].copy()
-                Omap[Owght] = mapping[Owght].where(mapping[Owght] > min_val, min_val)
-                Dmap = mapping[mapping_cols].copy()
-                Dmap[Dwght] = mapping[Dwght].where(mapping[Dwght] > min_val, min_val)
-                
-                if calculate_proportions:
-                    #proportions always respect 'old' mapping column
-                    Omap[Owght] = Omap.groupby(mapping_cols[0])[Owght].apply(lambda x: (x/x.sum()))
-                    Dmap[Dwght] = Dmap.groupby(mapping_cols[0])[Dwght].apply(lambda x: (x/x.sum()))
-            else:
-                Omap = mapping.reset_index()[mapping_cols]
-                Dmap = Omap
-            
-            suffixes = ['_' + n for n in mat.index.names]
-            rezoned = pd.merge(mat.reset_index(), Omap.reset_index(),
-                          left_on=mat.index.names[-2], right_on=mapping_cols[0])
-            rezoned = pd.merge(rezoned, Dmap.reset_index(),
-                          left_on=mat.index.names[-1], right_on=mapping_cols[0],
-                          suffixes=suffixes)
-            
-            if mapping_split_cols:
-                if Owght == Dwght:
-                    Owght, Dwght = ['{}{}'.format(Owght,s) for s in suffixes]
-                    
-                for col in mat:
-                    rezoned[col] = rezoned[col] * rezoned[Owght] * rezoned[Dwght]
-            
-            NewODnames = ['{}{}'.format(mapping_cols[1],s) for s in suffixes]
-            
-            aux_cols = list(set(rezoned.columns) - set(mat.columns) - set(NewODnames))
-            rezoned = rezoned.drop(aux_cols, axis=1)
-            
-            rezoned = rezoned.groupby(NewODnames).sum()
-            rezoned = Matrix(rezoned)
-            
-            if isinstance(self.columns, pd.MultiIndex):
-                rezoned = rezoned.unflat
-                rezoned.columns.names = col_lvl_names
+                wghts = []
+                for wght in (Owght, Dwght):
+                    w = mapping[wght].where(mapping[wght] > min_val, min_val)
+                    if calculate_proportions:
+                        #proportions always respect 'old' mapping column
+                        w = w / w.groupby(mapping[old]).transform('sum')
+                        
+                    wghts.append(w.values)
+                Owghts, Dwghts = wghts
+
+            #rows of the mapping for each row of the matrix (by index codes)
+            Orows, Drows, rows = mapping_rows(self.index, mapping[old])
+
+            values = {}
+            for j in range(len(self.columns)):
+                vals = self.iloc[:, j].values[rows]
+                if mapping_split_cols:
+                    vals = vals * Owghts[Orows] * Dwghts[Drows]
+                values[j] = vals
+            rezoned = pd.DataFrame(values, copy=False)
+            rezoned.columns = self.columns
+
+            NewODnames = ['{}_{}'.format(new, n) for n in self.index.names]
+            newvals = mapping[new].values
+            rezoned = rezoned.groupby([pd.Series(newvals[Orows], name=NewODnames[0]),
+                                       pd.Series(newvals[Drows], name=NewODnames[1])]).sum()
+            rezoned = self._cast_like(Matrix(rezoned))
             
             if not np.allclose(self.TOTALS, rezoned.TOTALS, rtol=tol, atol=tol):
                 if strict:
@@ -320,14 +873,17 @@ class Matrix(pd.DataFrame):
             # 4) Divide src x wght / wght at hyl level
             rezoned_weighted_mat = rezoned_wmat.div(rezoned_weights,
                     fill_value=0)
+            rezoned_weighted_mat = self._cast_like(rezoned_weighted_mat)
 
             return rezoned_weighted_mat
 
     @property
     def intrazonals(self):
         '''Return the submatrix of intrazonals'''
-        indexer = [allequal(vals) for vals in self.index.values]
-        return self.loc[indexer]
+        def intrazonals():
+            indexer = [allequal(vals) for vals in self.index.values]
+            return self.loc[indexer]
+        return self._memo('intrazonals', intrazonals)
 
     @property
     def intras(self):
@@ -349,34 +905,67 @@ class Matrix(pd.DataFrame):
         with the same dimensions as the intrazonals to infill.'''
         indexer = [allequal(vals) for vals in self.index.values]
         self.loc[indexer] = using
+        self.invalidate()
 
     #TODO: implement max_iter by time rather than iterations
-    def furness(self, TO, TD, tolerance=0.001, max_iter=100):
+    @instrumented
+    def furness(self, TO, TD, tolerance=0.001, max_iter=100,
+                executor=None, workers=None):
         '''Use FRATAR algorithm to adjust (balance) the matrix
         to target origins and destinations (TO, TD), within a certain tolerance.
-        Will not always converge, hence cap maximum iterations to max_iter.'''
+        Will not always converge, hence cap maximum iterations to max_iter.
+        executor - None, 'thread', 'process' or an Executor to balance each
+            column (segment) in parallel (see Parallel.map_columns).'''
+
+        if executor is not None and len(self.columns) > 1:
+            furness = functools.partial(Matrix.furness, tolerance=tolerance,
+                                        max_iter=max_iter)
+            return concat_columns(map_columns(furness, [self, TO, TD],
+                                              executor, workers))
         
-        sTO = self.TO
-        sTD = self.TD
-        fmat = self.copy()
+        # Balancing runs on the index codes: trip ends are summed with
+        # bincount and factors applied by broadcasting (no label alignment).
+        codes = [np.asarray(c) for c in self.index.codes]
+        nzones = [len(l) for l in self.index.levels]
+        #zones of each level with rows (only these are checked)
+        present = [np.bincount(c[c >= 0], minlength=n) > 0
+                   for c, n in zip(codes, nzones)]
+        targets = [zone_values(T, self.index.levels[l], self.columns)
+                   for l, T in enumerate([TO, TD])]
+        fmat = self.to_numpy(dtype=self.float_dtype or np.float64, copy=True)
+        sums = [level_sums(c, n, fmat) for c, n in zip(codes, nzones)]
         i = 1
         
-        while True:
-            # Balancing factors (Nan ~> 0, inf ~> 1):
-            A = (TO / fmat.TO).fillna(0).replace([np.inf, -np.inf], 1)
-            B = (TD / fmat.TD).fillna(0).replace([np.inf, -np.inf], 1)
-            fmat = fmat.mul(A, axis=1, level=0).mul(B, axis=1, level=1)
-        
-            i += 1
-            within_tol = not (any((fmat.TO - TO) > tolerance) or any((fmat.TD - TD) > tolerance))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            while True:
+                # Balancing factors (Nan ~> 0, inf ~> 1), origins then
+                # destinations:
+                A = np.nan_to_num(targets[0] / sums[0], nan=0, posinf=1, neginf=1)
+                fmat *= A[codes[0]]
+                sums[1] = level_sums(codes[1], nzones[1], fmat)
+                B = np.nan_to_num(targets[1] / sums[1], nan=0, posinf=1, neginf=1)
+                fmat *= B[codes[1]]
             
-            if within_tol:
-                break
-            if max_iter and (i >= max_iter):
-                break
-
-        return fmat
-
+                i += 1
+                sums = [level_sums(c, n, fmat) for c, n in zip(codes, nzones)]
+                dTO, dTD = [np.where(p[:, np.newaxis], S - T, np.nan)
+                            for p, S, T in zip(present, sums, targets)]
+                within_tol = not ((np.abs(dTO) > tolerance).any() or
+                                  (np.abs(dTD) > tolerance).any())
+                
+                if within_tol:
+                    break
+                if max_iter and (i >= max_iter):
+                    break
+
+        residual = np.concatenate([np.abs(dTO).ravel(), np.abs(dTD).ravel()])
+        residual = residual[~np.isnan(residual)]
+        note(iterations=i-1, converged=within_tol,
+             residual=float(residual.max()) if len(residual) else 0.)
+        fmat = Matrix(fmat, index=self.index, columns=self.columns)
+        return self._cast_like(fmat)
+
+    @instrumented
     def sectorized(self, sectoring: pd.DataFrame, zcol: str, scol: str):
         '''Returns a matrix with the same dimensions, aggregated by sectors.
         All cells belonging to a sector OD pair will have the sector OD pair
@@ -400,6 +989,7 @@ class Matrix(pd.DataFrame):
         
         return sectorized
 
+    @instrumented
     def desectorized(self, sectoring: pd.DataFrame, zcol: str, scol: str, suffixes=['_O','_D']):
         '''Returns a matrix zone-based matrix from a sector matrix, with zone
         dimensions.  All cells belonging to a sector OD pair will have the
@@ -421,7 +1011,9 @@ class Matrix(pd.DataFrame):
 
         return desectorized
 
-    def ApplyGravityModel(self, TO, TD, f, furness=True, *args, **kwargs):
+    @instrumented
+    def ApplyGravityModel(self, TO, TD, f, furness=True, *args,
+                          executor=None, workers=None, grid=None, **kwargs):
         '''Returns a matrix Tij = Oi*Dj*f(cij)
         self     - cost matrix
         TO       - trip origins
@@ -429,30 +1021,51 @@ class Matrix(pd.DataFrame):
         f        - deterrence function (object) or dictionary of {col: [functions]}
         furness  - return furnessed matrix with TO, TD
         *args, **kwargs - parameters to pass to furness method
+        executor - None, 'thread', 'process' or an Executor to apply the model
+                   to each column in parallel (see Parallel.map_columns).
+        grid     - if given, f is tabulated on a regular grid of costs of grid
+                   points and interpolated (see fast_pdf). Default: exact
         c, TO and TD must have the same number of columns and the same column names'''
         
         same_cols = all([c1==c2==c3 for c1,c2,c3 in zip(self.columns, TO.columns, TD.columns)])
         if not same_cols:
             raise ValueError('c, TO and TD must have the same number of columns and the same column names')
+
+        if executor is not None and len(self.columns) > 1 \
+           and isinstance(f, stats._distn_infrastructure.rv_frozen):
+            gravity = functools.partial(_gravity_column, f=f, furness=furness,
+                                        args=args, kwargs=dict(kwargs, grid=grid))
+            return concat_columns(map_columns(gravity, [self, TO, TD],
+                                              executor, workers))
         
+        dtype = self.float_dtype or np.float64
         if isinstance(f, stats._distn_infrastructure.rv_frozen):
-            gravity = self.apply(f.pdf)
+            gravity = pd.DataFrame(fast_pdf(f, self.to_numpy(dtype=np.float64), grid),
+                                   index=self.index, columns=self.columns).astype(dtype)
         elif isinstance(f, dict):
-            #TODO: fix, MultiIndex is not working
-            cols = [(k, d.dist.name) for k,dlst in f.items() for d in dlst]
-            colidx = pd.MultiIndex.from_tuples(cols)
-            gravity = pd.DataFrame(index=self.index, columns=colidx)
-            for col in self:
-                for distrib in f[col]:
-                    try:
-                        gravity.loc[:,(col, distrib.dist.name)] = distrib.pdf(self[col])
-                    except KeyError:
-                        gravity.iloc[:,(col, col)] = self[col]
+            #one column per segment and distribution, with the segment
+            #levels named as in TO and TD, so they broadcast by segment
+            names = list(self.columns.names)
+            if self.columns.nlevels == 1:
+                names = [names[0] or 'segment']
+            else:
+                names = [n or 'segment_{}'.format(l) for l, n in enumerate(names)]
+            TO = TO.set_axis(TO.columns.set_names(names), axis=1)
+            TD = TD.set_axis(TD.columns.set_names(names), axis=1)
+            cols, values = [], []
+            for j, col in enumerate(self.columns):
+                for distrib in f.get(col, []):
+                    cols.append((col if isinstance(col, tuple) else (col,))
+                                + (distrib.dist.name,))
+                    values.append(fast_pdf(distrib, self.iloc[:, j].values, grid).astype(dtype))
+            colidx = pd.MultiIndex.from_tuples(cols, names=names + ['distribution'])
+            gravity = pd.DataFrame(dict(enumerate(values)), index=self.index)
+            gravity.columns = colidx
         else:
             raise ValueError("f must be a stats distribution of a dict of {col: distirbution}")
 
         gravity = Matrix(gravity)
-        synthetic = gravity.mul(TO, axis=1, level=0).mul(TD, axis=1, level=1)
+        synthetic = gravity.broadcast(TO, level=0).broadcast(TD, level=1)
 
         if furness:
             return synthetic.furness(TO,TD, *args, **kwargs)
@@ -460,6 +1073,8 @@ class Matrix(pd.DataFrame):
             return synthetic
 
     @staticmethod
+    @instrumented
+    @cached(context=_dtype_policy)
     def read_TBA3(file, mat_type='VALUE'):
         '''Reads a text file containing one or more matrices in TBA3 format.
         This is one of SATURN-friendly formats'''
@@ -473,15 +1088,17 @@ class Matrix(pd.DataFrame):
         if mat_type == 'VALUE':
             #keep only UC lvl if no mat_type specified
             df.columns = df.columns.droplevel()
-        mat = Matrix(df)
+        mat = Matrix(df).with_dtype()
         
         return mat
 
     @staticmethod
+    @instrumented
+    @cached(context=_dtype_policy)
     def read_EMME(file):
         '''Reads a text file containing one or more matrices in EMME format.
         Accepts matrices, trip origins, trip destinations and constants.
-        Assumes one single value per row in the EMME files.
+        Full matrices can have one or several values per row (see to_EMME).
         '''
     
         EMMErecord_cols = {
@@ -509,6 +1126,9 @@ class Matrix(pd.DataFrame):
         fn, fext = os.path.splitext(filen)
         with open(file, 'r') as f:
             fcontent = f.read()
+            if not fcontent.endswith('\n'):
+                #last matrix records end with a new line (as in to_EMME output)
+                fcontent += '\n'
             #each source file might contain several matrices
             mat_blocks = mat_re.findall(fcontent)
             
@@ -529,7 +1149,11 @@ class Matrix(pd.DataFrame):
                 #normal md/mo/mf matrices
                 for matb in mat_blocks:
                     mat_type, mat_num, mat_name, mat_default, mat_desc, mat_data = matb
-                    mat_rows = EMMErecord_re[mat_type].findall(mat_data)
+                    if mat_type == 'mf':
+                        #one or several "D: value" per origin line
+                        mat_rows = EMME_mf_records(mat_data)
+                    else:
+                        mat_rows = EMMErecord_re[mat_type].findall(mat_data)
                     data[mat_name] = dict(zip(
                        'mat_type, mat_num, mat_default, mat_desc, mat_rows'.split(', '),
                        [mat_type, mat_num, mat_default, mat_desc, mat_rows]))
@@ -565,41 +1189,52 @@ class Matrix(pd.DataFrame):
         if 'ms' in fcontent:
             matrix = matrix.T.set_index('mat_num')['mat_name mat_val mat_desc'.split()]
         else:
-            matrix = matrix.apply(pd.to_numeric)
+            matrix = Matrix(matrix.apply(pd.to_numeric)).with_dtype()
     
         #numeric is needed for Matrix methods to work as expected
         return matrix
 
     @staticmethod
+    @instrumented
+    @cached(context=_dtype_policy)
     def read_FormatO(file, names=['O','D','T']):
-        '''Reads a "FormatO.mtx" file as exported from VISUM.'''
+        '''Reads a "FormatO.mtx" file as exported from VISUM.
+        Also reads the $E and $V (full matrix) formats (see read_VISUM).'''
 
-        buf = read_clean(file)
-        df = pd.read_csv(buf, delim_whitespace=True, header=None, 
-                     names=names, index_col=[0,1])
-        mat = Matrix(df)
+        O, D, values = read_VISUM(file)
+        idx = pd.MultiIndex.from_arrays([O, D], names=names[:2])
+        mat = Matrix({names[2]: values}, index=idx).with_dtype()
 
         return mat
 
+    @instrumented
     def to_EMME(self, OutputName,
                 file_header='', mat_number_start=100, mat_comment='', 
-                default_val=0, decimals=4):
+                default_val=0, decimals=4, compact=False, values_per_line=10,
+                skip_default=False):
         '''Will write each of the columns of a dataframe (matrix)
         as stacked EMME matrices in a single file.
         Missing values are ignored.
         Matrix nnumbers will be sequential with column order,
-        starting with mat_number_start.'''
-        df_dict = self.to_dict()
+        starting with mat_number_start.
+        compact - write one record per origin with up to values_per_line
+                  destinations (" O D1: v1 D2: v2 ..."), rather than one
+                  record per OD pair. Much smaller files.
+        skip_default - do not write the values equal to default_val (EMME
+                  reads them as default_val). Smaller files for sparse
+                  matrices.'''
+        mat = self.sort_index(level=0, sort_remaining=False) if compact else self
+        O = mat.index.get_level_values(0).values
+        D = mat.index.get_level_values(1).values
         with open(OutputName, "w") as OutputFile:
             if file_header:
                 OutputFile.write(file_header)
             
-            for col in df_dict:
-                mat = df_dict[col]
+            for j, col in enumerate(mat.columns):
                 mat_name = '{}'.format(col)
                 CheckEMMEmatName(mat_name)
                 
-                mat_number = 'mf{0:02d}'.format(mat_number_start + col)
+                mat_number = 'mf{0:02d}'.format(mat_number_start + j)
                 CheckEMMEmatNumber(mat_number)
                 
                 if self.columns.nlevels > 1:
@@ -614,14 +1249,173 @@ class Matrix(pd.DataFrame):
                 OutputFile.write("\na matrix={} {} {} '{}'".format(
                                     mat_number, mat_name, default_val, mat_cmnt))
 
-                # Write data:
-                for ODpair in mat:
-                    O, D = ODpair
-                    val = mat[ODpair]
-                    #Missing values won't be written
-                    if pd.notnull(val):
-                        OutputFile.write('\n {} {}: {:.{dec}f}'.format(O, D, val, dec=decimals))
+                # Write data (missing values won't be written):
+                OutputFile.write(EMME_records(O, D, mat.iloc[:, j].values,
+                                              decimals=decimals, compact=compact,
+                                              values_per_line=values_per_line,
+                                              skip_value=default_val if skip_default else None))
+
+    @instrumented
+    def to_OMX(self, OutputName, mapping='zone_number', fill_value=0,
+               compression=4, chunk_rows=256):
+        '''Writes the matrix as an OMX file (HDF5, needs h5py): each column
+        is a square array of all zones (origins and destinations), chunked
+        by rows and gzip compressed. Missing OD pairs take fill_value.
+        The zone numbers are stored in the lookup named mapping.'''
+        h5py = import_h5py()
+        zones = self.index.levels[0].union(self.index.levels[1])
+        n = len(zones)
+        oi = zones.get_indexer(self.index.get_level_values(0))
+        di = zones.get_indexer(self.index.get_level_values(1))
+        labels = np.asarray(zones)
+        if labels.dtype == object:
+            labels = labels.astype(str).astype(bytes)
+
+        with h5py.File(OutputName, 'w') as f:
+            f.attrs['OMX_VERSION'] = np.bytes_('0.2')
+            f.attrs['SHAPE'] = np.array([n, n], dtype=np.int32)
+            data = f.create_group('data', track_order=True)
+            f.create_group('lookup').create_dataset(mapping, data=labels)
+            for j, col in enumerate(self.columns):
+                vals = self.iloc[:, j].values
+                arr = np.full((n, n), fill_value, dtype=vals.dtype
+                              if np.issubdtype(vals.dtype, np.number) else np.float64)
+                arr[oi, di] = vals
+                name = col if isinstance(col, str) else '_'.join(map(str, np.atleast_1d(col)))
+                data.create_dataset(name, data=arr, chunks=(min(n, chunk_rows), n) if n else None,
+                                    compression='gzip' if compression else None,
+                                    compression_opts=compression or None,
+                                    shuffle=bool(compression))
 
+    @staticmethod
+    @instrumented
+    def read_OMX(file, matrices=None, mapping=None, names=['O', 'D']):
+        '''Reads an OMX file (HDF5, needs h5py) as a Matrix with one column
+        per OMX matrix (all of them, or those in the list matrices).
+        Zones are taken from the lookup named mapping (default: the first
+        lookup, or 1..n if there are none).'''
+        h5py = import_h5py()
+        with h5py.File(file, 'r') as f:
+            n = int(f.attrs['SHAPE'][0])
+            lookup = f['lookup'] if 'lookup' in f else {}
+            if mapping is None and len(lookup):
+                mapping = list(lookup.keys())[0]
+            if mapping is not None:
+                zones = lookup[mapping][()]
+                if zones.dtype.kind == 'S':
+                    zones = zones.astype(str)
+            else:
+                zones = np.arange(1, n + 1)
+            matrices = matrices or list(f['data'].keys())
+            values = {name: f['data'][name][()].ravel() for name in matrices}
+
+        idx = pd.MultiIndex.from_product([zones, zones], names=names)
+        return Matrix(values, index=idx).with_dtype()
+
+def mapping_rows(index, old):
+    '''Expands the rows of a matrix index by a zone mapping, using the index
+    codes: returns (Orows, Drows, rows) so that each row of the rezoned
+    matrix (before aggregating) takes rows[k] of the matrix, with origin
+    mapped by mapping row Orows[k] and destination by Drows[k].
+    Zones can be mapped to several new zones. Unmapped zones are dropped.'''
+    old = np.asarray(old)
+    mapped = []
+    for level in (0, 1):
+        #mapping rows sorted by the level value of their old zone
+        lev_pos = index.levels[level].get_indexer(old)
+        valid = np.flatnonzero(lev_pos >= 0)
+        order = valid[np.argsort(lev_pos[valid], kind='stable')]
+        counts = np.bincount(lev_pos[valid], minlength=len(index.levels[level]))
+        starts = np.cumsum(counts) - counts
+        codes = np.asarray(index.codes[level])
+        n = np.where(codes >= 0, counts[codes], 0)
+        mapped.append((order, starts[codes], n))
+
+    (Oorder, Ostart, nO), (Dorder, Dstart, nD) = mapped
+    n = nO * nD
+    rows = np.repeat(np.arange(len(index)), n)
+    #position within the nO x nD combinations of each row
+    k = np.arange(len(rows)) - np.repeat(np.cumsum(n) - n, n)
+    nDr = nD[rows]
+    Orows = Oorder[Ostart[rows] + k // np.maximum(nDr, 1)]
+    Drows = Dorder[Dstart[rows] + k % np.maximum(nDr, 1)]
+    return Orows, Drows, rows
+
+def segment_positions(columns, other):
+    '''Returns the position in other (column labels) of the segment of each
+    column in columns: by label, by the named levels of other (a subset of
+    the levels of columns), or 0 for all if other has a single column.'''
+    if other.equals(columns):
+        return np.arange(len(columns))
+    if other.is_unique:
+        pos = other.get_indexer(columns)
+        if (pos >= 0).all():
+            return pos
+        names = list(other.names)
+        if None not in names and set(names) <= set(columns.names):
+            keys = [columns.get_level_values(n) for n in names]
+            keys = keys[0] if len(keys) == 1 else pd.MultiIndex.from_arrays(keys)
+            pos = other.get_indexer(keys)
+            if (pos >= 0).all():
+                return pos
+    if len(other) == 1:
+        return np.zeros(len(columns), dtype=np.intp)
+    raise ValueError('Segments {} do not match the matrix columns {}.'.format(
+                        list(other), list(columns)))
+
+def segment_factors(columns, factors, by=None):
+    '''Returns an array with the factor of each column (segment).
+        factors - dict or Series by column label, or by the values of the
+                  column levels in by (a level name or a list of names).
+                  A Series with named index levels is matched by them.'''
+    factors = pd.Series(factors)
+    if by is None and None not in factors.index.names:
+        by = list(factors.index.names)
+    if by is not None:
+        by = [by] if isinstance(by, (str, int)) else list(by)
+        keys = [columns.get_level_values(b) for b in by]
+        columns = keys[0] if len(keys) == 1 else pd.MultiIndex.from_arrays(keys)
+    values = factors.reindex(columns).to_numpy(dtype=np.float64)
+    if np.isnan(values).any():
+        raise ValueError('No factors for segments {}.'.format(
+                            list(columns[np.isnan(values)])))
+    return values
+
+def zone_values(te, zones, columns):
+    '''Returns the values of trip-end vector te (zones x segments) for each
+    zone in zones (NaN if missing) and each column in columns.'''
+    te = pd.DataFrame(te)
+    values = te.to_numpy(dtype=np.float64)[:, segment_positions(columns, te.columns)]
+    if te.index.equals(zones):
+        #e.g. targets built on the matrix zones (TripEnds.targets)
+        return values
+    rows = te.index.get_indexer(zones)
+    return np.where((rows >= 0)[:, np.newaxis], values[rows], np.nan)
+
+def level_sums(codes, n, values):
+    '''Sums the rows of values (rows x columns) by codes (0 to n-1), skipping
+    NaN values.'''
+    sums = np.empty((n, values.shape[1]), dtype=np.float64)
+    valid = codes >= 0
+    for j in range(values.shape[1]):
+        vals = values[valid, j]
+        sums[:, j] = np.bincount(codes[valid], weights=np.where(np.isnan(vals), 0, vals),
+                                 minlength=n)
+    return sums
+
+def import_h5py():
+    '''Returns the h5py module (optional, for OMX files).'''
+    try:
+        import h5py
+    except ImportError:
+        raise ImportError('OMX files need h5py: pip install h5py')
+    return h5py
+
+def _gravity_column(cost, TO, TD, f, furness, args, kwargs):
+    '''ApplyGravityModel on single columns (picklable, for Parallel).'''
+    return cost.ApplyGravityModel(TO, TD, f, furness, *args, **kwargs)
+
+@instrumented
 def TE_comparison_to_PNGs(mati, matf, constrain_zones=None,
         oFileNamePattern='{}', title='', xaxis_eq_yaxis=True,
         homogeneous_axis=True, min_axis=0, prefixes='', suffixes='',
@@ -632,9 +1426,9 @@ def TE_comparison_to_PNGs(mati, matf, constrain_zones=None,
         prefixes         - to prepend to each column. Use as a marker.
         suffixes         - to append to each column. Use as a marker.
     '''
-    for df in zip_df_cols([mati.TE, matf.TE]):
-        
-        flatten_cols(df)
+    pairs = ColumnPairs([mati.TE, matf.TE])
+    for i in range(len(pairs)):
+        df = pairs.pair(i, sep='_')
         
         try:
             ##TODO: fix this condition. Try should not be needed.
@@ -648,16 +1442,32 @@ def TE_comparison_to_PNGs(mati, matf, constrain_zones=None,
                 homogeneous_axis=homogeneous_axis, min_axis=min_axis,
                 prefixes=prefixes, suffixes=suffixes, output_df=output_df)
 
+@instrumented
 def TE_RegressionStats(mati, matf, include_zones=None,
-                prefixes='', suffixes=''):
+                prefixes='', suffixes='', weights=None, through_origin=False):
     '''Returns a dataframe with the regression statistics of mati and matf trip
     ends. mati and matf columns will be compared pairwise, so must be ordered.
-    Wrapper of RegressionStats_ConsecutiveColPairs (with flavor).
+    All column pairs are fitted in one pass (RegressionStats_ColPairs).
         prefixes         - to prepend to each column. Use as a marker.
         suffixes         - to append to each column. Use as a marker.
+        weights          - zone weights for a weighted fit
+        through_origin   - fit regressions with intercept fixed to 0
     '''
-    return pd.concat([RegressionStats_ConsecutiveColPairs(
-                        flatten_cols(df, inplace=False),
-                        prefixes=prefixes,
-                        suffixes=suffixes)
-                     for df in zip_df_cols([mati.TE, matf.TE])])
+    pairs = ColumnPairs([mati.TE, matf.TE])
+    TEi, TEf = pairs.frames
+
+    colsi = list(flat_labels(TEi.columns, escape=False))
+    colsf = list(flat_labels(TEf.columns, escape=False))
+    if prefixes:
+        colsi = [prefixes[0] + col for col in colsi]
+        colsf = [prefixes[1] + col for col in colsf]
+    if suffixes:
+        colsi = [col + suffixes[0] for col in colsi]
+        colsf = [col + suffixes[1] for col in colsf]
+    names = [' - '.join([coli, colf]) for coli, colf in zip(colsi, colsf)]
+
+    if weights is not None:
+        weights = pd.Series(weights).reindex(pairs.index).fillna(0).values
+
+    return RegressionStats_ColPairs(*pairs.stacked, weights=weights,
+                                    through_origin=through_origin, names=names)
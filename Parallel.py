@@ -0,0 +1,264 @@
+
+# coding: utf-8
+
+# Parallel execution of Matrix operations, column by column.
+#
+#   mat.rezone(mapping, ['zones', 'sectors'], executor='thread')
+#   cost.ApplyGravityModel(TO, TD, f, executor='process', workers=8)
+#
+# executor can be None (serial), 'thread', 'process' or a
+# concurrent.futures executor. Threads suit operations that spend most of
+# their time in NumPy (which releases the GIL); processes suit the rest.
+# With processes, the input matrices are published once in shared memory
+# (SharedMatrix) and each worker builds its column from them, so whole
+# DataFrames are never pickled: only the column results travel back.
+# Only numeric and bool columns can be shared; matrices with other columns
+# (e.g. object, str or Int64) are pickled column by column instead.
+
+import numpy as np
+import pandas as pd
+import concurrent.futures as futures
+import os
+from multiprocessing import shared_memory
+
+def columns_of(frames):
+    '''Returns the number of columns to split frames by (the same for all).'''
+    ncols = {len(df.columns) for df in frames}
+    if len(ncols) != 1:
+        raise IndexError('Input matrices have different number of columns.')
+    return ncols.pop()
+
+def get_executor(executor=None, workers=None):
+    '''Returns (executor, owned): a concurrent.futures executor for
+    'thread' or 'process' (owned, to be shut down by the caller),
+    or executor itself.'''
+    if executor == 'thread':
+        return futures.ThreadPoolExecutor(workers or os.cpu_count()), True
+    if executor == 'process':
+        return futures.ProcessPoolExecutor(workers or os.cpu_count()), True
+    if isinstance(executor, futures.Executor):
+        return executor, False
+    raise ValueError("executor must be None, 'thread', 'process' or an Executor.")
+
+def column(df, j):
+    '''Returns the j-th column of df as a single-column frame (same class).'''
+    return df.iloc[:, [j]]
+
+def unshareable_columns(df):
+    '''Returns the columns of df that cannot be copied to shared memory:
+    those without a numeric or bool numpy dtype (e.g. object, str or
+    extension dtypes such as Int64).'''
+    return [c for c, t in df.dtypes.items()
+            if not (isinstance(t, np.dtype) and t.kind in 'biufc')]
+
+class SharedMatrix:
+    '''A Matrix (or any frame) published in shared memory: its columns and
+    index codes are copied once to a shared memory block, and other
+    processes attach read-only views on it (no copies, no pickling).
+
+    In the publishing process:
+        with SharedMatrix.publish(skims) as shared:
+            pool.submit(task, shared)      #pickles just the handle
+    In the workers:
+        def task(shared):
+            skims = shared.matrix          #read-only views
+
+    The publisher owns the block: close() releases it and unlink() frees it
+    (both on exit of the with block). Workers can close() their attachments,
+    or they are closed at exit.'''
+
+    _attached = {}  #name: SharedMatrix, attachments in this process
+
+    def __init__(self, shm, handle, owner=False):
+        self.shm = shm
+        self.handle = handle
+        self.owner = owner
+        self.closed = False
+        self._matrix = None
+
+    @staticmethod
+    def publish(df):
+        '''Copies df to a new shared memory block. Returns a SharedMatrix
+        that owns it. Raises ValueError if a column is not numeric or bool.'''
+        bad = unshareable_columns(df)
+        if bad:
+            raise ValueError('Only numeric or bool columns can be shared: {}.'.format(
+                                ', '.join('{} ({})'.format(c, df.dtypes[c]) for c in bad)))
+        arrays = [np.ascontiguousarray(df.iloc[:, j].values)
+                  for j in range(len(df.columns))]
+        if isinstance(df.index, pd.MultiIndex):
+            index = (df.index.levels, df.index.names)
+            arrays += [np.asarray(c) for c in df.index.codes]
+        else:
+            index = df.index
+        layout, offset = [], 0
+        for a in arrays:
+            layout.append((offset, a.dtype.str, len(a)))
+            offset += -(-a.nbytes // 8) * 8  #8-byte aligned
+        shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+        for (start, dtype, n), a in zip(layout, arrays):
+            np.ndarray(n, dtype, buffer=shm.buf, offset=start)[:] = a
+        handle = dict(name=shm.name, layout=layout, index=index,
+                      columns=df.columns, cls=type(df), ncols=len(df.columns))
+        return SharedMatrix(shm, handle, owner=True)
+
+    @staticmethod
+    def attach(handle):
+        '''Returns the SharedMatrix of a published handle, attaching it
+        once per process.'''
+        name = handle['name']
+        if name not in SharedMatrix._attached:
+            try:
+                shm = shared_memory.SharedMemory(name, track=False)
+            except TypeError:
+                #Python < 3.13 (workers share the parent resource tracker)
+                shm = shared_memory.SharedMemory(name)
+            SharedMatrix._attached[name] = SharedMatrix(shm, handle)
+        return SharedMatrix._attached[name]
+
+    def __reduce__(self):
+        #pickled as its handle: unpickling attaches it
+        return (SharedMatrix.attach, (self.handle,))
+
+    def __repr__(self):
+        return 'SharedMatrix({}, {} rows x {} columns, {} bytes{})'.format(
+                    self.name, self.shape[0], self.shape[1], self.nbytes,
+                    ', owner' if self.owner else '')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        if self.owner:
+            self.unlink()
+        return False
+
+    @property
+    def name(self):
+        return self.handle['name']
+
+    @property
+    def shape(self):
+        nrows = self.handle['layout'][0][2] if self.handle['layout'] else 0
+        return (nrows, self.handle['ncols'])
+
+    @property
+    def nbytes(self):
+        return self.shm.size
+
+    def _arrays(self):
+        if self.closed:
+            raise ValueError('SharedMatrix {} is closed.'.format(self.name))
+        arrays = []
+        for start, dtype, n in self.handle['layout']:
+            a = np.ndarray(n, dtype, buffer=self.shm.buf, offset=start)
+            a.flags.writeable = False
+            arrays.append(a)
+        return arrays
+
+    def _index(self, arrays):
+        ncols = self.handle['ncols']
+        if len(arrays) > ncols:
+            levels, names = self.handle['index']
+            return pd.MultiIndex(levels=levels, codes=arrays[ncols:], names=names,
+                                 verify_integrity=False)
+        return self.handle['index']
+
+    def _frame(self, arrays, cols):
+        df = pd.DataFrame({k: arrays[j] for k, j in enumerate(cols)},
+                          index=self._index(arrays), copy=False)
+        df.columns = self.handle['columns'][cols]
+        return self.handle['cls'](df)
+
+    @property
+    def matrix(self):
+        '''Returns the frame, with read-only views on the shared memory.'''
+        if self._matrix is None:
+            self._matrix = self._frame(self._arrays(), list(range(self.handle['ncols'])))
+        return self._matrix
+
+    def column(self, j):
+        '''Returns the j-th column as a single-column frame (views).'''
+        return self._frame(self._arrays(), [j])
+
+    def close(self):
+        '''Closes this process' access to the shared memory. Frames taken
+        from it must not be used afterwards.'''
+        self._matrix = None
+        if not self.closed:
+            try:
+                self.shm.close()
+            except BufferError:
+                #views still alive: memory is released when they are
+                pass
+            self.closed = True
+        if SharedMatrix._attached.get(self.name) is self:
+            del SharedMatrix._attached[self.name]
+
+    def unlink(self):
+        '''Frees the shared memory block (owner only), once all processes
+        have closed it.'''
+        if not self.owner:
+            raise ValueError('Only the publisher can unlink a SharedMatrix.')
+        try:
+            self.shm.unlink()
+        except FileNotFoundError:
+            pass
+
+def detach_all():
+    '''Closes all the SharedMatrix attachments of this process.'''
+    for shared in list(SharedMatrix._attached.values()):
+        shared.close()
+
+def _run_shared(func, shared, j):
+    '''Worker: runs func on the j-th column of each SharedMatrix.'''
+    try:
+        result = func(*[s.column(j) for s in shared])
+        #result must not keep views on the shared memory
+        result = result.copy(deep=True)
+        result.index = result.index.copy(deep=True)
+    finally:
+        for s in shared:
+            s.close()
+    return result
+
+def map_columns(func, frames, executor=None, workers=None):
+    '''Returns the results of func(col_0, col_1, ...) for each column position,
+    where col_i is the column of frames[i] in that position (as a single
+    column frame), in column order.
+        func     - function of one single-column frame per input frame.
+                   Must be picklable (e.g. module level, or functools.partial
+                   of one) for processes
+        frames   - list of matrices / dataframes with the same number of columns
+        executor - None (serial), 'thread', 'process' or a
+                   concurrent.futures executor
+        workers  - number of workers ('thread' or 'process')'''
+    ncols = columns_of(frames)
+    if executor is None or ncols < 2:
+        return [func(*[column(df, j) for df in frames]) for j in range(ncols)]
+
+    pool, owned = get_executor(executor, workers)
+    try:
+        if isinstance(pool, futures.ProcessPoolExecutor) \
+           and not any(unshareable_columns(df) for df in frames):
+            shared = [SharedMatrix.publish(df) for df in frames]
+            try:
+                jobs = [pool.submit(_run_shared, func, shared, j) for j in range(ncols)]
+                return [job.result() for job in jobs]
+            finally:
+                for s in shared:
+                    s.close()
+                    s.unlink()
+        jobs = [pool.submit(func, *[column(df, j) for df in frames])
+                for j in range(ncols)]
+        return [job.result() for job in jobs]
+    finally:
+        if owned:
+            pool.shutdown()
+
+def concat_columns(results):
+    '''Reassembles the results of map_columns as one frame (column order).'''
+    if len(results) == 1:
+        return results[0]
+    return type(results[0])(pd.concat(results, axis=1))
@@ -0,0 +1,213 @@
+
+# coding: utf-8
+
+import numpy as np
+import pandas as pd
+import os
+
+try:
+    from TPlanning_matrices.Streaming import OriginBlockReader, aligned_blocks
+    from TPlanning_matrices.AuxFunctions import *
+except:
+    # For in-folder examples
+    from Streaming import OriginBlockReader, aligned_blocks
+    from AuxFunctions import *
+
+def GEH(base, scenario):
+    '''Returns the GEH statistic of each pair of values.
+    GEH = sqrt(2 * (scenario - base)^2 / (scenario + base)). 0 if both are 0.'''
+    total = base + scenario
+    with np.errstate(divide='ignore', invalid='ignore'):
+        geh = np.sqrt(2 * (scenario - base) ** 2 / total)
+    return np.where(total > 0, geh, 0)
+
+class ScenarioComparison:
+    '''Accumulates difference statistics of several scenario matrices against
+    a base matrix, one block of origins at a time.
+    Columns are compared positionally (as in df_difference).
+        names     - scenario names
+        columns   - column names (from the base matrix)
+        top_k     - number of OD pairs with the largest absolute differences
+                    kept for each scenario and column
+        geh_bins  - bin edges of the cell GEH distribution
+    '''
+
+    def __init__(self, names, columns, top_k=20, geh_bins=[0, 1, 2, 5, 10, np.inf]):
+        self.names = list(names)
+        self.columns = list(columns)
+        self.top_k = top_k
+        self.geh_bins = np.asarray(geh_bins, dtype=np.float64)
+
+        shape = (len(self.names), len(self.columns))
+        self.total_base = np.zeros(len(self.columns))
+        self.total = np.zeros(shape)
+        self.abs_diff = np.zeros(shape)
+        self.sq_diff = np.zeros(shape)
+        self.cells = np.zeros(shape, dtype=np.int64)
+        self.geh_counts = np.zeros(shape + (len(self.geh_bins) - 1,), dtype=np.int64)
+        self.top = {}  #(scenario, column): (O, D, base, scenario, diff)
+        self.TOs = []
+        self.TDs = None
+
+    def update(self, base, scenarios):
+        '''Adds a block of origins. base and scenarios are Matrix blocks
+        (scenarios is a list, in the order of names).'''
+        if len(scenarios) != len(self.names):
+            raise ValueError('One matrix block is needed for each scenario.')
+
+        idx = base.index
+        for mat in scenarios:
+            idx = idx.union(mat.index)
+        if not len(idx):
+            return
+        O = idx.get_level_values(0)
+        D = idx.get_level_values(1)
+
+        b = base.reindex(idx).fillna(0).values
+        self._check_columns(b)
+        self.total_base += b.sum(axis=0)
+        TO = {('base', col): b[:, j] for j, col in enumerate(self.columns)}
+
+        for i, (name, mat) in enumerate(zip(self.names, scenarios)):
+            s = mat.reindex(idx).fillna(0).values
+            self._check_columns(s)
+            diff = s - b
+            self.total[i] += s.sum(axis=0)
+            self.abs_diff[i] += np.abs(diff).sum(axis=0)
+            self.sq_diff[i] += (diff ** 2).sum(axis=0)
+            self.cells[i] += len(idx)
+            geh = GEH(b, s)
+            for j, col in enumerate(self.columns):
+                self.geh_counts[i, j] += np.histogram(geh[:, j], self.geh_bins)[0]
+                self._update_top(name, col, O, D, b[:, j], s[:, j], diff[:, j])
+                TO[(name, col)] = s[:, j]
+
+        #Trip ends: each origin is only in one block, destinations in all.
+        TE = pd.DataFrame(TO, index=idx)
+        TE.columns = pd.MultiIndex.from_tuples(TE.columns)
+        self.TOs.append(TE.groupby(level=0).sum())
+        TD = TE.groupby(level=1).sum()
+        self.TDs = TD if self.TDs is None else self.TDs.add(TD, fill_value=0)
+
+    def _check_columns(self, values):
+        if values.shape[1] != len(self.columns):
+            raise IndexError('Input matrices have different number of columns.')
+
+    def _update_top(self, name, col, O, D, b, s, diff):
+        '''Keeps the top_k OD pairs by absolute difference.'''
+        cand = np.abs(diff)
+        if len(cand) > self.top_k:
+            sel = np.argpartition(-cand, self.top_k - 1)[:self.top_k]
+        else:
+            sel = np.arange(len(cand))
+        new = (np.asarray(O)[sel], np.asarray(D)[sel], b[sel], s[sel], diff[sel])
+        if (name, col) in self.top:
+            new = tuple(np.concatenate([old, n])
+                        for old, n in zip(self.top[(name, col)], new))
+            keep = np.argsort(-np.abs(new[-1]), kind='stable')[:self.top_k]
+            new = tuple(a[keep] for a in new)
+        self.top[(name, col)] = new
+
+    @property
+    def summary(self):
+        '''Returns a dataframe with the statistics of each scenario and column
+        against the base.'''
+        rows = []
+        for i, name in enumerate(self.names):
+            for j, col in enumerate(self.columns):
+                total_base = self.total_base[j]
+                total = self.total[i, j]
+                cells = self.cells[i, j]
+                geh = self.geh_counts[i, j]
+                rows.append({'scenario': name, 'column': col,
+                             'total_base': total_base,
+                             'total': total,
+                             'diff': total - total_base,
+                             '%diff': 100 * (total - total_base) / total_base
+                                      if total_base else np.nan,
+                             'abs_diff': self.abs_diff[i, j],
+                             'RMSE': np.sqrt(self.sq_diff[i, j] / cells)
+                                     if cells else np.nan,
+                             'cells': cells,
+                             'GEH<5': geh[self.geh_bins[1:] <= 5].sum() / cells
+                                      if cells else np.nan})
+        return pd.DataFrame(rows).set_index(['scenario', 'column'])
+
+    @property
+    def GEH_distribution(self):
+        '''Returns the number of cells in each GEH band, by scenario and column.'''
+        bands = ['{}-{}'.format(lo, hi) for lo, hi
+                 in zip(self.geh_bins[:-1], self.geh_bins[1:])]
+        idx = pd.MultiIndex.from_product([self.names, self.columns],
+                                         names=['scenario', 'column'])
+        return pd.DataFrame(self.geh_counts.reshape(len(idx), -1),
+                            index=idx, columns=bands)
+
+    @property
+    def top_changes(self):
+        '''Returns the top_k OD pairs with the largest absolute differences,
+        by scenario and column.'''
+        dfs = []
+        for (name, col), (O, D, b, s, diff) in self.top.items():
+            order = np.argsort(-np.abs(diff), kind='stable')
+            dfs.append(pd.DataFrame({'scenario': name, 'column': col,
+                                     'O': O[order], 'D': D[order],
+                                     'base': b[order], 'value': s[order],
+                                     'diff': diff[order]}))
+        if not dfs:
+            return pd.DataFrame(columns='scenario column O D base value diff'.split())
+        return pd.concat(dfs, ignore_index=True)
+
+    @property
+    def TO(self):
+        '''Trip origins of base and scenarios. Columns: (scenario, column).'''
+        return pd.concat(self.TOs) if self.TOs else None
+
+    @property
+    def TD(self):
+        '''Trip destinations of base and scenarios. Columns: (scenario, column).'''
+        return self.TDs
+
+    def TE_difference(self, percent=False):
+        '''Returns scenario - base trip ends (see df_difference).
+        Columns: (TO|TD, scenario, column).'''
+        TEs = {}
+        for te, df in [('TO', self.TO), ('TD', self.TD)]:
+            for name in self.names:
+                diff = df[name] - df['base']
+                if percent:
+                    diff = diff / df['base']
+                for col in diff:
+                    TEs[(te, name, col)] = diff[col]
+        return pd.DataFrame(TEs)
+
+def compare_scenarios(files, base=0, names=None, fmt=None, block_size=500,
+                      top_k=20, **kwargs):
+    '''Compares several matrix files against a base, reading all of them one
+    block of origins at a time (see Streaming.OriginBlockReader), so only
+    block_size origins of each matrix are in memory at any time.
+        files      - matrix files (EMME, TBA3 or FormatO), sorted by origin
+        base       - position of the base matrix in files
+        names      - scenario names. Default: file names
+        fmt        - file format. None to guess it for each file.
+    Returns a ScenarioComparison: summary, GEH_distribution, top_changes,
+    TO, TD and TE_difference.'''
+
+    if names is None:
+        names = [os.path.splitext(os.path.basename(f))[0] for f in files]
+    if duplicates_in_list(names):
+        raise ValueError('Duplicate scenario names.')
+
+    readers = [OriginBlockReader(f, fmt=fmt) for f in files]
+    scenario_names = [n for i, n in enumerate(names) if i != base]
+
+    comparison = None
+    for bound, blocks in aligned_blocks(readers, block_size):
+        base_block = blocks[base]
+        scenario_blocks = [blk for i, blk in enumerate(blocks) if i != base]
+        if comparison is None:
+            comparison = ScenarioComparison(scenario_names, base_block.columns,
+                                            top_k=top_k, **kwargs)
+        comparison.update(base_block, scenario_blocks)
+
+    return comparison
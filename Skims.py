@@ -0,0 +1,183 @@
+
+# coding: utf-8
+
+# Skim (cost) matrices from network shortest paths, as cost inputs for
+# ApplyGravityModel, TLD.from_mat and weighted rezones.
+#
+#   net = Network.read('links.csv', 'connectors.csv')
+#   cost = net.skims(['Time', 'Length'], zones=demand, executor='process')
+#
+# Links are a table of From / To nodes and cost columns. Zones are joined
+# to the network by connectors (Zone / Node, plus optional cost columns).
+# Each zone is split into an origin node, with access connectors only, and
+# a destination node, with egress connectors only, so shortest paths never
+# run through a zone. Paths are found with scipy.sparse.csgraph.dijkstra
+# for batches of origins, which can run in parallel (see Parallel).
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sparse
+from scipy.sparse.csgraph import dijkstra
+
+try:
+    from TPlanning_matrices.Matrix import Matrix, ZoneSystem
+    from TPlanning_matrices.Instrumentation import instrumented, note
+    from TPlanning_matrices.Parallel import get_executor
+except:
+    # For in-folder examples
+    from Matrix import Matrix, ZoneSystem
+    from Instrumentation import instrumented, note
+    from Parallel import get_executor
+
+class Network:
+    '''Links and zone connectors of a network.
+        links      - DataFrame with from_col, to_col and cost columns
+        connectors - DataFrame with zone_col, node_col and (optionally) cost
+                     columns, used both ways. Missing cost columns cost 0.
+                     None if zones are network nodes
+        directed   - False if links can be used both ways'''
+
+    def __init__(self, links, connectors=None, directed=True, from_col='From',
+                 to_col='To', zone_col='Zone', node_col='Node'):
+        self.links = links
+        self.connectors = connectors
+        self.directed = directed
+        self.from_col, self.to_col = from_col, to_col
+        self.zone_col, self.node_col = zone_col, node_col
+
+        ends = [links[from_col].values, links[to_col].values]
+        if connectors is not None:
+            ends.append(connectors[node_col].values)
+        self.nodes = pd.Index(pd.unique(np.concatenate(ends)), name='node')
+
+    def __repr__(self):
+        return 'Network({} nodes, {} links, {} zones)'.format(
+                    len(self.nodes), len(self.links), len(self.zones))
+
+    @staticmethod
+    def read(links, connectors=None, **kwargs):
+        '''Reads the links (and connectors) from CSV files. kwargs are passed
+        to Network (e.g. directed, from_col).'''
+        def read(file):
+            df = pd.read_csv(file, skipinitialspace=True)
+            df.columns = [c.strip() for c in df.columns]
+            return df
+        return Network(read(links), None if connectors is None else read(connectors),
+                       **kwargs)
+
+    @property
+    def zones(self):
+        '''Zones with connectors (all nodes if there are no connectors).'''
+        if self.connectors is None:
+            return pd.Index(self.nodes, name='zone')
+        return pd.Index(pd.unique(self.connectors[self.zone_col].values), name='zone')
+
+    def graph(self, cost, origins, destinations):
+        '''Returns (graph, sources, targets): the network as a sparse graph
+        weighted by the cost column, and the graph nodes of the origin and
+        destination zones. Parallel links keep the cheapest.'''
+        nodes = self.nodes
+        n = len(nodes)
+        f = nodes.get_indexer(self.links[self.from_col].values)
+        t = nodes.get_indexer(self.links[self.to_col].values)
+        w = self.links[cost].to_numpy(dtype=np.float64)
+        if np.isnan(w).any() or (w < 0).any():
+            raise ValueError('Link costs ({}) must be positive numbers.'.format(cost))
+        if not self.directed:
+            f, t, w = np.concatenate([f, t]), np.concatenate([t, f]), np.concatenate([w, w])
+
+        if self.connectors is None:
+            sources = nodes.get_indexer(origins)
+            targets = nodes.get_indexer(destinations)
+            if (sources < 0).any() or (targets < 0).any():
+                raise ValueError('There are zones that are not network nodes.')
+            size = n
+        else:
+            con = self.connectors
+            node = nodes.get_indexer(con[self.node_col].values)
+            c = con[cost].to_numpy(dtype=np.float64) if cost in con \
+                else np.zeros(len(con))
+            if np.isnan(c).any() or (c < 0).any():
+                raise ValueError('Connector costs ({}) must be positive numbers.'.format(cost))
+            #origin zone nodes after the network nodes, then destination ones
+            sources = n + np.arange(len(origins))
+            targets = n + len(origins) + np.arange(len(destinations))
+            opos = pd.Index(origins).get_indexer(con[self.zone_col].values)
+            dpos = pd.Index(destinations).get_indexer(con[self.zone_col].values)
+            o, d = opos >= 0, dpos >= 0
+            f = np.concatenate([f, sources[opos[o]], node[d]])
+            t = np.concatenate([t, node[o], targets[dpos[d]]])
+            w = np.concatenate([w, c[o], c[d]])
+            size = n + len(origins) + len(destinations)
+
+        #cheapest of parallel links (a sparse matrix would add them up)
+        order = np.lexsort((w, t, f))
+        f, t, w = f[order], t[order], w[order]
+        first = np.ones(len(f), dtype=bool)
+        first[1:] = (f[1:] != f[:-1]) | (t[1:] != t[:-1])
+        graph = sparse.csr_matrix((w[first], (f[first], t[first])), shape=(size, size))
+        return graph, sources, targets
+
+    @instrumented(name='Network.skims')
+    def skims(self, cost, zones=None, intrazonal=None, unreachable=np.nan,
+              batch=None, executor=None, workers=None):
+        '''Returns a Matrix with the shortest path cost between zones, one
+        column for each cost column in cost (a name or list of names).
+            zones       - a Matrix (skims for its OD pairs), a ZoneSystem, a
+                          list of zones or None (all zones)
+            intrazonal  - value for the intrazonal cells (None: the cost of
+                          going to the network and back)
+            unreachable - value for OD pairs without a path
+            batch       - origins per shortest path call (default: about
+                          64 MB of distances)
+            executor    - None (serial), 'thread', 'process' or an Executor,
+                          to run the batches in parallel
+            workers     - number of workers ('thread' or 'process')'''
+        costs = [cost] if isinstance(cost, str) else list(cost)
+        if not costs:
+            raise ValueError('There must be at least one cost column.')
+        if zones is None:
+            zs = ZoneSystem(self.zones)
+        elif isinstance(zones, pd.DataFrame):
+            zs = ZoneSystem.of(zones.index)
+        elif isinstance(zones, ZoneSystem):
+            zs = zones
+        else:
+            zs = ZoneSystem(zones)
+        origins, destinations = zs.origins, zs.destinations
+        if batch is None:
+            #graph nodes: network nodes and origin / destination zone nodes
+            size = len(self.nodes) if self.connectors is None else \
+                   len(self.nodes) + len(origins) + len(destinations)
+            batch = max(1, 2 ** 23 // size)
+
+        pool, owned = (None, False) if executor is None else get_executor(executor, workers)
+        try:
+            columns = {}
+            for c in costs:
+                graph, sources, targets = self.graph(c, origins, destinations)
+                batches = [sources[i:i + batch] for i in range(0, len(sources), batch)]
+                if pool is None:
+                    parts = [shortest_paths(graph, b, targets) for b in batches]
+                else:
+                    parts = [pool.submit(shortest_paths, graph, b, targets) for b in batches]
+                    parts = [p.result() for p in parts]
+                dist = np.concatenate(parts) if parts else \
+                       np.empty((0, len(destinations)))
+
+                dist[np.isinf(dist)] = unreachable
+                if intrazonal is not None:
+                    rows, cols = origins.get_indexer(destinations), np.arange(len(destinations))
+                    dist[rows[rows >= 0], cols[rows >= 0]] = intrazonal
+                columns[c] = dist.ravel()[zs.codes] if zs.mask is not None else dist.ravel()
+        finally:
+            if owned:
+                pool.shutdown()
+
+        note(nodes=len(self.nodes), links=len(self.links), batches=len(batches))
+        return Matrix(columns, index=zs.index).with_dtype()
+
+def shortest_paths(graph, sources, targets):
+    '''Returns the shortest path costs from the sources to the targets
+    (graph nodes), as a sources x targets array.'''
+    return dijkstra(graph, directed=True, indices=sources)[:, targets]
@@ -0,0 +1,291 @@
+
+# coding: utf-8
+
+import numpy as np
+import pandas as pd
+import re
+
+try:
+    from TPlanning_matrices.Matrix import Matrix
+    from TPlanning_matrices.AuxFunctions import *
+except:
+    # For in-folder examples
+    from Matrix import Matrix
+    from AuxFunctions import *
+
+# Matrix files are read in batches of lines of about this size (bytes)
+BATCH_BYTES = 2 ** 22
+
+EMMEheader_re = re.compile(r'a\s+(?:matrix\s*=\s*)?(mo|md|mf|ms)(\d+)\s+(\S+)')
+
+def guess_format(file):
+    '''Returns the format of a matrix file ('EMME', 'FormatO' or 'TBA3'),
+    based on its first non-empty line.'''
+    line = ''
+    with open(file, 'r') as f:
+        for line in f:
+            if line.strip():
+                break
+    if line[:1] and line[:1] in 'ctda':
+        return 'EMME'
+    if line[:1] in '$*':
+        return 'FormatO'
+    return 'TBA3'
+
+def EMME_blocks(file):
+    '''Returns a list of (mat_type, mat_num, mat_name, offset) for each matrix
+    in an EMME file. offset is the position of the first data line.'''
+    blocks = []
+    with open(file, 'rb') as f:
+        offset = 0
+        for line in f:
+            offset += len(line)
+            if line[:1] == b'a':
+                header = EMMEheader_re.match(line.decode())
+                if header:
+                    blocks.append(header.groups() + (offset,))
+    return blocks
+
+#first character of the record lines (numbers)
+RECORD_START = set('0123456789+-.')
+
+def record_batches(file, ncols, offset=0, stop_at_header=True,
+                   batch_bytes=BATCH_BYTES):
+    '''Generator of numeric records (2D arrays with ncols columns) read from
+    file, starting at offset. As in Matrix.read_EMME, records are the lines
+    whose first non-blank character is numeric, and ":" is taken as a
+    separator (EMME). Lines starting with a letter are headers: if
+    stop_at_header, reading stops at the first one (next EMME matrix).
+    Other lines (e.g. * comments) are skipped, and a $ line after the
+    records ends them (e.g. VISUM $NAMES). Raises ValueError if there
+    are no records.'''
+    found = False
+    with open(file, 'r') as f:
+        f.seek(offset)
+        while True:
+            lines = f.readlines(batch_bytes)
+            if not lines:
+                break
+            data = []
+            end = False
+            for line in lines:
+                first = line.lstrip()[:1]
+                if first in RECORD_START:
+                    data.append(line)
+                elif (stop_at_header and first.isalpha()) \
+                     or (first == '$' and (found or data)):
+                    end = True
+                    break
+            if data:
+                found = True
+                text = ''.join(data)
+                if ':' in text and text.count(':') != len(data):
+                    #compact EMME records: several "D: value" per origin line
+                    vals = np.array(EMME_mf_records(text), dtype=np.float64).ravel()
+                else:
+                    vals = np.fromstring(text.replace(':', ' '), sep=' ')
+                if len(vals) % ncols:
+                    raise ValueError('{}: records must have {} values.'.format(
+                                        file, ncols))
+                yield vals.reshape(-1, ncols)
+            if end:
+                break
+    if not found:
+        raise ValueError('{}: no matrix records found (from position {}).'.format(
+                            file, offset))
+
+class OriginBuffer:
+    '''Buffers the records of a stream sorted by origin, so they can be taken
+    one block of origins at a time.'''
+
+    def __init__(self, batches, ncols):
+        self.batches = batches
+        self.ncols = ncols
+        self.pending = None
+        self.exhausted = False
+
+    def _read(self):
+        '''Reads one more batch into pending. False if there is nothing left.'''
+        if self.exhausted:
+            return False
+        try:
+            batch = next(self.batches)
+        except StopIteration:
+            self.exhausted = True
+            return False
+        if self.pending is not None and len(self.pending):
+            batch = np.concatenate([self.pending, batch])
+        if np.any(np.diff(batch[:, 0]) < 0):
+            raise ValueError('Matrix records must be sorted by origin.')
+        self.pending = batch
+        return True
+
+    def origins(self, k):
+        '''Returns up to k+1 first distinct origins in the buffer, reading
+        until there are more than k or the stream is exhausted.'''
+        while True:
+            if self.pending is not None and len(self.pending):
+                O = self.pending[:, 0]
+                origins = O[np.r_[0, np.flatnonzero(np.diff(O)) + 1]]
+                if len(origins) > k:
+                    return origins[:k+1]
+            if not self._read():
+                if self.pending is None:
+                    return np.array([])
+                O = self.pending[:, 0]
+                return O[np.r_[0, np.flatnonzero(np.diff(O)) + 1]] if len(O) else O
+
+    def take_until(self, origin):
+        '''Returns (and removes from the buffer) the records with O <= origin.'''
+        while not self.exhausted and (self.pending is None
+                                      or not len(self.pending)
+                                      or self.pending[-1, 0] <= origin):
+            self._read()
+        if self.pending is None:
+            return np.empty((0, self.ncols))
+        n = np.searchsorted(self.pending[:, 0], origin, side='right')
+        records = self.pending[:n]
+        self.pending = self.pending[n:]
+        return records
+
+def zone_labels(zones, str_zones=False):
+    '''Returns the zone labels of numeric zones: int64, or str as
+    Matrix.read_EMME labels them.'''
+    zones = zones.astype(np.int64)
+    return zones.astype(str) if str_zones else zones
+
+def origin_keys(labels):
+    '''Returns the sort keys of origin labels: numbers for numeric str
+    labels (EMME zones), so blocks follow the numeric order of the files.'''
+    labels = np.asarray(labels)
+    if len(labels) and labels.dtype.kind in 'UO':
+        try:
+            return labels.astype(np.int64)
+        except (ValueError, TypeError):
+            pass
+    return labels
+
+def records_to_matrix(records, columns, names=['O', 'D'], str_zones=False):
+    '''Returns a Matrix from a list of record arrays [O, D, value],
+    one for each column.
+        str_zones - zone labels as str (as Matrix.read_EMME) rather than int'''
+    series = []
+    for col, rec in zip(columns, records):
+        idx = pd.MultiIndex.from_arrays([zone_labels(rec[:, 0], str_zones),
+                                         zone_labels(rec[:, 1], str_zones)],
+                                        names=names)
+        series.append(pd.Series(rec[:, 2], index=idx, name=col))
+    if len(series) == 1:
+        return Matrix(series[0].to_frame()).with_dtype()
+    mat = pd.concat(series, axis=1)
+    mat.index.names = names
+    return Matrix(mat).with_dtype()
+
+class OriginBlockReader:
+    '''Reads a matrix file (EMME, TBA3 or FormatO) one block of origins at
+    a time. Records must be sorted by origin, as exported by the modelling
+    packages. Only the records of the current block are kept in memory.
+    Zone labels have the dtype of the in-memory readers (str for EMME).
+        file        - matrix file
+        fmt         - 'EMME', 'TBA3' or 'FormatO'. None to guess it.
+        names       - index names
+        batch_bytes - size of the batches of lines read from file'''
+
+    def __init__(self, file, fmt=None, names=['O', 'D'], batch_bytes=BATCH_BYTES):
+        self.file = file
+        self.fmt = fmt or guess_format(file)
+        self.names = names
+
+        if self.fmt == 'EMME':
+            blocks = [b for b in EMME_blocks(file) if b[0] == 'mf']
+            if not blocks:
+                raise ValueError('{} has no full (mf) matrices.'.format(file))
+            self.columns = [b[2] for b in blocks]
+            self.buffers = [OriginBuffer(record_batches(file, 3, b[3],
+                                            batch_bytes=batch_bytes), 3)
+                            for b in blocks]
+        elif self.fmt == 'TBA3':
+            # O D UC VALUE. User classes become columns.
+            self.columns = None
+            self.buffers = [OriginBuffer(self._TBA3_batches(batch_bytes), 4)]
+        elif self.fmt == 'FormatO':
+            #records start after the VISUM header (see read_VISUM_header)
+            with open(file, 'r') as f:
+                fmt, self.factor, zones, extra = read_VISUM_header(f)
+                offset = f.tell()
+            if fmt == 'V' or len(extra):
+                raise ValueError('{}: only VISUM $O / $E matrices with one record '
+                                 'per line can be read by blocks.'.format(file))
+            self.columns = ['T']
+            self.buffers = [OriginBuffer(record_batches(file, 3, offset,
+                                            stop_at_header=False,
+                                            batch_bytes=batch_bytes), 3)]
+        else:
+            raise ValueError('Unknown matrix format: {}'.format(self.fmt))
+
+    def _TBA3_batches(self, batch_bytes):
+        '''TBA3 lines do not necessarily start with a space.'''
+        with open(self.file, 'r') as f:
+            while True:
+                lines = f.readlines(batch_bytes)
+                if not lines:
+                    return
+                vals = np.fromstring(''.join(lines), sep=' ')
+                if len(vals) % 4:
+                    raise ValueError('{}: records must have 4 values.'.format(self.file))
+                yield vals.reshape(-1, 4)
+
+    def origins(self, k):
+        '''Returns up to k+1 next distinct origins (all column streams).'''
+        origins = [buf.origins(k) for buf in self.buffers]
+        origins = [o for o in origins if len(o)]
+        if not origins:
+            return np.array([])
+        return np.unique(np.concatenate(origins))[:k+1]
+
+    def read_until(self, origin):
+        '''Returns a Matrix with the records for origins up to origin
+        (included).'''
+        records = [buf.take_until(origin) for buf in self.buffers]
+
+        if self.fmt == 'TBA3':
+            rec = records[0]
+            mat = pd.DataFrame(rec[:, 3],
+                               index=pd.MultiIndex.from_arrays(
+                                   [rec[:, 0].astype(np.int64),
+                                    rec[:, 1].astype(np.int64),
+                                    rec[:, 2].astype(np.int64)],
+                                   names=self.names + ['UC']),
+                               columns=['VALUE'])
+            mat = mat['VALUE'].unstack()
+            mat.columns.name = None
+            return Matrix(mat).with_dtype()
+
+        if self.fmt == 'FormatO' and self.factor != 1:
+            records = [np.column_stack([rec[:, :2], rec[:, 2] * self.factor])
+                       for rec in records]
+        #EMME zones are labelled as Matrix.read_EMME does (str)
+        return records_to_matrix(records, self.columns, names=self.names,
+                                 str_zones=self.fmt == 'EMME')
+
+    def blocks(self, block_size=500):
+        '''Generator of Matrix blocks with up to block_size origins each.'''
+        for bound, (block,) in aligned_blocks([self], block_size):
+            yield block
+
+def aligned_blocks(readers, block_size=500):
+    '''Generator of (last_origin, [Matrix block for each reader]), reading all
+    readers up to the same origin, so blocks cover the same origins.
+    Each block has up to block_size origins.'''
+    while True:
+        heads = [r.origins(block_size) for r in readers]
+        heads = [h for h in heads if len(h)]
+        if not heads:
+            return
+        if all(len(h) <= block_size for h in heads):
+            #last block: read everything
+            bound = max(h[-1] for h in heads)
+        else:
+            #block_size-th origin overall, so no reader exceeds block_size
+            bound = np.unique(np.concatenate(heads))[block_size - 1]
+        yield bound, [r.read_until(bound) for r in readers]
@@ -8,6 +8,7 @@ import pandas as pd
 import matplotlib.pyplot as plt
 import re
 import os
+import functools
 
 
 # In[2]:
@@ -20,10 +21,16 @@ import glob
 try:
     from TPlanning_matrices.Matrix import Matrix
     from TPlanning_matrices.AuxFunctions import *
+    from TPlanning_matrices.Instrumentation import instrumented
+    from TPlanning_matrices.Parallel import map_columns
+    from TPlanning_matrices.Cache import cached
 except:
     # For in-folder examples    
     from Matrix import Matrix
     from AuxFunctions import *
+    from Instrumentation import instrumented
+    from Parallel import map_columns
+    from Cache import cached
 
 
 # In[4]:
@@ -106,6 +113,7 @@ class TLD(pd.DataFrame):
             tld = tld.remove_negative_index(inplace=inplace)
             return tld
 
+    @instrumented
     def band_agg(self, n, current_bands=0, upper_band=True, set_zero=False):
         '''Aggregates to bands of n.
         current_bands - length of the current interval. 0 to estimate it.'''
@@ -185,6 +193,7 @@ class TLD(pd.DataFrame):
 
     ##TODO: Add an option to dropna or fillna
     @staticmethod
+    @instrumented
     def from_dist_col(mat, dist_col=-1, dist_band=1, normalized=False):
         '''Returns the Trip-Lenght Distribution of mat, 
         based on dist_col, aggregated by dist_band.'''
@@ -209,6 +218,7 @@ class TLD(pd.DataFrame):
         return tld
 
     @staticmethod
+    @instrumented
     def from_mat_single(mat, dist, dist_col=-1, dist_band=1, normalized=False):
         '''Returns the Trip-Lenght Distribution of mat, 
         based on distance (dist_col) form dist, aggregated by dist_band.
@@ -228,23 +238,29 @@ class TLD(pd.DataFrame):
         return tld
 
     @staticmethod
-    def from_mat(mat, dist, dist_band=1, normalized=False):
+    @instrumented
+    def from_mat(mat, dist, dist_band=1, normalized=False,
+                 executor=None, workers=None):
         '''Returns the Trip-Length Distribution of mat.
         TLD for each mat column will be based on the corresponding
         column from dist (in order). mat and dist must have the same
         number of columns, or just the first distance column will be
-        used, but make sure names don't overlap!.'''
+        used, but make sure names don't overlap!.
+        executor - None, 'thread', 'process' or an Executor to calculate
+                   each column pair in parallel (see Parallel.map_columns).'''
 
         if len(mat.columns) != len(dist.columns):
             return TLD.from_mat_single(mat, dist,
                                         dist_band=dist_band,
                                         normalized=normalized)
 
-        dfs = zip_df_cols([mat,dist])
-        TLDs = [TLD.from_dist_col(df, dist_col=1,
-                                    dist_band=dist_band,
-                                    normalized=normalized)
-                for df in dfs]
+        if executor is None:
+            return TLD.from_pairs(ColumnPairs([mat, dist]),
+                                  dist_band=dist_band, normalized=normalized)
+
+        TLDs = map_columns(functools.partial(_tld_pair, dist_band=dist_band,
+                                             normalized=normalized),
+                           [mat, dist], executor, workers)
 
         tld = pd.concat(TLDs, axis=1)
         tld = TLD(tld)
@@ -252,6 +268,162 @@ class TLD(pd.DataFrame):
         return tld
 
     @staticmethod
+    @instrumented
+    def from_pairs(pairs, dist_band=1, normalized=False):
+        '''Returns the Trip-Length Distribution of each (mat, dist) column
+        pair in pairs (ColumnPairs), all pairs at once: trips of the mat
+        column are added up by distance band of the dist column.
+        Columns are named as in mat. Bands without OD pairs in a column are
+        NaN (as when concatenating the TLD of each column).'''
+
+        trips, dist = pairs.stacked[0], pairs.stacked[1]
+        bands = np.trunc(dist / dist_band)
+        valid = ~np.isnan(bands)
+
+        #bands of all pairs, then one bincount over (pair, band)
+        used, codes = np.unique(bands[valid], return_inverse=True)
+        pair = np.broadcast_to(np.arange(len(pairs)), bands.shape)[valid]
+        flat = pair * len(used) + codes.ravel()
+        shape = (len(pairs), len(used))
+        sums = np.bincount(flat, weights=np.nan_to_num(trips[valid]),
+                           minlength=shape[0] * shape[1]).reshape(shape).T
+        counts = np.bincount(flat, minlength=shape[0] * shape[1]).reshape(shape).T
+        sums[counts == 0] = np.nan
+
+        if isinstance(dist_band, (int, np.integer)):
+            used = used.astype(np.int64)
+        tld = pd.DataFrame(sums, index=used * dist_band + dist_band, #top end of each band
+                           columns=[pairs.labels(i)[0] for i in range(len(pairs))])
+        tld.loc[0, :] = 0 #fill initial zero value
+        tld = TLD(tld.sort_index())
+
+        if normalized:
+            tld = tld.norm
+
+        return tld
+
+    @staticmethod
+    @instrumented
+    def from_survey(records, dist_col='StageDistance', weight_col='Trips', by=None,
+                    dist_band=1, normalized=False, bootstrap=0, ci=0.95,
+                    seed=None, chunksize=1000000):
+        '''Returns the Trip-Length Distribution of survey records (e.g.
+        example_data/obsTLD.txt), with a column for each group of records:
+        the weights (weight_col, e.g. expanded trips; None to count records)
+        are added up by distance band of dist_col, in one bincount per block
+        of records.
+            records   - DataFrame, csv file (read in blocks of chunksize
+                        records) or iterable of DataFrames
+            by        - column or list of columns to group records by
+                        (None for a single TLD)
+            bootstrap - number of bootstrap replicates for confidence
+                        intervals (Poisson bootstrap: in each replicate,
+                        every record weight is multiplied by a Poisson(1)
+                        draw, so blocks can be resampled independently)
+            ci        - confidence level of the intervals
+        Records with no distance, weight or group (by) value are ignored.
+        Returns the TLD or, with bootstrap, (TLD, lower, upper).'''
+
+        by = [] if by is None else ([by] if isinstance(by, str) else list(by))
+        if isinstance(records, pd.DataFrame):
+            blocks = [records]
+        elif isinstance(records, (str, os.PathLike)):
+            usecols = by + [dist_col] + ([weight_col] if weight_col else [])
+            blocks = pd.read_csv(records, skipinitialspace=True, usecols=usecols,
+                                 chunksize=chunksize)
+        else:
+            blocks = records
+
+        rng = np.random.default_rng(seed)
+        groups = None
+        sums = np.zeros((0, 0))
+        counts = np.zeros((0, 0), dtype=np.int64)
+        boot = np.zeros((bootstrap, 0, 0))
+        grow = lambda a, shape: np.pad(a, [(0, n - m) for n, m in zip(shape, a.shape)])
+
+        for block in blocks:
+            dist = block[dist_col].to_numpy(dtype=np.float64)
+            if weight_col:
+                weights = block[weight_col].to_numpy(dtype=np.float64)
+            else:
+                weights = np.ones(len(block))
+            valid = ~(np.isnan(dist) | np.isnan(weights))
+            for col in by:
+                valid &= pd.notna(block[col].to_numpy())
+            bands = np.trunc(dist[valid] / dist_band).astype(np.int64)
+            weights = weights[valid]
+            if len(bands) and bands.min() < 0:
+                raise ValueError('Negative distances are not supported.')
+
+            #codes of the groups, shared by all blocks
+            if by:
+                #factorize each column, then their combinations
+                codes, levels = np.zeros(len(bands), dtype=np.int64), []
+                for col in by:
+                    c, uniques = pd.factorize(block[col].to_numpy()[valid])
+                    codes = codes * len(uniques) + c
+                    levels.append(uniques)
+                codes, combined = pd.factorize(codes)
+                arrays = []
+                for uniques in levels[::-1]:
+                    combined, c = np.divmod(combined, len(uniques))
+                    arrays.insert(0, uniques[c])
+                keys = pd.MultiIndex.from_arrays(arrays, names=by)
+            else:
+                codes = np.zeros(len(bands), dtype=np.intp)
+                keys = pd.MultiIndex.from_tuples([(weight_col or 'records',)])
+            if groups is None:
+                groups = keys[:0]
+            pos = groups.get_indexer(keys)
+            if (pos < 0).any():
+                groups = groups.append(keys[pos < 0])
+                pos = groups.get_indexer(keys)
+            codes = pos[codes]
+
+            shape = (len(groups), max(sums.shape[1], bands.max() + 1 if len(bands) else 0))
+            size = shape[0] * shape[1]
+            sums, counts = grow(sums, shape), grow(counts, shape)
+            flat = codes * shape[1] + bands
+            sums += np.bincount(flat, weights=weights, minlength=size).reshape(shape)
+            counts += np.bincount(flat, minlength=size).reshape(shape)
+
+            if bootstrap:
+                boot = grow(boot, (bootstrap,) + shape)
+                step = max(1, 2 ** 24 // bootstrap)
+                for start in range(0, len(flat), step):
+                    f, w = flat[start:start + step], weights[start:start + step]
+                    draws = rng.poisson(1., size=(bootstrap, len(f))) * w
+                    rflat = (np.arange(bootstrap)[:, np.newaxis] * size + f).ravel()
+                    boot += np.bincount(rflat, weights=draws.ravel(),
+                                        minlength=bootstrap * size).reshape(boot.shape)
+
+        if groups is None:
+            return None
+
+        #bands with records, top end of each band, plus zero
+        used = np.flatnonzero(counts.sum(axis=0))
+        index = (used + 1) * dist_band
+        columns = groups.get_level_values(0) if groups.nlevels == 1 else groups
+
+        def to_TLD(values):
+            tld = pd.DataFrame(values[:, used].T, index=index, columns=columns)
+            tld.loc[0] = 0
+            return TLD(tld.sort_index())
+
+        if normalized:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                sums = np.nan_to_num(sums / sums.sum(axis=1, keepdims=True))
+                boot = np.nan_to_num(boot / boot.sum(axis=2, keepdims=True))
+
+        tld = to_TLD(sums)
+        if not bootstrap:
+            return tld
+        lower, upper = np.quantile(boot, [(1 - ci) / 2, (1 + ci) / 2], axis=0)
+        return tld, to_TLD(lower), to_TLD(upper)
+
+    @staticmethod
+    @instrumented
+    @cached
     def read_EMME_TLD(file):
         '''Returns TLD df from an EMME TLD report file, with columns:
         ['from','to','density_abs','density_norm','cumulative_abs','cumulative_norm']
@@ -280,6 +452,7 @@ class TLD(pd.DataFrame):
         return df
 
     @staticmethod
+    @instrumented
     def read_EMME_TLDs(files):
         '''Reads all TLD reports specified in files
         and returns four DataFrames, with the TLDs combined.
@@ -298,6 +471,7 @@ class TLD(pd.DataFrame):
         return density_abs, density_norm, cumulative_abs, cumulative_norm
 
     #TODO: Set xmax, ymax for x and y axes
+    @instrumented
     def to_PNG(self, OutputName='TLD.png', title='Trip-Length Distribution',
                    ylabel='Trips', units='',
                    legend=False, table=False, table_font_colors=True,
@@ -368,14 +542,18 @@ class TLD(pd.DataFrame):
 
     #TODO: output average distances as DataFrame (and export as csv?)
     @staticmethod
+    @instrumented
     def comparison_to_PNGs(TLDs, oFileNamePattern='TLD_{}.png', *args, **kwargs):
         '''Produces comparison graphs of the columns in each TLD in TLDs list.
         Columns are taken pairwise, in positional order.
         Names based on column names.'''
-        comparisonTLDs = [TLD(df) for df in zip_df_cols(TLDs)]
-        #zip_df_cols produces DataFrames, not TLDs
-        for tld in comparisonTLDs:
+        for df in ColumnPairs(TLDs):
+            tld = TLD(df)
             tldn = '-'.join(tld.columns)
             OutputName = oFileNamePattern.format(tldn)
             TLD.to_PNG(tld, OutputName, *args, **kwargs)
 
+def _tld_pair(mat, dist, dist_band=1, normalized=False):
+    '''TLD of a single column pair (picklable, for Parallel).'''
+    return TLD.from_pairs(ColumnPairs([mat, dist]), dist_band=dist_band,
+                          normalized=normalized)
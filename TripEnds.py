@@ -0,0 +1,259 @@
+
+# coding: utf-8
+
+# Trip ends (productions and attractions) by segment, mode and car
+# availability, as balancing targets for furness and ApplyGravityModel.
+#
+#   tes = TripEnds.read('example_data/TEs.txt')
+#   TO, TD = tes.targets(mat, segments=['segment', 'mode'])
+#   demand = mat.ApplyGravityModel(TO, TD, f)
+#
+# Trip-end tables have one row per zone and segment, with Prod_<mode>_<ca>
+# and Attr_<mode> columns (e.g. Prod_Bus_CA, Attr_Bus). They are pivoted
+# once to zones x (segment, mode, ca) frames. Targets are built on the zone
+# system of a matrix (or a ZoneSystem / list of zones) with one lookup per
+# level, so they line up with the matrix without further alignment.
+
+import numpy as np
+import pandas as pd
+import re
+
+try:
+    from TPlanning_matrices.Matrix import ZoneSystem
+    from TPlanning_matrices.Instrumentation import instrumented
+    from TPlanning_matrices.Cache import cached
+except:
+    # For in-folder examples
+    from Matrix import ZoneSystem
+    from Instrumentation import instrumented
+    from Cache import cached
+
+TE_col_re = re.compile(r'(Prod|Attr)_([^_]+)(?:_(.+))?$')
+
+class TripEnds:
+    '''Productions and attractions of each zone, by segment.
+        productions - DataFrame, zones x (segment, mode, ca) columns
+        attractions - DataFrame, zones x (segment, mode) columns
+        sectors     - Series with the sector of each zone (optional)'''
+
+    def __init__(self, productions, attractions, sectors=None):
+        self.productions = productions
+        self.attractions = attractions
+        self.sectors = sectors
+
+    def __repr__(self):
+        return 'TripEnds({} zones, {} production / {} attraction columns)'.format(
+                    len(self.productions), len(self.productions.columns),
+                    len(self.attractions.columns))
+
+    @staticmethod
+    @instrumented(name='TripEnds.read')
+    @cached(name='TripEnds.read')
+    def read(file, zone_col='ModelZone', segment_col='Model Demand Segment',
+             sector_col='Sector'):
+        '''Reads a trip-end table (e.g. example_data/TEs.txt): one row per
+        zone and segment, with Prod_<mode>[_<ca>] and Attr_<mode>[_<ca>]
+        columns. Other columns (e.g. segment IDs) are ignored.'''
+
+        df = pd.read_csv(file, skipinitialspace=True)
+        df.columns = [c.strip() for c in df.columns]
+
+        zones = df[zone_col].values
+        if np.issubdtype(zones.dtype, np.floating) and \
+           np.array_equal(zones, np.trunc(zones)):
+            zones = zones.astype(np.int64)
+        zcodes, zones = pd.factorize(zones, sort=True)
+        scodes, segments = pd.factorize(df[segment_col].str.strip())
+        zones = pd.Index(zones, name='zone')
+
+        frames = {}
+        for kind in ('Prod', 'Attr'):
+            cols, labels = [], []
+            for col in df.columns:
+                m = TE_col_re.match(col)
+                if m and m.group(1) == kind:
+                    cols.append(col)
+                    labels.append(m.groups()[1:])
+            with_ca = any(ca is not None for _, ca in labels)
+            labels = [(mode, ca) if with_ca else (mode,) for mode, ca in labels]
+
+            #zones x segments x columns, adding up repeated rows
+            values = np.zeros((len(zones), len(segments), len(cols)))
+            np.add.at(values, (zcodes, scodes), df[cols].to_numpy(dtype=np.float64))
+            columns = pd.MultiIndex.from_tuples(
+                            [(s,) + l for s in segments for l in labels],
+                            names=['segment', 'mode', 'ca'][:1 + len(labels[0])])
+            frames[kind] = pd.DataFrame(values.reshape(len(zones), -1),
+                                        index=zones, columns=columns)
+
+        sectors = None
+        if sector_col in df:
+            sectors = pd.Series(df[sector_col].values, index=zcodes)
+            sectors = sectors[~sectors.index.duplicated()].sort_index()
+            if np.array_equal(sectors.values, np.trunc(sectors.values)):
+                sectors = sectors.astype(np.int64)
+            sectors.index = zones[sectors.index]
+            sectors.name = 'sector'
+
+        return TripEnds(frames['Prod'], frames['Attr'], sectors)
+
+    def aggregate(self, segments):
+        '''Returns the trip ends by the column levels in segments (e.g.
+        ['segment', 'mode']), adding up the rest (e.g. 'ca').'''
+        return TripEnds(sum_columns(self.productions, segments),
+                        sum_columns(self.attractions, segments), self.sectors)
+
+    def by_sector(self, sectors=None):
+        '''Returns the trip ends aggregated by sector (default: the sectors
+        read with the trip ends).'''
+        sectors = self.sectors if sectors is None else pd.Series(sectors)
+        if sectors is None:
+            raise ValueError('There are no sectors for these trip ends.')
+        codes, names = pd.factorize(sectors.reindex(self.productions.index), sort=True)
+        names = pd.Index(names, name=sectors.name or 'sector')
+        frames = []
+        for df in (self.productions, self.attractions):
+            values = np.zeros((len(names), len(df.columns)))
+            valid = codes >= 0
+            np.add.at(values, codes[valid], df.to_numpy()[valid])
+            frames.append(pd.DataFrame(values, index=names, columns=df.columns))
+        return TripEnds(*frames)
+
+    @instrumented(name='TripEnds.targets')
+    def targets(self, zones=None, segments=None, ca=False, balance='productions',
+                from_home=None, home_based=None):
+        '''Returns (TO, TD): trip-end targets by zone and segment, ready for
+        furness / ApplyGravityModel.
+            zones      - zone system: a Matrix (targets on its index levels),
+                         a ZoneSystem, a list of zones or None (all zones).
+                         Zones without trip ends get 0
+            segments   - column levels to keep (default: all but 'ca')
+            ca         - if True (and 'ca' in segments), attractions are
+                         split by the car availability shares of the
+                         productions of each segment and mode
+            balance    - 'productions' (attractions scaled to production
+                         totals), 'attractions' (the other way) or None
+            from_home  - None for PA targets (TO = productions, TD =
+                         attractions). Otherwise, the share of from-home
+                         trips (float or dict by segment) to convert
+                         home-based PA to OD (see PA_to_OD)
+            home_based - segments that are home-based (default: segment
+                         names starting with 'HB')'''
+
+        P, A = self.productions, self.attractions
+        if segments is None:
+            segments = [n for n in P.columns.names if n != 'ca' or ca]
+        segments = [segments] if isinstance(segments, str) else list(segments)
+
+        if 'ca' in segments and 'ca' not in A.columns.names:
+            A = split_by_ca(A, P)
+        P = sum_columns(P, segments)
+        A = sum_columns(A, segments).reindex(columns=P.columns, fill_value=0)
+
+        if balance == 'productions':
+            A = A * safe_ratio(P.sum(), A.sum())
+        elif balance == 'attractions':
+            P = P * safe_ratio(A.sum(), P.sum())
+        elif balance is not None:
+            raise ValueError("balance must be 'productions', 'attractions' or None")
+
+        if from_home is not None:
+            P, A = PA_to_OD(P, A, from_home, home_based)
+
+        if zones is None:
+            origins = destinations = P.index
+            names = ['O', 'D']
+        elif isinstance(zones, pd.DataFrame):
+            origins, destinations = zones.index.levels
+            names = list(zones.index.names)
+        elif isinstance(zones, ZoneSystem):
+            origins, destinations = zones.origins, zones.destinations
+            names = zones.names
+        else:
+            origins = destinations = pd.Index(zones)
+            names = ['O', 'D']
+
+        TO = on_zones(P, origins, names[0])
+        TD = on_zones(A, destinations, names[1])
+        return TO, TD
+
+def sum_columns(df, levels):
+    '''Returns df with the columns added up by the column levels in levels.'''
+    levels = [l for l in df.columns.names if l in levels]
+    if levels == list(df.columns.names):
+        return df
+    if not levels:
+        raise ValueError('No segment levels to keep.')
+    keys = df.columns.droplevel([l for l in df.columns.names if l not in levels])
+    codes, columns = pd.factorize(keys)
+    indicator = np.zeros((len(keys), len(columns)))
+    indicator[np.arange(len(keys)), codes] = 1
+    if len(levels) > 1:
+        columns = pd.MultiIndex.from_tuples(columns, names=levels)
+    else:
+        columns = pd.Index(columns, name=levels[0])
+    return pd.DataFrame(df.to_numpy() @ indicator, index=df.index, columns=columns)
+
+def split_by_ca(A, P):
+    '''Splits attractions (segment, mode) by the car availability shares of
+    the productions (segment, mode, ca) totals.'''
+    totals = P.sum()
+    shares = totals / totals.groupby(level=['segment', 'mode']).transform('sum')
+    shares = shares.fillna(0)
+    keys = P.columns.droplevel('ca')
+    values = A.to_numpy()[:, A.columns.get_indexer(keys)] * shares.values
+    return pd.DataFrame(values, index=A.index, columns=P.columns)
+
+def safe_ratio(num, den):
+    '''num / den, 1 where den is 0.'''
+    return (num / den.where(den != 0, np.nan)).fillna(1)
+
+def PA_to_OD(P, A, from_home=0.5, home_based=None):
+    '''Converts production / attraction trip ends of home-based segments to
+    origin / destination: O = f*P + (1-f)*A and D = f*A + (1-f)*P, where f is
+    the share of from-home trips (float or dict by segment). Other segments
+    keep O = P and D = A.
+        home_based - segments that are home-based (default: segment names
+                     starting with 'HB')'''
+    segs = P.columns.get_level_values('segment') if 'segment' in P.columns.names \
+           else P.columns
+    if home_based is None:
+        hb = np.array([str(s).startswith('HB') for s in segs])
+    else:
+        hb = np.isin(segs, list(home_based))
+    if isinstance(from_home, dict):
+        f = np.array([from_home.get(s, 0.5) for s in segs], dtype=np.float64)
+    else:
+        f = np.full(len(segs), float(from_home))
+    f = np.where(hb, f, 1.)
+    Pv, Av = P.to_numpy(), A.to_numpy()
+    O = pd.DataFrame(f * Pv + (1 - f) * Av, index=P.index, columns=P.columns)
+    D = pd.DataFrame(f * Av + (1 - f) * Pv, index=A.index, columns=A.columns)
+    return O, D
+
+def like_zones(index, zones):
+    '''Returns the zone labels in index with the dtype of zones if they
+    differ (e.g. int zones of a trip-end table and the str zones of a
+    matrix read from EMME), index otherwise.'''
+    if index.dtype == zones.dtype:
+        return index
+    try:
+        if pd.api.types.is_numeric_dtype(zones.dtype):
+            return pd.Index(pd.to_numeric(index)).astype(zones.dtype)
+        return index.astype(str).astype(zones.dtype)
+    except (ValueError, TypeError):
+        return index
+
+def on_zones(te, zones, name):
+    '''Returns te (zones x segments) on zones, with 0 for missing zones.
+    Zone labels are matched as the dtype of zones (see like_zones). Raises
+    ValueError if no zone matches.'''
+    zones = pd.Index(zones, name=name)
+    index = like_zones(te.index, zones)
+    if index.equals(zones):
+        return pd.DataFrame(te.to_numpy(), index=zones, columns=te.columns)
+    rows = index.get_indexer(zones)
+    if len(te) and len(zones) and not (rows >= 0).any():
+        raise ValueError('None of the {} zones has trip ends.'.format(name))
+    values = np.where((rows >= 0)[:, np.newaxis], te.to_numpy()[rows], 0.)
+    return pd.DataFrame(values, index=zones, columns=te.columns)